@@ -46,12 +46,28 @@ def classify(event_time, channel_name,
             timeseries
             source
 
+            save_images : if `False` the q scans are labelled straight from
+                their pixels (see `utils.rasterize_q_scans`) and no images
+                are saved, the FilenameN columns then name the images that
+                would have been saved, default: `True`
+
+            writer : a `gravityspy.plot.PNGWriter` that encodes and writes
+                the images in the background, default: `None`
+
+            path_to_semantic_model : if given, the feature space of the
+                event is also obtained from the same pixels as the
+                labels (see `utils.get_features`) and kept in the
+                columns '0', '1', ..., default: `None`
+
+            inference_endpoint : where an `inference.InferenceServer`
+                holding the models listens, they are loaded by this
+                process if it cannot be used, default: `None`
+
     Returns:
 
-        ind_fig_all
-            A list of individual spectrogram plots
-        super_fig
-            A single `plot` object contianing all spectrograms
+        events (`gravityspy.table.Events`):
+            The scores, labels, q value and images of the event, and its
+            feature space if `path_to_semantic_model` is given
     """
 
     if not os.path.isfile(path_to_cnn):
@@ -67,6 +83,15 @@ def classify(event_time, channel_name,
     config = kwargs.pop('config', utils.GravitySpyConfigFile())
     plot_directory = kwargs.pop('plot_directory', 'plots')
     id_string = kwargs.pop('id_string', '{0:.9f}'.format(event_time))
+    save_images = kwargs.pop('save_images', True)
+    writer = kwargs.pop('writer', None)
+    path_to_semantic_model = kwargs.pop('path_to_semantic_model', None)
+    inference_endpoint = kwargs.pop('inference_endpoint', None)
+    # one read of the images serves both models
+    if path_to_semantic_model is None:
+        color = 'grayscale'
+    else:
+        color = 'both'
 
     # Parse Ini File
     plot_time_ranges = config.plot_time_ranges
@@ -80,17 +105,53 @@ def classify(event_time, channel_name,
                                              config=config,
                                              **kwargs)
 
-    utils.save_q_scans(plot_directory, specsgrams,
-                       plot_normalized_energy_range, plot_time_ranges,
-                       detector_name, event_time, frange=frange,
-                       id_string=id_string,
-                       **kwargs)
+    if save_images:
+        utils.save_q_scans(plot_directory, specsgrams,
+                           plot_normalized_energy_range, plot_time_ranges,
+                           detector_name, event_time, frange=frange,
+                           id_string=id_string, writer=writer,
+                           super_image=config.super_image,
+                           image_format=config.image_format,
+                           thumbnail_scale=config.thumbnail_scale,
+                           **kwargs)
+        if writer is not None:
+            writer.flush()
+        image_data = utils.read_q_scans(plot_directory, color=color,
+                                        image_format=config.image_format)
+    else:
+        image_data = utils.rasterize_q_scans(specsgrams,
+                                             plot_normalized_energy_range,
+                                             plot_time_ranges,
+                                             detector_name, event_time,
+                                             frange=frange,
+                                             id_string=id_string,
+                                             color=color,
+                                             image_format=config.image_format)
+
+    image_data, names = image_data
+    if path_to_semantic_model is not None:
+        image_data, image_data_rgb = image_data
 
     results = utils.label_q_scans(plot_directory=plot_directory,
                                   path_to_cnn=path_to_cnn,
+                                  image_data=(image_data, names),
+                                  image_format=config.image_format,
+                                  inference_endpoint=inference_endpoint,
                                   **kwargs)
 
+    if path_to_semantic_model is not None:
+        features = utils.get_features(
+            plot_directory=plot_directory,
+            path_to_semantic_model=path_to_semantic_model,
+            image_data=(image_data_rgb, names),
+            inference_endpoint=inference_endpoint, **kwargs)
+
     results['q_value'] = q_value
+    if path_to_semantic_model is not None:
+        # the rows of both tables follow the images read
+        for name in features.colnames:
+            if name != 'gravityspy_id':
+                results[name] = features[name]
 
     results = results.to_pandas()
     results['Filename1'] = results['Filename1'].apply(lambda x, y : os.path.join(y, x),
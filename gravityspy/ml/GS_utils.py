@@ -5,12 +5,6 @@ processing the outputs into a more understandable way.
 For example ``tile_raster_images`` helps in generating a easy to grasp
 image from a set of samples or weights.
 """
-from keras import backend as K
-from keras.regularizers import l2
-from keras.models import Sequential
-from keras.layers import Dense, Dropout, Activation, Flatten
-from keras.layers import MaxPooling2D, Conv2D
-
 import numpy as np
 
 #4/2/2018
@@ -48,37 +42,70 @@ def concatenate_views(image_set1, image_set2, image_set3,
         concated_view (array):
             A single merged view of the sample, in the case
             a merged view of the 0.5 1.0 2.0 and 4.0 duration
-            omega scans.
+            omega scans, see `assemble_views`
     """
-    img_rows = image_size[0]
-    img_cols = image_size[1]
-    if rgb_flag:
-        ch = 3
-    else:
-        ch = 1
+    assert len(image_set1) == len(image_set2)
+    assert len(image_set3) == len(image_set4)
+    return assemble_views([image_set1, image_set2, image_set3, image_set4],
+                          order_of_channels=order_of_channels)
+
+def assemble_views(views, out=None, order_of_channels='channels_last'):
+    """Merge the 4 views of every sample into one 2x2 panel
+
+    The first and second views are stacked on the left, the third and
+    fourth on the right. The panels are written straight into `out`, so
+    one buffer can be reused for every batch of samples.
+
+    Parameters:
+        views (array):
+            The (samples, 4, ...) views, or a list of the 4 (samples, ...)
+            arrays, of shape (rows, columns, channels) for 'channels_last'
+            or (channels, rows, columns) for 'channels_first' each, or
+            (rows, columns) for grayscale pixels
+
+        out (array, optional):
+            Where to write the panels, of shape (samples, 2 * rows,
+            2 * columns, channels) for 'channels_last' or (samples,
+            channels, 2 * rows, 2 * columns) for 'channels_first',
+            default: a new float32 array, the dtype of the models
+
+        order_of_channels (str, optional):
+            default: 'channels_last'
 
+    Returns:
+        concated_view (array):
+            `out`, holding the merged view of every sample
+    """
+    if isinstance(views, np.ndarray):
+        views = [views[:, iview] for iview in range(views.shape[1])]
     if order_of_channels == 'channels_last':
-        concat_images_set = np.zeros((len(image_set1), img_rows * 2, img_cols, ch))
-        concat_images_set2 = np.zeros((len(image_set3), img_rows * 2, img_cols, ch))
-        concat_row_axis = 0
-        concat_col_axis = 2
+        views = [view if view.ndim == 4 else view[..., None]
+                 for view in views]
+        img_rows, img_cols, ch = views[0].shape[1:]
+        shape = (len(views[0]), img_rows * 2, img_cols * 2, ch)
     elif order_of_channels == 'channels_first':
-        concat_images_set = np.zeros((len(image_set1), ch, img_rows * 2, img_cols))
-        concat_images_set2 = np.zeros((len(image_set3), ch, img_rows * 2, img_cols))
-        concat_row_axis = 1
-        concat_col_axis = 3
+        views = [view if view.ndim == 4 else view[:, None] for view in views]
+        ch, img_rows, img_cols = views[0].shape[1:]
+        shape = (len(views[0]), ch, img_rows * 2, img_cols * 2)
     else:
         raise ValueError("Do not understand supplied channel order")
 
-    assert len(image_set1) == len(image_set2)
-    for i in range(0, len(image_set1)):
-        concat_images_set[i, :, :, :] = np.append(image_set1[i, :, :, :], image_set2[i, :, :, :], axis=concat_row_axis)
-
-    assert len(image_set3) == len(image_set4)
-    for i in range(0, len(image_set3)):
-        concat_images_set2[i, :, :, :] = np.append(image_set3[i, :, :, :], image_set4[i, :, :, :], axis=concat_row_axis)
+    if out is None:
+        out = np.empty(shape, dtype='float32')
+    elif out.shape != shape:
+        raise ValueError("The buffer has shape {0}, not {1}".format(
+                         out.shape, shape))
 
-    out = np.append(concat_images_set,concat_images_set2, axis=concat_col_axis)
+    if order_of_channels == 'channels_last':
+        panel = out
+    else:
+        # write the rows and columns of every channel the same way
+        panel = np.moveaxis(out, 1, -1)
+        views = [np.moveaxis(view, 1, -1) for view in views]
+    panel[:, :img_rows, :img_cols] = views[0]
+    panel[:, img_rows:, :img_cols] = views[1]
+    panel[:, :img_rows, img_cols:] = views[2]
+    panel[:, img_rows:, img_cols:] = views[3]
     return out
 
 #4/2/2018
@@ -108,6 +135,12 @@ def build_cnn(img_rows, img_cols, order_of_channels):
         model (`object`):
             a CNN
     """
+    # keras is only needed to train models, see numpy_model
+    from keras.regularizers import l2
+    from keras.models import Sequential
+    from keras.layers import Dense, Dropout, Activation, Flatten
+    from keras.layers import MaxPooling2D, Conv2D
+
     W_reg = 1e-4
     print('regularization parameter: ', W_reg)
     if order_of_channels == 'channels_last':
@@ -156,6 +189,7 @@ def cosine_distance(vects):
 
         vect (array):
     """
+    from keras import backend as K
     x, y = vects
     x = K.maximum(x, K.epsilon())
     y = K.maximum(y, K.epsilon())
@@ -170,6 +204,8 @@ def siamese_acc(thred):
         thred (float):
             It is something
     """
+    from keras import backend as K
+
     def inner_siamese_acc(y_true, y_pred):
         pred_res = y_pred < thred
         acc = K.mean(K.cast(K.equal(K.cast(pred_res, dtype='int32'), K.cast(y_true, dtype='int32')), dtype='float32'))
@@ -182,6 +218,7 @@ def eucl_dist_output_shape(shapes):
     return (shape1[0], 1)
 
 def contrastive_loss(y_true, y_pred):
+    from keras import backend as K
     margin = 1
     return K.mean(y_true * K.square(y_pred) + (1 - y_true) * K.square(K.maximum(margin - y_pred, 0)))
 
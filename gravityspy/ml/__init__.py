@@ -15,6 +15,3 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
-
-from keras import backend as K
-K.set_image_data_format("channels_last")
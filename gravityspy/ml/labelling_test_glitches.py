@@ -1,10 +1,7 @@
-from .GS_utils import concatenate_views
-from keras import backend as K
-K.set_image_data_format("channels_last")
-from keras.models import load_model
+from .GS_utils import concatenate_views, assemble_views
+from .numpy_model import EXTENSION
+from .registry import MODEL_REGISTRY
 from PIL import Image
-from keras.applications.vgg16 import preprocess_input
-from keras.optimizers import RMSprop
 
 import numpy
 import os
@@ -78,7 +75,7 @@ def label_glitches(image_data, model_name,
     img_rows, img_cols = image_size[0], image_size[1]
 
     # load a model and weights
-    K.set_image_data_format(order_of_channels)
+    _set_image_data_format(model_name, order_of_channels)
     if order_of_channels == 'channels_last':
         reshape_order = (-1, img_rows, img_cols, 1)
     elif order_of_channels == 'channels_first':
@@ -86,11 +83,7 @@ def label_glitches(image_data, model_name,
     else:
         raise ValueError("Do not understand supplied channel order")
 
-    final_model = load_model(model_name)
-
-    final_model.compile(loss='categorical_crossentropy',
-                        optimizer='adadelta',
-                        metrics=['accuracy'])
+    predict = MODEL_REGISTRY.get_predictor(model_name)
 
     first_image_in_panel = sorted(image_data.filter(regex=(image_order[0])).keys())
     second_image_in_panel = sorted(image_data.filter(regex=(image_order[1])).keys())
@@ -106,7 +99,7 @@ def label_glitches(image_data, model_name,
     concat_test_unlabelled = concatenate_views(test_set_unlabelled_x_1,
                             test_set_unlabelled_x_2, test_set_unlabelled_x_3, test_set_unlabelled_x_4, [img_rows, img_cols], False, order_of_channels)
 
-    confidence_array = final_model.predict_proba(concat_test_unlabelled, verbose=0)
+    confidence_array = predict(concat_test_unlabelled)
     index_label = confidence_array.argmax(1)
 
     ids = []
@@ -142,7 +135,7 @@ def get_feature_space(image_data, semantic_model_name, image_size=[140, 170],
             a 200 dimensional feature space vector
     """
     img_rows, img_cols = image_size[0], image_size[1]
-    semantic_idx_model = load_model(semantic_model_name)
+    predict = MODEL_REGISTRY.get_predictor(semantic_model_name)
     test_data = image_data.filter(regex=("1.0.png")).iloc[0].iloc[0].reshape(-1, 1, img_rows, img_cols)
     test_data = test_data.reshape([test_data.shape[0], img_rows, img_cols, 1])
     test_data = numpy.repeat(test_data, 3, axis=3)
@@ -153,7 +146,7 @@ def get_feature_space(image_data, semantic_model_name, image_size=[140, 170],
         img_rows = 224
         test_data = numpy.asarray(new_data2)
 
-    return semantic_idx_model.predict([test_data])
+    return predict([test_data])
 
 
 def get_multiview_feature_space(image_data, semantic_model_name,
@@ -185,7 +178,7 @@ def get_multiview_feature_space(image_data, semantic_model_name,
     """
     img_rows, img_cols = image_size[0], image_size[1]
 
-    K.set_image_data_format(order_of_channels)
+    _set_image_data_format(semantic_model_name, order_of_channels)
     if order_of_channels == 'channels_last':
         reshape_order = (-1, img_rows, img_cols, 3)
     elif order_of_channels == 'channels_first':
@@ -206,21 +199,146 @@ def get_multiview_feature_space(image_data, semantic_model_name,
     concat_test_unlabelled = concatenate_views(test_set_unlabelled_x_1,
                             test_set_unlabelled_x_2, test_set_unlabelled_x_3, test_set_unlabelled_x_4, [img_rows, img_cols], True, order_of_channels)
 
-    concat_test_unlabelled = preprocess_input(concat_test_unlabelled)
+    concat_test_unlabelled = _preprocess_input(concat_test_unlabelled)
 
     ids = []
     for uid in half_second_images:
         ids.append(uid.split('_')[1])
 
-    semantic_idx_model = load_model(semantic_model_name)
-    features = semantic_idx_model.predict([concat_test_unlabelled])
+    predict = MODEL_REGISTRY.get_predictor(semantic_model_name)
+    features = predict([concat_test_unlabelled])
 
     return features, ids
 
 
+def predict_batch(image_data, model_name, order_of_channels="channels_last",
+                  batch_size=64, rgb=False, penultimate=False):
+    """Run a model over many samples, a minibatch at a time
+
+    Only one minibatch of merged views is held at once, so the memory
+    used does not grow with the number of samples.
+
+    Parameters:
+
+        image_data (`numpy.ndarray`):
+            The pixels of the 0.5, 1.0, 2.0 and 4.0 second views of each
+            sample, of shape (samples, 4, rows, columns) for the
+            classifier or (samples, 4, rows, columns, 3) for the
+            similarity model, as from `read_image.read_batch`
+
+        model_name (str):
+            Path to the model
+
+        order_of_channels (str, optional):
+            default "channels_last"
+
+        batch_size (int, optional):
+            The number of samples passed to the model at once,
+            default 64
+
+        rgb (bool, optional):
+            `True` for the similarity model, which reads RGB views,
+            default False
+
+        penultimate (bool, optional):
+            Also return the activations fed to the last layer of the
+            model, e.g. the deep layer of the classifier, obtained
+            from the same pass through the model, default False
+
+    Returns:
+
+        np.array:
+            the outputs of the model for every sample, e.g. the
+            confidence scores per class of the classifier
+
+        np.array:
+            the activations fed to the last layer for every sample,
+            only if `penultimate`
+    """
+    if order_of_channels not in ["channels_last", "channels_first"]:
+        raise ValueError("Do not understand supplied channel order")
+    _set_image_data_format(model_name, order_of_channels)
+
+    img_rows, img_cols = image_data.shape[2:4]
+    model = MODEL_REGISTRY.get_model(model_name)
+    predict = MODEL_REGISTRY.get_predictor(model_name,
+                                           penultimate=penultimate)
+
+    outputs = numpy.empty((len(image_data),) + tuple(model.output_shape[1:]),
+                          dtype='float32')
+    if penultimate:
+        # shaped by the first minibatch
+        activations = numpy.empty((len(image_data), 0), dtype='float32')
+    # one buffer holds the merged views of every minibatch
+    ch = 3 if rgb else 1
+    if order_of_channels == "channels_last":
+        shape = (batch_size, img_rows * 2, img_cols * 2, ch)
+    else:
+        shape = (batch_size, ch, img_rows * 2, img_cols * 2)
+    buffer = numpy.empty(shape, dtype='float32')
+
+    for first in range(0, len(image_data), batch_size):
+        batch = image_data[first:first + batch_size]
+        views = [_model_views(batch[:, iview], order_of_channels, rgb)
+                 for iview in range(4)]
+        concat_test_unlabelled = assemble_views(
+            views, out=buffer[:len(batch)],
+            order_of_channels=order_of_channels)
+        if rgb:
+            concat_test_unlabelled = _preprocess_input(concat_test_unlabelled)
+            concat_test_unlabelled = [concat_test_unlabelled]
+        batch_outputs = predict(concat_test_unlabelled, batch_size=batch_size)
+        if penultimate:
+            if first == 0:
+                activations = numpy.empty(
+                    (len(image_data),) + batch_outputs[0].shape[1:],
+                    dtype='float32')
+            activations[first:first + len(batch)] = batch_outputs[0]
+            batch_outputs = batch_outputs[1]
+        outputs[first:first + len(batch)] = batch_outputs
+
+    if penultimate:
+        return outputs, activations
+
+    return outputs
+
+
+def _set_image_data_format(model_name, order_of_channels):
+    # only keras models read the format, and they need keras anyway
+    if model_name.endswith(EXTENSION):
+        return
+    from keras import backend as K
+    K.set_image_data_format(order_of_channels)
+
+
+def _preprocess_input(x):
+    # the similarity model is a keras VGG16
+    from keras.applications.vgg16 import preprocess_input
+    return preprocess_input(x)
+
+
+def _model_views(view, order_of_channels, rgb):
+    """One view of a batch of samples, shaped as the models read it
+
+    The RGB views are flattened one colour plane after the other, as by
+    `read_image.read_rgb`, and then reshaped the way
+    `get_multiview_feature_space` does.
+    """
+    nsamples, img_rows, img_cols = view.shape[:3]
+    if not rgb:
+        if order_of_channels == "channels_last":
+            return view.reshape(nsamples, img_rows, img_cols, 1)
+        return view.reshape(nsamples, 1, img_rows, img_cols)
+
+    planes = numpy.ascontiguousarray(numpy.moveaxis(view, -1, 1))
+    if order_of_channels == "channels_last":
+        return planes.reshape(nsamples, img_rows, img_cols, 3)
+    return planes.reshape(nsamples, 3, img_rows, img_cols)
+
+
 def get_deeplayer(image_data, model_name, image_size=[140, 170],
-                  verbose=False):
-    """Obtain 1XNclasses confidence vector and label for image
+                  verbose=False, order_of_channels="channels_last"):
+    """Obtain the confidence scores and the deep layer of samples
 
     Parameters:
 
@@ -230,8 +348,8 @@ def get_deeplayer(image_data, model_name, image_size=[140, 170],
             the b/w pixel values at some resoltion
             determined by `read_image`
 
-        model_adr (str, optional):
-            Path to folder containing model
+        model_name (str):
+            Path to the classifier
 
         image_size (list, optional):
             Default [140, 170]
@@ -239,61 +357,39 @@ def get_deeplayer(image_data, model_name, image_size=[140, 170],
         verbose (bool, optional):
             Default False
 
+        order_of_channels (str, optional):
+            default "channels_last"
+
     Returns:
 
-        score3_unlabelled (np.array):
+        confidence_array (np.array):
             confidence scores per class (b/t 0 and 1)
-            index_label (int): ml label
-    """
 
-    numpy.random.seed(1986)  # for reproducibility
+        index_label (np.array):
+            ml label
 
+        deeplayer (np.array):
+            the activations fed to the softmax, see `predict_batch`
+    """
     img_rows, img_cols = image_size[0], image_size[1]
 
-    # load a model and weights
-    if verbose:
-        print ('Retrieving the trained ML classifier')
-    final_model = load_model(model_name)
-
-    final_model.compile(loss='categorical_crossentropy',
-                        optimizer='adadelta',
-                        metrics=['accuracy'])
-
     if verbose:
         print ('Scoring unlabelled glitches')
 
-    half_second_images = sorted(image_data.filter(regex=("0.5.png")).keys())
-    one_second_images = sorted(image_data.filter(regex=("1.0.png")).keys())
-    two_second_images = sorted(image_data.filter(regex=("2.0.png")).keys())
-    four_second_images = sorted(image_data.filter(regex=("4.0.png")).keys())
-
-    # read in 4 durations
-    test_set_unlabelled_x_1 = numpy.vstack(image_data[half_second_images].iloc[0].values)
-    test_set_unlabelled_x_1 = test_set_unlabelled_x_1.reshape(-1, 1, img_rows, img_cols)
-
-    test_set_unlabelled_x_2 = numpy.vstack(image_data[four_second_images].iloc[0].values)
-    test_set_unlabelled_x_2 = test_set_unlabelled_x_2.reshape(-1, 1, img_rows, img_cols)
-
-    test_set_unlabelled_x_3 = numpy.vstack(image_data[one_second_images].iloc[0].values)
-    test_set_unlabelled_x_3 = test_set_unlabelled_x_3.reshape(-1, 1, img_rows, img_cols)
-
-    test_set_unlabelled_x_4 = numpy.vstack(image_data[two_second_images].iloc[0].values)
-    test_set_unlabelled_x_4 = test_set_unlabelled_x_4.reshape(-1, 1, img_rows, img_cols)
+    panels = [sorted(image_data.filter(regex=(duration)).keys())
+              for duration in ['0.5.png', '1.0.png', '2.0.png', '4.0.png']]
+    views = numpy.stack([
+        numpy.vstack(image_data[panel].iloc[0]).reshape(-1, img_rows, img_cols)
+        for panel in panels], axis=1)
 
-    concat_test_unlabelled = concatenate_views(test_set_unlabelled_x_1,
-                            test_set_unlabelled_x_2, test_set_unlabelled_x_3, test_set_unlabelled_x_4, [img_rows, img_cols], False)
-
-    feature_exc1 = K.function([final_model.layers[0].get_input_at(node_index=0),
-                K.learning_phase()],
-               [final_model.layers[0].get_layer(index=20).output])
-
-    deeplayer = feature_exc1([concat_test_unlabelled, 0])[0]
+    confidence_array, deeplayer = predict_batch(
+        views, model_name, order_of_channels=order_of_channels,
+        penultimate=True)
+    index_label = confidence_array.argmax(1)
 
     ids = []
-    for uid in half_second_images:
+    for uid in panels[0]:
         ids.append(uid.split('_')[1])
 
-    confidence_array = final_model.predict_proba(concat_test_unlabelled, verbose=0)
-    index_label = confidence_array.argmax(1)
-
-    return confidence_array, index_label, deeplayer, ids, half_second_images, one_second_images, two_second_images, four_second_images
+    return (confidence_array, index_label, deeplayer, ids, panels[0],
+            panels[1], panels[2], panels[3])
@@ -0,0 +1,191 @@
+"""Run the classifier of `GS_utils.build_cnn` with NumPy alone
+
+Loading keras and building the graph of a model takes seconds and
+hundreds of MB, which is most of the cost of scoring one event.
+`export_model` writes the weights and class labels of a trained
+classifier to a small `.npz` file, which `NumpyModel` runs with one
+matrix product per convolution (im2col), without importing keras.
+"""
+from numpy.lib.stride_tricks import as_strided
+
+import h5py
+import json
+import numpy as np
+
+#: The extension of exported models
+EXTENSION = '.npz'
+
+
+def export_model(filename, output):
+    """Write a trained classifier to the format of `NumpyModel`
+
+    Parameters
+        filename (str):
+            the `.h5` file of a classifier from `GS_utils.build_cnn`
+            and a softmax layer, with its class labels in
+            `/labels/labels`
+
+        output (str):
+            the `.npz` file to write
+    """
+    with h5py.File(filename, 'r') as f:
+        classes = np.array(f['/labels/labels']).astype(str).T[0]
+        data_format = 'channels_last'
+        if 'model_config' in f.attrs:
+            data_format = _data_format(json.loads(_str(
+                f.attrs['model_config'])), data_format)
+        group = f['model_weights'] if 'model_weights' in f else f
+        weights = []
+        for layer in group.attrs['layer_names']:
+            for weight in group[_str(layer)].attrs['weight_names']:
+                weights.append(np.array(group[_str(layer)][_str(weight)],
+                                        dtype=np.float32))
+
+    kernels = [weight for weight in weights if weight.ndim == 4]
+    dense = [weight for weight in weights if weight.ndim == 2]
+    if len(kernels) + len(dense) != len(weights) / 2 or len(dense) != 2:
+        raise ValueError('{0} is not a classifier of build_cnn'.format(
+                         filename))
+
+    arrays = {'classes': classes, 'data_format': data_format}
+    for idx in range(0, len(weights), 2):
+        arrays['kernel_{0}'.format(idx // 2)] = weights[idx]
+        arrays['bias_{0}'.format(idx // 2)] = weights[idx + 1]
+    np.savez(output, **arrays)
+
+
+def _str(value):
+    # h5py gives the names of older files as bytes
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def _data_format(config, default):
+    # the data_format of the first convolution in a model config
+    if isinstance(config, dict):
+        if 'data_format' in config:
+            return config['data_format']
+        config = list(config.values())
+    if isinstance(config, list):
+        for item in config:
+            data_format = _data_format(item, None)
+            if data_format is not None:
+                return data_format
+    return default
+
+
+class NumpyModel(object):
+    """A classifier of `GS_utils.build_cnn` written by `export_model`
+
+    The convolutions are 'valid', each followed by a ReLU and 2x2 max
+    pooling, then come the ReLU dense layer and the softmax. Dropout
+    does nothing at inference.
+
+    Parameters
+        filename (str):
+            the file written by `export_model`
+    """
+    def __init__(self, filename):
+        with np.load(filename, allow_pickle=False) as arrays:
+            self.classes = arrays['classes']
+            self.data_format = str(arrays['data_format'])
+            nlayers = len([key for key in arrays if key.startswith('kernel')])
+            self.kernels = [arrays['kernel_{0}'.format(idx)]
+                            for idx in range(nlayers)]
+            self.biases = [arrays['bias_{0}'.format(idx)]
+                           for idx in range(nlayers)]
+        self.output_shape = (None, len(self.classes))
+
+    def predict(self, x, batch_size=32, verbose=0, penultimate=False):
+        """The scores of every class for a batch of merged views
+
+        Parameters
+            x (`np.ndarray`):
+                the merged views, shaped as the inputs of the keras
+                model, or a list of them
+
+            batch_size (int, optional):
+                the number of samples held at once, default: 32
+
+            verbose (int, optional):
+                ignored, as for `keras.models.Model.predict`
+
+            penultimate (bool, optional):
+                also give the activations of the dense layer before
+                the softmax, default: `False`
+
+        Returns
+            scores (`np.ndarray`):
+                or the list of the activations and the scores if
+                `penultimate`
+        """
+        if isinstance(x, list):
+            x = x[0]
+        scores = np.empty((len(x), len(self.classes)), dtype=np.float32)
+        activations = np.empty((len(x), self.kernels[-1].shape[0]),
+                               dtype=np.float32)
+        for first in range(0, len(x), batch_size):
+            batch = slice(first, first + batch_size)
+            activations[batch], scores[batch] = self._forward(x[batch])
+
+        if penultimate:
+            return [activations, scores]
+
+        return scores
+
+    def _forward(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.data_format == 'channels_first':
+            x = np.moveaxis(x, 1, -1)
+        x = np.ascontiguousarray(x)
+
+        for kernel, bias in zip(self.kernels[:-2], self.biases[:-2]):
+            x = _max_pool(_conv2d(x, kernel, bias))
+            np.maximum(x, 0, out=x)
+
+        # Flatten follows the order of the axes of the keras model
+        if self.data_format == 'channels_first':
+            x = np.moveaxis(x, -1, 1)
+        x = x.reshape(len(x), -1)
+
+        activations = np.dot(x, self.kernels[-2]) + self.biases[-2]
+        np.maximum(activations, 0, out=activations)
+        logits = np.dot(activations, self.kernels[-1]) + self.biases[-1]
+        logits -= logits.max(axis=1, keepdims=True)
+        scores = np.exp(logits)
+        scores /= scores.sum(axis=1, keepdims=True)
+        return activations, scores
+
+
+def _conv2d(x, kernel, bias):
+    """A 'valid' convolution of channels_last images as one product
+
+    The patches of one image are gathered at a time, which bounds the
+    memory used to that of the patches of the largest image.
+    """
+    nrows, ncols, nchannels, nfilters = kernel.shape
+    nsamples, rows, cols = x.shape[:3]
+    out_rows, out_cols = rows - nrows + 1, cols - ncols + 1
+    weights = kernel.reshape(-1, nfilters)
+
+    out = np.empty((nsamples, out_rows, out_cols, nfilters), dtype=np.float32)
+    strides = x.strides[1:]
+    for isample in range(nsamples):
+        patches = as_strided(x[isample],
+                             shape=(out_rows, out_cols, nrows, ncols,
+                                    nchannels),
+                             strides=strides[:2] + strides)
+        np.dot(patches.reshape(out_rows * out_cols, -1), weights,
+               out=out[isample].reshape(out_rows * out_cols, nfilters))
+    out += bias
+    return out
+
+
+def _max_pool(x):
+    """2x2 max pooling of channels_last images, dropping odd edges
+    """
+    nsamples, rows, cols, nchannels = x.shape
+    x = x[:, :rows // 2 * 2, :cols // 2 * 2]
+    return x.reshape(nsamples, rows // 2, 2, cols // 2, 2,
+                     nchannels).max(axis=(2, 4))
@@ -1,9 +1,10 @@
 from skimage import io
 from skimage.color import rgb2gray
 from skimage.transform import rescale
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import os
-from functools import reduce
+from functools import reduce, lru_cache
 
 
 def read_and_crop_image(filename, x, y):
@@ -54,6 +55,23 @@ def read_grayscale(filename, resolution=0.3, x=[66, 532], y=[105, 671],
     """
     image_data = read_and_crop_image(filename, x=x, y=y)
 
+    return to_grayscale(image_data, resolution=resolution)
+
+def to_grayscale(image_data, resolution=0.3):
+    """Convert cropped RGB pixels to Gray, downsample
+
+    Parameters
+        image_data (`np.array`):
+            RGB pixels, as returned by `read_and_crop_image`
+
+        resolution (float, optional):
+            default: 0.3
+
+    Returns
+        image_data (`np.array):
+            this images is taken from rgb to gray scale
+            and then downsampled by the resolution.
+    """
     image_data = rgb2gray(image_data)
     image_data = rescale(image_data, resolution, mode='constant',
                          preserve_range='True', multichannel=False)
@@ -84,6 +102,23 @@ def read_rgb(filename, resolution=0.3, x=[66, 532], y=[105, 671],
             and then downsampled by the resolution.
     """
     image_data = read_and_crop_image(filename, x=x, y=y)
+
+    return to_rgb(image_data, resolution=resolution)
+
+def to_rgb(image_data, resolution=0.3):
+    """Downsample cropped RGB pixels
+
+    Parameters
+        image_data (`np.array`):
+            RGB pixels, as returned by `read_and_crop_image`
+
+        resolution (float, optional):
+            default: 0.3
+
+    Returns
+        image_data_r, image_data_g, image_data_b (`np.array`):
+            the downsampled red, green and blue pixels
+    """
     image_data = rescale(image_data, resolution, mode='constant',
                          preserve_range='True', multichannel=True)
     dim = np.int(reduce(lambda x, y: x * y, image_data[:,:,0].shape))
@@ -92,3 +127,179 @@ def read_rgb(filename, resolution=0.3, x=[66, 532], y=[105, 671],
     image_data_b = np.reshape(image_data[:,:,2], (dim))
 
     return image_data_r, image_data_g, image_data_b
+
+@lru_cache(maxsize=8)
+def get_resampling_operator(shape, resolution=0.3):
+    """Find the (cached) matrices that downsample images like `rescale`
+
+    `skimage.transform.rescale` with `mode='constant'` smooths and
+    interpolates each axis independently, so before clipping it is the
+    product `rows @ image @ columns.T`. The matrices are measured from
+    `rescale` itself, and `resample` matches it to within 1e-6 of
+    the range of the pixels.
+
+    Parameters
+        shape (tuple):
+            (rows, columns) of the images, e.g. (466, 566) for the
+            default crop
+
+        resolution (float, optional):
+            default: 0.3
+
+    Returns
+        rows, columns (`np.array`):
+            of shape (output rows, rows) and (output columns, columns)
+    """
+    return (_resampling_matrix(shape[0], resolution),
+            _resampling_matrix(shape[1], resolution))
+
+def _resampling_matrix(size, resolution, width=10):
+    """Measure how `rescale` resamples one axis
+
+    A narrow image with one channel per pixel of the axis gives every
+    column of the matrix at once, scaled by how `rescale` resamples the
+    other axis, which the same image of ones tells.
+    """
+    probe = np.zeros((size, width, size))
+    probe[np.arange(size), :, np.arange(size)] = 1
+    probe = rescale(probe, resolution, mode='constant', clip=False,
+                    preserve_range=True, multichannel=True)
+    ones = rescale(np.ones((size, width, 1)), resolution, mode='constant',
+                   clip=False, preserve_range=True, multichannel=True)
+    # the middle output row is far from the edges, where the weights
+    # of each output pixel add up to one
+    row, column = ones.shape[0] // 2, ones.shape[1] // 2
+    return probe[:, column, :] / ones[row, column, 0]
+
+def resample(image_data, resolution=0.3):
+    """Downsample a batch of images with matrix products
+
+    Parameters
+        image_data (`np.array`):
+            images of shape (..., rows, columns)
+
+        resolution (float, optional):
+            default: 0.3
+
+    Returns
+        image_data (`np.array`):
+            float64 images of shape (..., output rows, output columns),
+            as `rescale` of each image with `mode='constant'`, see
+            `get_resampling_operator`
+    """
+    image_data = np.asarray(image_data, dtype=np.float64)
+    rows, columns = get_resampling_operator(image_data.shape[-2:],
+                                            resolution)
+    resampled = np.matmul(np.matmul(rows, image_data), columns.T)
+    # as rescale, keep each image within the range of its pixels
+    return np.clip(resampled, image_data.min(axis=(-2, -1), keepdims=True),
+                   image_data.max(axis=(-2, -1), keepdims=True))
+
+def resample_views(views, resolution=0.3, color='grayscale'):
+    """Downsample the views of one sample as `read_batch` does
+
+    Parameters
+        views (list):
+            The cropped RGB pixels of each view, as returned by
+            `read_and_crop_image`
+
+        resolution (float, optional):
+            default: 0.3
+
+        color (str, optional):
+            'grayscale', 'rgb' or 'both', default: 'grayscale'
+
+    Returns
+        image_data (`np.array`):
+            float64 pixels of shape (views, rows, columns) for
+            'grayscale' or (views, rows, columns, 3) for 'rgb', or a
+            tuple of both arrays for 'both'
+    """
+    gray_data = rgb_data = None
+    if color in ['grayscale', 'both']:
+        gray_data = resample([rgb2gray(view) for view in views],
+                             resolution=resolution)
+    if color in ['rgb', 'both']:
+        # resample the red, green and blue planes of every view
+        planes = np.moveaxis(np.array(views, dtype=np.float64), -1, 1)
+        rgb_data = np.moveaxis(resample(planes, resolution=resolution), 1, -1)
+
+    if color == 'both':
+        return gray_data, rgb_data
+    return rgb_data if gray_data is None else gray_data
+
+def read_batch(filenames, resolution=0.3, x=[66, 532], y=[105, 671],
+               color='grayscale', nthreads=4):
+    """Read the views of many samples at once
+
+    The images are decoded on a pool of threads, and the views of each
+    sample downsampled together by `resample`, straight into one
+    preallocated array. The pixels match `read_grayscale` and
+    `read_rgb` to within 1e-6 of their range. With `color='both'` each
+    image is decoded once for the two arrays.
+
+    Parameters
+        filenames (list):
+            One list of filenames per sample, e.g.
+            `zip(Filename1, Filename2, Filename3, Filename4)`
+
+        resolution (float, optional):
+            default: 0.3
+
+        color (str, optional):
+            'grayscale' (as `read_grayscale`), 'rgb' (as `read_rgb`)
+            or 'both', default: 'grayscale'
+
+        nthreads (int, optional):
+            The number of images decoded at once, default: 4
+
+    Returns
+        image_data (`np.array`):
+            float32 pixels of shape (samples, views, rows, columns) for
+            'grayscale' or (samples, views, rows, columns, 3) for 'rgb',
+            e.g. rows, columns = 140, 170 by default, or a tuple of
+            both arrays for 'both'
+
+        ids (list):
+            The id of each sample, taken from the name of its first view
+    """
+    filenames = [list(sample) for sample in filenames]
+    nviews = len(filenames[0]) if filenames else 0
+
+    # the shape skimage.transform.rescale gives the cropped images
+    shape = tuple(np.maximum(np.round(
+        resolution * np.array([x[1] - x[0], y[1] - y[0]])), 1).astype(int))
+    if color not in ['grayscale', 'rgb', 'both']:
+        raise ValueError('Unknown color {0}, please choose '
+                         'from grayscale, rgb or both'.format(color))
+    gray_data = rgb_data = None
+    if color in ['grayscale', 'both']:
+        gray_data = np.empty((len(filenames), nviews) + shape,
+                             dtype='float32')
+    if color in ['rgb', 'both']:
+        rgb_data = np.empty((len(filenames), nviews) + shape + (3,),
+                            dtype='float32')
+
+    def _read(isample):
+        views = resample_views([read_and_crop_image(filename, x=x, y=y)
+                                for filename in filenames[isample]],
+                               resolution=resolution, color=color)
+        if color == 'both':
+            gray_data[isample], rgb_data[isample] = views
+        elif gray_data is not None:
+            gray_data[isample] = views
+        else:
+            rgb_data[isample] = views
+
+    if nthreads > 1:
+        with ThreadPoolExecutor(nthreads) as executor:
+            list(executor.map(_read, range(len(filenames))))
+    else:
+        for isample in range(len(filenames)):
+            _read(isample)
+
+    ids = [os.path.basename(sample[0]).split('_')[1] for sample in filenames]
+
+    if color == 'both':
+        return (gray_data, rgb_data), ids
+    return (rgb_data if gray_data is None else gray_data), ids
@@ -0,0 +1,159 @@
+"""Load each trained model once per process
+
+Scoring in a loop used to load (and compile) the models on every call,
+which costs seconds each time. `MODEL_REGISTRY` keeps every model and
+its class labels, keyed by the path and modification time of the file,
+so a retrained model written to the same path is loaded again.
+
+Models exported by `numpy_model.export_model` are run by
+`numpy_model.NumpyModel`, and keras is not imported for them.
+"""
+from .numpy_model import EXTENSION, NumpyModel
+
+import h5py
+import numpy as np
+import os
+import threading
+
+
+class ModelRegistry(object):
+    """The models and class labels loaded by this process
+
+    Models are loaded without compiling them, which only training needs.
+    """
+    def __init__(self):
+        self._models = {}
+        self._classes = {}
+        self._predictors = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._models)
+
+    @staticmethod
+    def key(filename):
+        """The key a model is kept under
+
+        Parameters
+            filename (str):
+                the file of the model
+
+        Returns
+            key (tuple)
+        """
+        return os.path.abspath(filename), os.stat(filename).st_mtime_ns
+
+    def get_model(self, filename):
+        """The (cached) model of a file
+
+        Parameters
+            filename (str):
+                the file of the model
+
+        Returns
+            model (`keras.models.Model`):
+                not compiled, or a `numpy_model.NumpyModel`
+        """
+        key = self.key(filename)
+        with self._lock:
+            if key not in self._models:
+                self._forget(key)
+                if filename.endswith(EXTENSION):
+                    self._models[key] = NumpyModel(filename)
+                else:
+                    from keras.models import load_model
+                    self._models[key] = load_model(filename, compile=False)
+            return self._models[key]
+
+    def get_classes(self, filename):
+        """The (cached) class labels stored with a model
+
+        Parameters
+            filename (str):
+                the file of the model
+
+        Returns
+            classes (`np.array`):
+                the name of the class of every score of the model
+        """
+        key = self.key(filename)
+        with self._lock:
+            if key not in self._classes:
+                self._forget(key)
+                if filename.endswith(EXTENSION):
+                    self._classes[key] = self.get_model(filename).classes
+                    return self._classes[key]
+                with h5py.File(filename, 'r') as f:
+                    self._classes[key] = np.array(
+                        f['/labels/labels']).astype(str).T[0]
+            return self._classes[key]
+
+    def get_predictor(self, filename, penultimate=False):
+        """A warmed-up predict function of a model
+
+        The first prediction of a model builds its graph, so the
+        function predicts one blank sample before it is returned.
+
+        Parameters
+            filename (str):
+                the file of the model
+
+            penultimate (bool, optional):
+                also give the activations fed to the last layer, from
+                the same pass through the model, default: `False`
+
+        Returns
+            predict (callable):
+                `predict(x, batch_size=32)` gives the outputs of the
+                model for the inputs `x`, or the list of the
+                activations and the outputs if `penultimate`
+        """
+        key = self.key(filename)
+        with self._lock:
+            if key + (penultimate,) not in self._predictors:
+                self._forget(key)
+                model = self.get_model(filename)
+                if isinstance(model, NumpyModel):
+                    # there is no graph to build
+                    def predict(x, batch_size=32):
+                        return model.predict(x, batch_size=batch_size,
+                                             penultimate=penultimate)
+
+                    self._predictors[key + (penultimate,)] = predict
+                    return predict
+
+                if penultimate:
+                    from keras.models import Model
+                    model = Model(inputs=model.inputs,
+                                  outputs=[model.layers[-1].input] +
+                                  model.outputs)
+
+                def predict(x, batch_size=32):
+                    return model.predict(x, batch_size=batch_size, verbose=0)
+
+                shapes = model.input_shape
+                if not isinstance(shapes, list):
+                    shapes = [shapes]
+                predict([np.zeros((1,) + tuple(shape[1:]), dtype='float32')
+                         for shape in shapes])
+                self._predictors[key + (penultimate,)] = predict
+            return self._predictors[key + (penultimate,)]
+
+    def clear(self):
+        """Forget every model
+        """
+        with self._lock:
+            self._models.clear()
+            self._classes.clear()
+            self._predictors.clear()
+
+    def _forget(self, key):
+        # the versions of a model rewritten since they were loaded
+        for cache in [self._models, self._classes, self._predictors]:
+            for stale in [stale for stale in cache
+                          if stale[0] == key[0] and stale[1] != key[1]]:
+                del cache[stale]
+
+
+#: The models loaded by this process
+MODEL_REGISTRY = ModelRegistry()
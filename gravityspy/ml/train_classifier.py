@@ -34,6 +34,12 @@ def fetch_data(ifo, event_time, duration=8, sample_frequency=4096,
 
         verbose (bool, optional):
 
+        **kwargs:
+            frametype
+
+            strain_cache : `gravityspy.utils.cache.StrainCache` to read
+                the resampled data through, default: `None`
+
     Returns:
 
         a `gwpy.timeseries.TimeSeries`
@@ -48,19 +54,35 @@ def fetch_data(ifo, event_time, duration=8, sample_frequency=4096,
     stop_time = start_time + duration
     frametype = kwargs.pop('frametype', None)
     frametype = '{0}_HOFT_{1}'.format(ifo, frametype)
+    strain_cache = kwargs.pop('strain_cache', None)
+    channel_name = '{0}:GDS-CALIB_STRAIN'.format(ifo)
+
+    def _resample(data):
+        if data.sample_rate.decompose().value != sample_frequency:
+            data = data.resample(sample_frequency)
+        return data
+
+    def _fetch(start_time, stop_time):
+        return _resample(TimeSeries.get(channel_name, start_time,
+                                        stop_time, frametype=frametype,
+                                        verbose=verbose).astype('float64'))
+
+    def _fetch_open_data(start_time, stop_time):
+        return _resample(TimeSeries.fetch_open_data(ifo, start_time,
+                                                    stop_time,
+                                                    verbose=verbose))
+
+    def _get(key, fetch, origin=None):
+        if strain_cache is not None:
+            return strain_cache.get(key, start_time, stop_time,
+                                    sample_frequency, fetch, origin=origin)
+        return fetch(start_time, stop_time)
 
     try:
-        channel_name = '{0}:GDS-CALIB_STRAIN'.format(ifo)
-        data = TimeSeries.get(channel_name, start_time,
-                              stop_time, frametype=frametype,
-                              verbose=verbose).astype('float64')
+        return _get(channel_name, _fetch, origin=frametype)
     except:
-        TimeSeries.fetch_open_data(ifo, start_time, stop_time, verbose=verbose)
-
-    if data.sample_rate.decompose().value != sample_frequency:
-        data = data.resample(sample_frequency)
-
-    return data
+        # open data are cached apart from the calibrated frames
+        return _get('{0}:GWOSC-STRAIN'.format(ifo), _fetch_open_data)
 
 
 def training_set_raw_data(filename, format, duration=8, sample_frequency=4096,
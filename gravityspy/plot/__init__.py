@@ -16,4 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
 
-from .plot import plot_qtransform
+from .plot import (plot_qtransform, QTransformRenderer)
+from .raster import rasterize_qtransform
+from .writer import (PNGWriter, render_figure, save_image, make_thumbnail,
+                     image_extension)
+from .stitch import stitch_qtransform
@@ -19,22 +19,31 @@
 """Plotting tool for gravityspy
 """
 
-from matplotlib import use
-use('agg')
-from matplotlib import pyplot
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.ticker import ScalarFormatter
 
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
-from gwpy.plot import Plot
+from gwpy.plot.rc import get_subplot_params
 
 import numpy
+import threading
+
+#: Size (inches) of the plot of each spectrogram
+INDIVIDUAL_FIGSIZE = (8, 6)
+
+#: Size (inches) of the plot of all spectrograms
+SUPER_FIGSIZE = (27, 6)
 
 
 def plot_qtransform(specsgrams, plot_normalized_energy_range, plot_time_ranges,
                     detector_name, start_time, **kwargs):
     """Fetch raw data around a glitch
 
+    The figures are drawn on their own Agg canvas, without `pyplot`,
+    so q scans can be plotted by several threads at once.
+
     Parameters:
 
         specsgrams (list):
@@ -53,61 +62,35 @@ def plot_qtransform(specsgrams, plot_normalized_energy_range, plot_time_ranges,
             What was the start time of the data used for these spectrograms
             this effects what the plot title is (ER10 O1 O2 etc)
 
+        plot_super_fig (bool, optional):
+            Whether to plot all spectrograms on one figure, default: True
+
     Returns:
 
         ind_fig_all
             A list of individual spectrogram plots
         super_fig
-            A single `plot` object contianing all spectrograms
+            A single `matplotlib.figure.Figure` contianing all spectrograms,
+            `None` if not `plot_super_fig`
     """
     frange = kwargs.pop('frange', [10, 2048])
+    plot_super_fig = kwargs.pop('plot_super_fig', True)
 
     # Set some plotting params
     myfontsize = 15
     mylabelfontsize = 20
     my_color = 'k'
-    if detector_name == 'H1':
-        title = "Hanford"
-    elif detector_name == 'L1':
-        title = "Livingston"
-    elif detector_name == 'V1':
-        title = "VIRGO"
-    else:
-        raise ValueError('You have supplied a detector '
-                         'that is unknown at this time.')
-
-    if start_time < 1126400000:
-        title = title + ' - pre O1'
-    elif 1126400000 < start_time < 1137250000:
-        title = title + ' - O1'
-    elif 1137250000 < start_time < 1161907217:
-        title = title + ' - post O1 pre ER10'
-    elif 1161907217 < start_time < 1164499217:
-        title = title + ' - ER10'
-    elif 1164499217 < start_time < 1219276818:
-        title = title + ' - O2a'
-    elif 1219276818 < start_time < 1228838418:
-        title = title + ' - post O2 pre ER13'
-    elif 1228838418 < start_time < 1229176818:
-        title = title + ' - ER13'
-    elif 1229176818 < start_time < 1235750418:
-        title = title + ' - post ER13 pre O3'
-    elif 1235750418 <start_time < 1238112018:
-        title = title + ' - ER14'
-    elif 1238112018 <start_time:
-        title = title + ' - O3'
-    else:
-        raise ValueError('Time outside science or engineering run '
-                         'or more likely code not updated to reflect '
-                         'new science run.')
+    title = plot_title(detector_name, start_time)
 
     ind_fig_all = []
 
     for i, spec in enumerate(specsgrams):
 
-        ind_fig = spec.plot(figsize=[8, 6])
+        ind_fig = _new_figure(figsize=list(INDIVIDUAL_FIGSIZE))
+        ax = ind_fig.add_subplot(1, 1, 1)
+        # as drawn by `gwpy.spectrogram.Spectrogram.plot`
+        ax.pcolormesh(spec)
 
-        ax = ind_fig.gca()
         ax.set_position([0.125, 0.1, 0.775, 0.8])
         ax.set_yscale('log', basey=2)
         ax.set_xscale('linear')
@@ -135,30 +118,35 @@ def plot_qtransform(specsgrams, plot_normalized_energy_range, plot_time_ranges,
         ax.yaxis.set_major_formatter(ScalarFormatter())
         ax.ticklabel_format(axis='y', style='plain')
 
-        pyplot.tick_params(axis='x', which='major', labelsize=myfontsize)
-        pyplot.tick_params(axis='y', which='major', labelsize=12)
+        ax.tick_params(axis='x', which='major', labelsize=myfontsize)
+        ax.tick_params(axis='y', which='major', labelsize=12)
 
         divider = make_axes_locatable(ax)
         cax = divider.append_axes("right", size="5%", pad="3%")
 
-        cbar = ind_fig.colorbar(cax=cax, cmap='viridis',
-                                label='Normalized energy',
-                                clim=plot_normalized_energy_range)
+        cbar = ax.colorbar(cax=cax, cmap='viridis',
+                           label='Normalized energy',
+                           clim=plot_normalized_energy_range)
 
         cbar.ax.tick_params(labelsize=12)
         cbar.ax.yaxis.label.set_size(myfontsize)
 
         ind_fig_all.append(ind_fig)
 
+    if not plot_super_fig:
+        return ind_fig_all, None
+
     # Create one image containing all spectogram grams
-    super_fig, axes = pyplot.subplots(nrows=1, ncols=len(specsgrams),
-                                      sharey=True,
-                                      subplot_kw={'xscale': 'auto-gps'},
-                                      figsize=(27, 6), FigureClass=Plot)
+    super_fig = _new_figure(figsize=SUPER_FIGSIZE)
+    axes = super_fig.subplots(nrows=1, ncols=len(specsgrams), sharey=True,
+                              squeeze=False)[0]
     count = 0
 
     for iax, spec in zip(axes, specsgrams):
-        iax.imshow(spec)
+        if _is_regular(spec.yindex):
+            iax.imshow(spec)
+        else:
+            iax.pcolormesh(spec)
 
         iax.set_yscale('log', basey=2)
         iax.set_xscale('linear')
@@ -185,3 +173,160 @@ def plot_qtransform(specsgrams, plot_normalized_energy_range, plot_time_ranges,
     super_fig.suptitle(title, fontsize=mylabelfontsize, color=my_color, x=0.51)
 
     return ind_fig_all, super_fig
+
+
+def plot_title(detector_name, start_time):
+    """The title of the plots of a q scan
+
+    Parameters:
+
+        detector_name (str):
+            What detetor where these spectrograms from
+
+        start_time (float):
+            What was the start time of the data used for these spectrograms
+            this effects what the plot title is (ER10 O1 O2 etc)
+
+    Returns:
+
+        title (str)
+    """
+    if detector_name == 'H1':
+        title = "Hanford"
+    elif detector_name == 'L1':
+        title = "Livingston"
+    elif detector_name == 'V1':
+        title = "VIRGO"
+    else:
+        raise ValueError('You have supplied a detector '
+                         'that is unknown at this time.')
+
+    if start_time < 1126400000:
+        title = title + ' - pre O1'
+    elif 1126400000 < start_time < 1137250000:
+        title = title + ' - O1'
+    elif 1137250000 < start_time < 1161907217:
+        title = title + ' - post O1 pre ER10'
+    elif 1161907217 < start_time < 1164499217:
+        title = title + ' - ER10'
+    elif 1164499217 < start_time < 1219276818:
+        title = title + ' - O2a'
+    elif 1219276818 < start_time < 1228838418:
+        title = title + ' - post O2 pre ER13'
+    elif 1228838418 < start_time < 1229176818:
+        title = title + ' - ER13'
+    elif 1229176818 < start_time < 1235750418:
+        title = title + ' - post ER13 pre O3'
+    elif 1235750418 <start_time < 1238112018:
+        title = title + ' - ER14'
+    elif 1238112018 <start_time:
+        title = title + ' - O3'
+    else:
+        raise ValueError('Time outside science or engineering run '
+                         'or more likely code not updated to reflect '
+                         'new science run.')
+
+    return title
+
+
+class QTransformRenderer(object):
+    """Plot q scans on figures reused from one event to the next
+
+    The first event plotted for each detector, observing run, durations,
+    frequency range and colorbar range is plotted by `plot_qtransform`.
+    Later events only replace the spectrograms (and time axes) of those
+    figures, which are saved pixel for pixel as `plot_qtransform` would
+    have plotted them.
+
+    Every thread plots on its own figures, so one renderer can be shared
+    by a pool of threads. The figures returned by `QTransformRenderer.plot`
+    are only valid until its next call from the same thread.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def plot(self, specsgrams, plot_normalized_energy_range,
+             plot_time_ranges, detector_name, start_time, **kwargs):
+        """Plot q scans, see `plot_qtransform`
+
+        Returns:
+
+            ind_fig_all
+                A list of individual spectrogram plots
+            super_fig
+                A single `plot` object contianing all spectrograms
+        """
+        frange = kwargs.pop('frange', [10, 2048])
+        plot_super_fig = kwargs.pop('plot_super_fig', True)
+
+        key = (plot_title(detector_name, start_time),
+               tuple(float(dur) for dur in plot_time_ranges), tuple(frange),
+               tuple(plot_normalized_energy_range),
+               tuple(_is_regular(spec.yindex) for spec in specsgrams),
+               plot_super_fig)
+
+        templates = self._templates
+        if key not in templates:
+            templates[key] = plot_qtransform(
+                specsgrams, plot_normalized_energy_range, plot_time_ranges,
+                detector_name, start_time, frange=frange,
+                plot_super_fig=plot_super_fig)
+            return templates[key]
+
+        ind_fig_all, super_fig = templates[key]
+        for ind_fig, spec, dur in zip(ind_fig_all, specsgrams,
+                                      plot_time_ranges):
+            _replace_spectrogram(ind_fig.axes[0], spec, dur, frange)
+        if super_fig is not None:
+            for iax, spec, dur in zip(super_fig.axes, specsgrams,
+                                      plot_time_ranges):
+                _replace_spectrogram(iax, spec, dur, frange)
+
+        return ind_fig_all, super_fig
+
+    @property
+    def _templates(self):
+        """The figures of the calling thread
+        """
+        if not hasattr(self._local, 'templates'):
+            self._local.templates = {}
+        return self._local.templates
+
+
+def _new_figure(figsize):
+    """A figure with its own Agg canvas, unknown to `pyplot`
+
+    Its axes are `gwpy.plot.Axes`, which `gwpy` registers as the default
+    projection, so spectrograms can be drawn on them directly.
+    """
+    fig = Figure(figsize=figsize, subplotpars=get_subplot_params(figsize))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _replace_spectrogram(ax, spec, dur, frange):
+    """Draw a spectrogram in place of the one on these axes
+    """
+    if ax.images:
+        old = ax.images[0]
+        new = ax.imshow(spec)
+    else:
+        old = ax.collections[0]
+        new = ax.pcolormesh(spec)
+    new.set_cmap(old.get_cmap())
+    new.set_clim(old.get_clim())
+    old.remove()
+
+    ax.set_xlim(spec.xspan)
+    ax.set_ylim(frange)
+    ax.set_xticks(numpy.linspace(spec.xindex.min().value,
+                                 spec.xindex.max().value, 5))
+    ax.set_xticklabels([str(itick) for itick in
+                        numpy.linspace(-float(dur)/2, float(dur)/2, 5)])
+
+
+def _is_regular(index):
+    """Whether an index is evenly spaced
+    """
+    steps = numpy.diff(index.value)
+    return numpy.allclose(steps, steps[0])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Scott Coughlin (2017-)
+#
+# This file is part of gravityspy.
+#
+# gravityspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gravityspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Draw q scans straight into pixels, without matplotlib
+"""
+
+from matplotlib import cm
+from matplotlib.colors import Normalize
+
+import numpy
+
+#: Pixel extent (left, right, top, bottom) of the spectrogram in the
+#: 800x600 individual plots of `plot_qtransform`: the axes at
+#: [0.125, 0.1, 0.775, 0.8] lose 8% of their width to the colorbar
+AXES_EXTENT = (100., 100. + 620. / 1.08, 60., 540.)
+
+
+def rasterize_qtransform(spec, plot_normalized_energy_range,
+                         frange=(10, 2048), x=[66, 532], y=[105, 671]):
+    """Draw the pixels of a q scan as they appear in its plot
+
+    Each pixel takes the colour of the spectrogram tile under its centre,
+    as `imshow` (without interpolation) and `pcolormesh` draw them.
+
+    Parameters:
+
+        spec (`gwpy.spectrogram.Spectrogram`):
+            The q scan
+
+        plot_normalized_energy_range (array):
+            The min and max of the colorbar
+
+        frange (array, optional):
+            The frequency limits of the plot, default: (10, 2048)
+
+        x (list, optional):
+            The range of rows of the plot to draw,
+            default: [66, 532] as cropped by `read_image`
+
+        y (list, optional):
+            The range of columns of the plot to draw,
+            default: [105, 671] as cropped by `read_image`
+
+    Returns:
+
+        image_data (`numpy.ndarray`):
+            `uint8` RGB pixels of shape (rows, columns, 3)
+    """
+    left, right, top, bottom = AXES_EXTENT
+    rows = numpy.arange(x[0], x[1]) + 0.5
+    columns = numpy.arange(y[0], y[1]) + 0.5
+
+    # the data coordinates of the centre of each pixel
+    start_time, end_time = spec.xspan
+    times = start_time + ((columns - left) / (right - left) *
+                          (end_time - start_time))
+    low, high = numpy.log2(frange)
+    frequencies = 2 ** (low + (bottom - rows) / (bottom - top) * (high - low))
+
+    # the tile under each pixel
+    time_edges = numpy.append(spec.xindex.value, spec.xspan[1])
+    frequency_edges = numpy.append(spec.yindex.value, spec.yspan[1])
+    itime = numpy.searchsorted(time_edges, times, side='right') - 1
+    ifrequency = numpy.searchsorted(frequency_edges, frequencies,
+                                    side='right') - 1
+    time_inside = (itime >= 0) & (itime < spec.shape[0])
+    frequency_inside = (ifrequency >= 0) & (ifrequency < spec.shape[1])
+
+    values = spec.value[numpy.clip(itime, 0, spec.shape[0] - 1)[None, :],
+                        numpy.clip(ifrequency, 0, spec.shape[1] - 1)[:, None]]
+
+    # Agg rounds (rather than truncates) colours to 8 bits
+    norm = Normalize(*plot_normalized_energy_range)
+    image_data = numpy.rint(cm.viridis(norm(values))[:, :, :3] * 255
+                            ).astype(numpy.uint8)
+
+    # no tile: the white background of the axes
+    image_data[~(frequency_inside[:, None] & time_inside[None, :])] = 255
+
+    return image_data
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Scott Coughlin (2017-)
+#
+# This file is part of gravityspy.
+#
+# gravityspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gravityspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Combine the individual q scan plots into one image
+"""
+
+from .plot import (INDIVIDUAL_FIGSIZE, SUPER_FIGSIZE)
+
+import numpy
+
+#: Columns of the 800x600 individual plots of `plot_qtransform` from the
+#: left of the spectrograms to the right of the last time tick label
+AXES_COLUMNS = (100, 702)
+
+#: Columns left of the spectrograms holding the frequency axis, which
+#: only the first panel keeps, and the first time tick label overhangs
+FREQUENCY_AXIS_COLUMNS = (78, 100)
+
+#: First column of the colorbar
+COLORBAR_COLUMN = 690
+
+#: Rows above the spectrograms holding the title
+TITLE_ROWS = 58
+
+#: First row of the time tick labels, below the spectrograms
+TIME_AXIS_ROW = 546
+
+
+def stitch_qtransform(panels):
+    """Lay out the individual q scan plots side by side
+
+    The panels share one title and the colorbar of the first one, as
+    in the combined plot of `plot_qtransform`, and the image is as wide
+    as that plot. The columns left over are spread between the panels.
+    Panels too wide to fit are laid out without gaps, in a wider image.
+
+    Parameters:
+
+        panels (list):
+            The `uint8` RGB or RGBA pixels of the 800x600 individual
+            plots of `plot_qtransform`, in order of duration
+
+    Returns:
+
+        image_data (`numpy.ndarray`):
+            `uint8` pixels of the combined image
+    """
+    first = panels[0]
+
+    # the panels are rendered at the same dpi as the combined plot
+    dpi = first.shape[0] / INDIVIDUAL_FIGSIZE[1]
+    width = int(round(SUPER_FIGSIZE[0] * dpi))
+    used = (AXES_COLUMNS[1] + (len(panels) - 1) *
+            (AXES_COLUMNS[1] - FREQUENCY_AXIS_COLUMNS[0]) +
+            first.shape[1] - COLORBAR_COLUMN)
+    gaps = [max(0, width - used) // len(panels)] * len(panels)
+    gaps[-1] += max(0, width - used) % len(panels)
+
+    pieces = []
+    for idx, panel in enumerate(panels):
+        panel = numpy.array(panel, dtype=numpy.uint8)
+        # one title and one colorbar replace those of every panel
+        panel[:TITLE_ROWS, AXES_COLUMNS[0]:] = 255
+        panel[:TIME_AXIS_ROW, COLORBAR_COLUMN:] = 255
+        if idx == 0:
+            pieces.append(panel[:, :AXES_COLUMNS[1]])
+        else:
+            # the frequency axis is shared with the first panel, but keep
+            # the time tick label overhanging it
+            panel[:TIME_AXIS_ROW, slice(*FREQUENCY_AXIS_COLUMNS)] = 255
+            pieces.append(panel[:, FREQUENCY_AXIS_COLUMNS[0]:AXES_COLUMNS[1]])
+        pieces.append(numpy.full((first.shape[0], gaps[idx], first.shape[2]),
+                                 255, dtype=numpy.uint8))
+
+    colorbar = numpy.array(first[:, COLORBAR_COLUMN:], dtype=numpy.uint8)
+    colorbar[TIME_AXIS_ROW:] = 255
+    pieces.append(colorbar)
+    image_data = numpy.concatenate(pieces, axis=1)
+
+    title = first[:TITLE_ROWS, AXES_COLUMNS[0]:COLORBAR_COLUMN]
+    left = (image_data.shape[1] - title.shape[1]) // 2
+    image_data[:TITLE_ROWS, left:left + title.shape[1]] = title
+
+    return image_data
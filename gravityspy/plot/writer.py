@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Scott Coughlin (2017-)
+#
+# This file is part of gravityspy.
+#
+# gravityspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gravityspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Write plots to image files in the background
+"""
+
+from PIL import Image
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import numpy
+import os
+import tempfile
+import threading
+
+#: The file extension of each image format
+IMAGE_EXTENSIONS = {
+    'png': '.png',
+    'png-palette': '.png',
+    'webp': '.webp',
+}
+
+
+class PNGWriter(object):
+    """Encode and write figures to image files on a pool of threads
+
+    `PNGWriter.write` draws the figure on the calling thread, so the
+    figure can be reused as soon as it returns, and leaves the PNG
+    encoding and the writing of the file to the pool. Every image is
+    written to a temporary file which is then renamed, so a file with
+    the final name is always a complete image.
+
+    Parameters:
+
+        nthreads (int, optional):
+            The number of images encoded at once, default: 2
+
+        maxsize (int, optional):
+            The most images waiting to be written, `PNGWriter.write`
+            blocks until there is room for more, default: 16
+
+        compress_level (int, optional):
+            The zlib compression level, from 0 (fastest, largest files)
+            to 9 (slowest, smallest files), default: 6 as `matplotlib`
+
+        image_format (str, optional):
+            The encoding of the images, see `save_image`, default: 'png'
+    """
+    def __init__(self, nthreads=2, maxsize=16, compress_level=6,
+                 image_format='png'):
+        image_extension(image_format)
+        self.nthreads = nthreads
+        self.compress_level = compress_level
+        self.image_format = image_format
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._executor = None
+        self._pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, fig, filename, dpi=100):
+        """Queue a figure to be written
+
+        Parameters:
+
+            fig (`matplotlib.figure.Figure`):
+                The figure to write
+
+            filename (str):
+                Where to write it
+
+            dpi (float, optional):
+                The resolution of the image, default: 100
+
+        Returns:
+
+            future (`concurrent.futures.Future`):
+                Done when the file is written
+        """
+        return self.write_image(render_figure(fig, dpi=dpi), filename)
+
+    def write_image(self, image, filename):
+        """Queue an image to be written
+
+        Parameters:
+
+            image (`numpy.ndarray`):
+                `uint8` RGB or RGBA pixels of shape (rows, columns, 3 or 4)
+
+            filename (str):
+                Where to write it
+
+        Returns:
+
+            future (`concurrent.futures.Future`):
+                Done when the file is written
+        """
+        self._slots.acquire()
+        try:
+            future = self._get_executor().submit(
+                save_image, image, filename, self.compress_level,
+                self.image_format)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def flush(self):
+        """Wait until every queued image is written
+
+        Raises the first error met writing any of them.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """Write the queued images and stop the threads
+        """
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self):
+        # the threads of a pool do not survive a fork, so a forked
+        # process starts its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.nthreads)
+                self._pid = os.getpid()
+                self._pending = []
+            return self._executor
+
+
+def render_figure(fig, dpi=100):
+    """Draw a figure into pixels
+
+    Parameters:
+
+        fig (`matplotlib.figure.Figure`):
+            The figure to draw
+
+        dpi (float, optional):
+            The resolution of the image, default: 100
+
+    Returns:
+
+        image (`numpy.ndarray`):
+            `uint8` RGBA pixels of shape (rows, columns, 4), as saved
+            by `savefig`
+    """
+    buf = io.BytesIO()
+    fig.savefig(buf, format='rgba', dpi=dpi)
+    width = int(round(fig.get_figwidth() * dpi))
+    return numpy.frombuffer(buf.getvalue(), dtype=numpy.uint8).reshape(
+        (-1, width, 4))
+
+
+def save_image(image, filename, compress_level=6, image_format='png'):
+    """Write pixels to an image file
+
+    The image is written to a temporary file which is then renamed,
+    so a file with the final name is always a complete image.
+
+    Parameters:
+
+        image (`numpy.ndarray`):
+            `uint8` RGB or RGBA pixels of shape (rows, columns, 3 or 4)
+
+        filename (str):
+            Where to write it
+
+        compress_level (int, optional):
+            The zlib compression level of PNGs, default: 6
+
+        image_format (str, optional):
+            'png', 'png-palette' (PNG of at most 256 colours, close to
+            but not exactly the original pixels) or 'webp' (lossless),
+            default: 'png'
+    """
+    image_extension(image_format)
+    image = Image.fromarray(numpy.ascontiguousarray(image))
+    if image_format == 'webp':
+        options = {'format': 'WEBP', 'lossless': True}
+    else:
+        if image_format == 'png-palette':
+            image = image.convert('RGB').quantize(256, method=Image.MEDIANCUT)
+        options = {'format': 'PNG', 'compress_level': compress_level}
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmpfile:
+            image.save(tmpfile, **options)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+
+def make_thumbnail(image, scale):
+    """Downscale pixels
+
+    Parameters:
+
+        image (`numpy.ndarray`):
+            `uint8` RGB or RGBA pixels of shape (rows, columns, 3 or 4)
+
+        scale (float):
+            The size of the thumbnail relative to the image
+
+    Returns:
+
+        thumbnail (`numpy.ndarray`):
+            `uint8` pixels of the thumbnail
+    """
+    image = Image.fromarray(numpy.ascontiguousarray(image))
+    size = (max(1, int(round(image.width * scale))),
+            max(1, int(round(image.height * scale))))
+    return numpy.asarray(image.resize(size, Image.LANCZOS))
+
+
+def image_extension(image_format):
+    """The file extension of an image format, see `save_image`
+
+    Parameters:
+
+        image_format (str)
+
+    Returns:
+
+        extension (str)
+    """
+    try:
+        return IMAGE_EXTENSIONS[image_format]
+    except KeyError:
+        raise ValueError('Unknown image format {0}, please choose from '
+                         '{1}'.format(image_format,
+                                      ', '.join(sorted(IMAGE_EXTENSIONS))))
@@ -24,14 +24,14 @@ from gwpy.table.filter import filter_table
 from gwpy.table.filters import in_segmentlist
 from sklearn.cluster import KMeans
 from astropy.table import Column
-from keras import backend as K
-K.set_image_data_format("channels_last")
-from keras.models import load_model
 
 from ..utils import log
 from ..utils import utils
+from ..utils.sharedmemory import SharedTimeSeries
+from ..plot.plot import QTransformRenderer
+from ..plot.writer import (PNGWriter, image_extension)
 from ..api.project import GravitySpyProject
-from ..ml.train_classifier import make_model
+from ..ml.registry import MODEL_REGISTRY
 
 import panoptes_client
 import numpy
@@ -40,7 +40,6 @@ import subprocess
 import string
 import random
 import os
-import h5py
 
 class Events(GravitySpyTable):
     """This class provides method for classifying events with gravityspy
@@ -99,6 +98,31 @@ class Events(GravitySpyTable):
             **kwargs:
                 nproc : number of parallel event times to be processing at once
 
+                coalesce : if `True` the events are grouped into blocks of
+                    overlapping data (see `utils.plan_blocks`) and the data
+                    for each block is fetched and whitened only once,
+                    default: `False`
+
+                max_block_time : the longest block of data to coalesce
+                    when `coalesce` is `True`, default: 1024 seconds
+
+                asd_cache : `gravityspy.utils.cache.ASDCache` used to
+                    reuse the ASDs for whitening, give one with a
+                    directory to share ASDs between the processes,
+                    this changes the q scans slightly (see
+                    `utils.make_q_scans`), default: `None`, every ASD
+                    is estimated from all of the data
+
+                strain_cache : `gravityspy.utils.cache.StrainCache` to
+                    read the strain data through, so that reprocessing
+                    the same events does not read the frames again,
+                    default: `None`
+
+                save_images : if `False` the q scans are labelled straight
+                    from their pixels (see `utils.rasterize_q_scans`) and no
+                    images are saved, the FilenameN columns then name the
+                    images that would have been saved, default: `True`
+
         Returns:
             `Events` table
         """
@@ -115,36 +139,97 @@ class Events(GravitySpyTable):
         channel_name = kwargs.pop('channel_name', None)
         frametype = kwargs.pop('frametype', None)
         verbose = kwargs.pop('verbose', False)
+        coalesce = kwargs.pop('coalesce', False)
+        max_block_time = kwargs.pop('max_block_time', 1024)
+        asd_cache = kwargs.pop('asd_cache', None)
+        strain_cache = kwargs.pop('strain_cache', None)
+        save_images = kwargs.pop('save_images', True)
         # calculate maximum number of processes
         nproc = kwargs.pop('nproc', 1)
 
-        # make a list of event times
-        inputs = zip(self['event_time'], self['ifo'],
-                     self['gravityspy_id'])
-
-        inputs = ((etime, ifo, gid, config, plot_directory,
-                   timeseries, source, channel_name, frametype, nproc, verbose)
-                  for etime, ifo, gid in inputs)
-
-        # make q_scans
-        output = mp_utils.multiprocess_with_queues(nproc,
-                                                   _make_single_qscan,
-                                                   inputs)
-
-        qvalues = []
-        # raise exceptions (from multiprocessing, single process raises inline)
-        for f, x in output:
-            if isinstance(x, Exception):
-                x.args = ('Failed to make q scan at time %s: %s' % (f,
-                                                                    str(x)),)
-                raise x
+        # share the timeseries with the worker processes instead of
+        # pickling it into the inputs of every event
+        shared_timeseries = None
+        if (timeseries is not None) and (nproc > 1):
+            shared_timeseries = SharedTimeSeries(timeseries)
+            timeseries = shared_timeseries
+
+        try:
+            if coalesce:
+                # group the events into blocks of overlapping data
+                blocks = utils.plan_blocks(self['event_time'], config=config,
+                                           max_block_time=max_block_time)
+
+                inputs = [(block, [(self['event_time'][idx], self['ifo'][idx],
+                                    self['gravityspy_id'][idx], idx)
+                                   for idx in indices],
+                           config, plot_directory, timeseries, source,
+                           channel_name, frametype, asd_cache, strain_cache,
+                           save_images, nproc, verbose)
+                          for block, indices in blocks]
+
+                # make q_scans
+                output = mp_utils.multiprocess_with_queues(nproc,
+                                                           _make_block_qscans,
+                                                           inputs)
+
+                qvalues = numpy.zeros(len(self))
+                images = []
+                # raise exceptions (from multiprocessing, single process raises inline)
+                for f, x in output:
+                    if isinstance(x, Exception):
+                        x.args = ('Failed to make q scans for block %s: %s' % (f,
+                                                                              str(x)),)
+                        raise x
+                    else:
+                        for idx, q_value, image_data in x:
+                            qvalues[idx] = q_value
+                            images.append(image_data)
+
+                self['q_value'] = qvalues
             else:
-                qvalues.append(x)
-
-        self['q_value'] = qvalues
+                # make a list of event times
+                inputs = zip(self['event_time'], self['ifo'],
+                             self['gravityspy_id'])
+
+                inputs = ((etime, ifo, gid, config, plot_directory,
+                           timeseries, source, channel_name, frametype, asd_cache,
+                           strain_cache, save_images, nproc, verbose)
+                          for etime, ifo, gid in inputs)
+
+                # make q_scans
+                output = mp_utils.multiprocess_with_queues(nproc,
+                                                           _make_single_qscan,
+                                                           inputs)
+
+                qvalues = []
+                images = []
+                # raise exceptions (from multiprocessing, single process raises inline)
+                for f, x in output:
+                    if isinstance(x, Exception):
+                        x.args = ('Failed to make q scan at time %s: %s' % (f,
+                                                                            str(x)),)
+                        raise x
+                    else:
+                        qvalues.append(x[0])
+                        images.append(x[1])
+
+                self['q_value'] = qvalues
+        finally:
+            if shared_timeseries is not None:
+                shared_timeseries.close()
+
+        if save_images:
+            image_data = None
+        else:
+            # the pixels of every event go to the classifier as one array
+            image_data = (numpy.concatenate([pixels for pixels, _ in images]),
+                          [sample for _, names in images for sample in names])
 
         results = utils.label_q_scans(plot_directory=plot_directory,
                                       path_to_cnn=path_to_cnn,
+                                      image_data=image_data,
+                                      image_format=config.image_format,
                                       verbose=verbose,
                                       **kwargs)
 
@@ -189,21 +274,16 @@ class Events(GravitySpyTable):
 
         Parameters:
             table (str): name of SQL table
+            config (`utils.GravitySpyConfigFile`, optional):
+                the `image_format` the images were saved with
         """
         from sqlalchemy.engine import create_engine
+        config = kwargs.pop('config', utils.GravitySpyConfigFile())
+        extension = image_extension(config.image_format)
 
         tab = self.to_pandas()
-        def makelink(x):
-            # This horrendous thing obtains the public html path for image
-            intermediate_path = '/'.join(filter(None,str(x.Filename1).split('/'))[3:-1])
-            if x.ifo == 'L1':
-                return 'https://ldas-jobs.ligo-la.caltech.edu/~gravityspy/{0}/{1}.png'.format(intermediate_path,x.gravityspy_id)
-            elif x.ifo == 'V1':
-                return 'https://ldas-jobs.ligo.caltech.edu/~gravityspy/{0}/{1}.png'.format(intermediate_path, x.gravityspy_id)
-            else:
-                return 'https://ldas-jobs.ligo-wa.caltech.edu/~gravityspy/{0}/{1}.png'.format(intermediate_path, x.gravityspy_id)
-
-        tab['imgUrl'] = tab[['ifo', 'gravityspy_id', 'Filename1']].apply(makelink, axis=1)
+        tab['imgUrl'] = tab[['ifo', 'gravityspy_id', 'Filename1']].apply(
+            _image_url, axis=1, args=(extension,))
         tab['pipeline'] = 'GravitySpy'
         tab['flag'] = 0
         # Get the right columns for glitch db from all the available colums
@@ -336,10 +416,10 @@ class Events(GravitySpyTable):
                 subject.save()
                 subjects.append(subject)
                 self['links_subjects'][self['gravityspy_id'] == gid] = int(subject.id)
-                self['url1'][self['gravityspy_id'] == gid] = subject.raw['locations'][0]['image/png'].split('?')[0]
-                self['url2'][self['gravityspy_id'] == gid] = subject.raw['locations'][1]['image/png'].split('?')[0]
-                self['url3'][self['gravityspy_id'] == gid] = subject.raw['locations'][2]['image/png'].split('?')[0]
-                self['url4'][self['gravityspy_id'] == gid] = subject.raw['locations'][3]['image/png'].split('?')[0]
+                self['url1'][self['gravityspy_id'] == gid] = _location_url(subject.raw['locations'][0])
+                self['url2'][self['gravityspy_id'] == gid] = _location_url(subject.raw['locations'][1])
+                self['url3'][self['gravityspy_id'] == gid] = _location_url(subject.raw['locations'][2])
+                self['url4'][self['gravityspy_id'] == gid] = _location_url(subject.raw['locations'][3])
                 self['upload_flag'][self['gravityspy_id'] == gid] = 1
             subjectset.add(subjects)
 
@@ -351,6 +431,17 @@ class Events(GravitySpyTable):
         Parameters:
             path_to_cnn (str): filename of model
 
+            **kwargs:
+                pixel_cache : `gravityspy.utils.cache.PixelCache` to read
+                    the pixels of the images through, so that scoring the
+                    same images with another model does not decode them
+                    again, default: `None`
+
+                batch_size : the number of events scored at once,
+                    default: 64
+
+                see `utils.label_select_images`
+
         Returns:
             `Events` table with columns containing new scores
         """
@@ -375,6 +466,12 @@ class Events(GravitySpyTable):
         Parameters:
             path_to_semantic_model (str): filename of model
 
+            **kwargs:
+                pixel_cache : `gravityspy.utils.cache.PixelCache` to read
+                    the pixels of the images through, default: `None`
+
+                see `utils.get_features_select_images`
+
         Returns:
             `Events` table with columns containing new scores
         """
@@ -391,6 +488,47 @@ class Events(GravitySpyTable):
 
         return Events(results)
 
+    def update_scores_and_features(self, path_to_cnn, path_to_semantic_model,
+                                   nproc=1, **kwargs):
+        """Obtain new scores and features, reading every image once
+
+        Parameters:
+            path_to_cnn (str): filename of model
+
+            path_to_semantic_model (str): filename of similarity model
+
+            **kwargs:
+                see `update_scores` and `update_features`
+
+        Returns:
+            `Events` table with columns containing new scores and
+            `Events` table with columns containing new features
+        """
+        if not all(elem in self.keys() for elem in ['Filename1', 'Filename2',
+                                                    'Filename3', 'Filename4']):
+            raise ValueError("This method only works if the file paths "
+                             "of the images of the images are known.")
+
+        image_data, image_data_rgb = utils.read_select_images(
+            filename1=self['Filename1'], filename2=self['Filename2'],
+            filename3=self['Filename3'], filename4=self['Filename4'],
+            color='both', **kwargs)
+
+        scores = utils.label_select_images(filename1=self['Filename1'],
+                                           filename2=self['Filename2'],
+                                           filename3=self['Filename3'],
+                                           filename4=self['Filename4'],
+                                           path_to_cnn=path_to_cnn,
+                                           image_data=image_data, **kwargs)
+
+        features = utils.get_features_select_images(
+            filename1=self['Filename1'], filename2=self['Filename2'],
+            filename3=self['Filename3'], filename4=self['Filename4'],
+            path_to_semantic_model=path_to_semantic_model,
+            image_data=image_data_rgb, **kwargs)
+
+        return Events(scores), Events(features)
+
     def determine_workflow_and_subjectset(self, project_info_pickle):
         """Obtain omicron triggers to run gravityspy on
 
@@ -663,7 +801,7 @@ class Events(GravitySpyTable):
             Parameters:
                 path_to_cnn (`str`): path to file with weights of trained model
 
-                **kwargs: anything you can pass to keras.model.predict_proba
+                **kwargs: anything you can pass to keras.model.predict
         """
         # first convert to pandas
         import io
@@ -671,9 +809,9 @@ class Events(GravitySpyTable):
             return numpy.load(io.BytesIO(byte_image_data))['x']
 
         # determine class names
-        f = h5py.File(path_to_cnn, 'r')
-        classes = kwargs.pop('classes',
-                             numpy.array(f['/labels/labels']).astype(str).T[0])
+        classes = kwargs.pop('classes', None)
+        if classes is None:
+            classes = MODEL_REGISTRY.get_classes(path_to_cnn)
 
         df = self.to_pandas()
 
@@ -682,17 +820,33 @@ class Events(GravitySpyTable):
 
         image_data = numpy.vstack(df['image_panel'].apply(byte_to_numpy).values)
 
-        final_model = load_model(path_to_cnn)
-
-        final_model.compile(loss='categorical_crossentropy',
-                           optimizer='adadelta',
-                           metrics=['accuracy'])
-        confidence_array = final_model.predict_proba(image_data, **kwargs)
+        final_model = MODEL_REGISTRY.get_model(path_to_cnn)
+        confidence_array = final_model.predict(image_data, **kwargs)
 
         self['ml_label']  = numpy.array(classes)[confidence_array.argmax(1)]
         self['ml_confidence'] = confidence_array.max(1)
 
 
+def _location_url(location):
+    # a location maps the mime type of an image, which depends on its
+    # format, to its url
+    url, = location.values()
+    return url.split('?')[0]
+
+def _image_url(x, extension):
+    # This horrendous thing obtains the public html path for the image
+    # of all q scans, which is saved next to the first one
+    intermediate_path = '/'.join(
+        list(filter(None, str(x.Filename1).split('/')))[3:-1])
+    if x.ifo == 'L1':
+        host = 'ldas-jobs.ligo-la.caltech.edu'
+    elif x.ifo == 'V1':
+        host = 'ldas-jobs.ligo.caltech.edu'
+    else:
+        host = 'ldas-jobs.ligo-wa.caltech.edu'
+    return 'https://{0}/~gravityspy/{1}/{2}{3}'.format(
+        host, intermediate_path, x.gravityspy_id, extension)
+
 def id_generator(x, size=10,
                  chars=(string.ascii_uppercase +
                         string.digits +
@@ -729,6 +883,19 @@ def get_connection_str(db='gravityspy',
     return '{0}://{1}:{2}@{3}:{4}/{5}'.format(server, user, passwd,
                                               host, port, db)
 
+#: Reuses the figures of the previous event plotted in each process
+RENDERER = QTransformRenderer()
+
+#: Encodes and writes the images of each process in the background,
+#: by compression level and image format
+WRITERS = {}
+
+def _png_writer(config):
+    key = (config.png_compress_level, config.image_format)
+    if key not in WRITERS:
+        WRITERS[key] = PNGWriter(compress_level=key[0], image_format=key[1])
+    return WRITERS[key]
+
 # define multiprocessing method
 def _make_single_qscan(inputs):
     event_time = inputs[0]
@@ -740,8 +907,14 @@ def _make_single_qscan(inputs):
     source = inputs[6]
     channel_name = inputs[7]
     frametype = inputs[8]
-    nproc = inputs[9]
-    verbose = inputs[10]
+    asd_cache = inputs[9]
+    strain_cache = inputs[10]
+    save_images = inputs[11]
+    nproc = inputs[12]
+    verbose = inputs[13]
+
+    if isinstance(timeseries, SharedTimeSeries):
+        timeseries = timeseries.attach()
 
     # Parse Ini File
     plot_time_ranges = config.plot_time_ranges
@@ -751,25 +924,114 @@ def _make_single_qscan(inputs):
             specsgrams, q_value = utils.make_q_scans(event_time=event_time,
                                                      config=config,
                                                      timeseries=timeseries,
+                                                     asd_cache=asd_cache,
                                                      verbose=verbose)
-        if source is not None:
+        elif source is not None:
+            # the strain cache keys the data by channel
             specsgrams, q_value = utils.make_q_scans(event_time=event_time,
                                                      config=config,
                                                      source=source,
+                                                     channel_name=channel_name,
+                                                     asd_cache=asd_cache,
+                                                     strain_cache=strain_cache,
                                                      verbose=verbose)
-        if channel_name is not None:
+        elif channel_name is not None:
             specsgrams, q_value = utils.make_q_scans(event_time=event_time,
                                                      config=config,
                                                      channel_name=channel_name,
                                                      frametype=frametype,
+                                                     asd_cache=asd_cache,
+                                                     strain_cache=strain_cache,
                                                      verbose=verbose)
-        utils.save_q_scans(plot_directory, specsgrams,
-                           plot_normalized_energy_range, plot_time_ranges,
-                           ifo, event_time, id_string=gid, verbose=verbose)
+        if save_images:
+            writer = _png_writer(config)
+            utils.save_q_scans(plot_directory, specsgrams,
+                               plot_normalized_energy_range, plot_time_ranges,
+                               ifo, event_time, id_string=gid,
+                               renderer=RENDERER, writer=writer,
+                               super_image=config.super_image,
+                               thumbnail_scale=config.thumbnail_scale,
+                               verbose=verbose)
+            # the images are labelled as soon as this returns
+            writer.flush()
+            image_data = None
+        else:
+            image_data = utils.rasterize_q_scans(specsgrams,
+                                                 plot_normalized_energy_range,
+                                                 plot_time_ranges,
+                                                 ifo, event_time, id_string=gid,
+                                                 image_format=config.image_format)
 
-        return event_time, q_value
+        return event_time, (q_value, image_data)
     except Exception as exc:  # pylint: disable=broad-except
         if nproc == 1:
             raise
         else:
             return event_time, exc
+
+def _make_block_qscans(inputs):
+    block = inputs[0]
+    events = inputs[1]
+    config = inputs[2]
+    plot_directory = inputs[3]
+    timeseries = inputs[4]
+    source = inputs[5]
+    channel_name = inputs[6]
+    frametype = inputs[7]
+    asd_cache = inputs[8]
+    strain_cache = inputs[9]
+    save_images = inputs[10]
+    nproc = inputs[11]
+    verbose = inputs[12]
+
+    if isinstance(timeseries, SharedTimeSeries):
+        timeseries = timeseries.attach()
+
+    # Parse Ini File
+    plot_time_ranges = config.plot_time_ranges
+    plot_normalized_energy_range = config.plot_normalized_energy_range
+    try:
+        # read, resample and whiten the whole block only once
+        data = utils.fetch_data(block[0], block[1], config=config,
+                                timeseries=timeseries, source=source,
+                                channel_name=channel_name,
+                                frametype=frametype,
+                                strain_cache=strain_cache, verbose=verbose)
+        data = utils.whiten_data(data, asd_cache=asd_cache,
+                                 channel_name=channel_name,
+                                 origin=source or frametype)
+
+        writer = _png_writer(config)
+        qvalues = []
+        for event_time, ifo, gid, idx in events:
+            specsgrams, q_value = utils.make_q_scans(event_time=event_time,
+                                                     config=config,
+                                                     timeseries=data,
+                                                     whiten=False,
+                                                     verbose=verbose)
+            if save_images:
+                utils.save_q_scans(plot_directory, specsgrams,
+                                   plot_normalized_energy_range,
+                                   plot_time_ranges, ifo, event_time,
+                                   id_string=gid, renderer=RENDERER,
+                                   writer=writer,
+                                   super_image=config.super_image,
+                                   thumbnail_scale=config.thumbnail_scale,
+                                   verbose=verbose)
+                image_data = None
+            else:
+                image_data = utils.rasterize_q_scans(
+                    specsgrams, plot_normalized_energy_range,
+                    plot_time_ranges, ifo, event_time, id_string=gid,
+                    image_format=config.image_format)
+            qvalues.append((idx, q_value, image_data))
+
+        # the images of the block are encoded while the next event is
+        # transformed, but must all be written once this returns
+        writer.flush()
+        return block, qvalues
+    except Exception as exc:  # pylint: disable=broad-except
+        if nproc == 1:
+            raise
+        else:
+            return block, exc
@@ -0,0 +1,158 @@
+"""Unit test for GravitySpy
+"""
+
+__author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
+
+from gravityspy.utils.cache import (ASDCache, StrainCache, PixelCache)
+import gravityspy.ml.read_image as read_image
+from gwpy.timeseries import TimeSeries
+
+import numpy
+import os
+import shutil
+
+numpy.random.seed(1986)
+TIMESERIES = TimeSeries(numpy.random.normal(size=4096 * 16),
+                        sample_rate=4096, t0=1127700000,
+                        name='L1:GDS-CALIB_STRAIN')
+TEST_IMAGES_PATH = os.path.join(os.path.split(__file__)[0], 'data',
+                                'images')
+TEST_IMAGES = ['L1_123abc1234_spectrogram_{0}.png'.format(dur)
+               for dur in ['0.5', '1.0', '2.0', '4.0']]
+
+
+class TestGravitySpyCache(object):
+    """`TestCase` for the GravitySpy caches
+    """
+    def test_asd_cache(self, tmpdir):
+        asd_cache = ASDCache(maxsize=1, directory=str(tmpdir))
+
+        asd = asd_cache.asd(TIMESERIES, 2, 1)
+        numpy.testing.assert_array_equal(asd.value,
+                                         TIMESERIES.asd(2, 1).value)
+        assert asd_cache.asd(TIMESERIES, 2, 1) is asd
+
+        # only one ASD is kept in memory
+        asd_cache.asd(TIMESERIES.crop(1127700000, 1127700008), 2, 1)
+        assert len(asd_cache) == 1
+
+        # but both are on disk
+        asd_cache.clear()
+        cached = asd_cache.asd(TIMESERIES, 2, 1)
+        numpy.testing.assert_array_equal(cached.value, asd.value)
+        assert cached.df == asd.df
+
+    def test_asd_cache_chunks(self):
+        asd_cache = ASDCache(chunk_time=4)
+
+        # both spans are nearest the chunk starting 8 seconds in
+        asd = asd_cache.asd(TIMESERIES.crop(1127700001, 1127700016), 2, 1)
+        numpy.testing.assert_array_equal(
+            asd.value, TIMESERIES.crop(1127700008, 1127700012).asd(2, 1).value)
+        assert asd_cache.asd(TIMESERIES.crop(1127700003, 1127700016),
+                             2, 1) is asd
+
+        # no chunk fits in this span, so the ASD is its own
+        asd_cache.asd(TIMESERIES.crop(1127700001, 1127700006), 2, 1)
+        assert len(asd_cache) == 2
+
+        # the same channel from another frametype has its own ASD
+        other = asd_cache.asd(TIMESERIES.crop(1127700001, 1127700016) * 2,
+                              2, 1, origin='L1_HOFT_C01')
+        assert len(asd_cache) == 3
+        numpy.testing.assert_allclose(other.value, 2 * asd.value)
+
+    def test_strain_cache(self, tmpdir):
+        strain_cache = StrainCache(str(tmpdir), chunk_time=4, pad=1)
+        fetched = []
+
+        def fetch(start_time, stop_time):
+            fetched.append((start_time, stop_time))
+            return TIMESERIES.crop(start_time, stop_time)
+
+        data = strain_cache.get('L1:GDS-CALIB_STRAIN', 1127700005,
+                                1127700009, 4096, fetch)
+        numpy.testing.assert_array_equal(
+            data.value, TIMESERIES.crop(1127700005, 1127700009).value)
+        assert data.t0.value == 1127700005
+        assert len(fetched) == 2
+
+        # the second read does not fetch anything
+        data = strain_cache.get('L1:GDS-CALIB_STRAIN', 1127700006,
+                                1127700010, 4096, fetch)
+        numpy.testing.assert_array_equal(
+            data.value, TIMESERIES.crop(1127700006, 1127700010).value)
+        assert len(fetched) == 2
+
+        # nor are chunks of another frametype of the same channel
+        def fetch_c01(start_time, stop_time):
+            fetched.append((start_time, stop_time))
+            return TIMESERIES.crop(start_time, stop_time) * 2
+
+        data = strain_cache.get('L1:GDS-CALIB_STRAIN', 1127700006,
+                                1127700010, 4096, fetch_c01,
+                                origin='L1_HOFT_C01')
+        assert len(fetched) == 4
+        numpy.testing.assert_array_equal(
+            data.value, 2 * TIMESERIES.crop(1127700006, 1127700010).value)
+        data = strain_cache.get('L1:GDS-CALIB_STRAIN', 1127700006,
+                                1127700010, 4096, fetch,
+                                origin='L1_HOFT_C00')
+        assert len(fetched) == 6
+        numpy.testing.assert_array_equal(
+            data.value, TIMESERIES.crop(1127700006, 1127700010).value)
+
+        # a span beyond the end of the data is fetched directly
+        data = strain_cache.get('L1:GDS-CALIB_STRAIN', 1127700014,
+                                1127700018, 4096, fetch)
+        assert data.span == (1127700014, 1127700016)
+        assert fetched[-1] == (1127700014, 1127700018)
+
+        # only the most recently used chunk is kept
+        strain_cache.maxbytes = 4 * 4096 * 8 + 128
+        strain_cache.evict()
+        assert strain_cache.size() <= strain_cache.maxbytes
+
+    def test_pixel_cache(self, tmpdir):
+        images = [os.path.join(str(tmpdir), image) for image in TEST_IMAGES]
+        for image in TEST_IMAGES:
+            shutil.copy(os.path.join(TEST_IMAGES_PATH, image), str(tmpdir))
+        directory = os.path.join(str(tmpdir), 'pixels')
+        pixel_cache = PixelCache(directory)
+
+        image_data, ids = pixel_cache.read_batch([images], nthreads=2)
+        expected, _ = read_image.read_batch([images])
+        numpy.testing.assert_array_equal(image_data, expected)
+        assert ids == ['123abc1234']
+        assert len(pixel_cache) == 4
+
+        # other processes read the same shard, without decoding
+        pixel_cache = PixelCache(directory)
+        assert len(pixel_cache) == 4
+        image_data, _ = pixel_cache.read_batch([images[:2], images[2:]])
+        numpy.testing.assert_array_equal(image_data,
+                                         expected.reshape(2, 2, 140, 170))
+        assert len(os.listdir(directory)) == 2
+
+        # only the rgb pixels are decoded
+        (image_data, image_data_rgb), _ = pixel_cache.read_batch(
+            [images], color='both')
+        numpy.testing.assert_array_equal(image_data, expected)
+        numpy.testing.assert_array_equal(
+            image_data_rgb, read_image.read_batch([images], color='rgb')[0])
+        assert len(pixel_cache) == 8
+
+        # a rewritten image is decoded again
+        shutil.copy(images[0], images[1])
+        image_data, _ = pixel_cache.read_batch([images])
+        numpy.testing.assert_array_equal(image_data[0, 1], expected[0, 0])
+        assert len(pixel_cache) == 9
+
+        # the least recently used shards are deleted once over maxbytes
+        pixel_cache.maxbytes = pixel_cache.size() - 1
+        pixel_cache.evict()
+        assert pixel_cache.size() <= pixel_cache.maxbytes
+        assert len(pixel_cache) < 9
+        image_data, _ = pixel_cache.read_batch([images])
+        numpy.testing.assert_array_equal(image_data[0, 1], expected[0, 0])
+        numpy.testing.assert_array_equal(image_data[0, 2:], expected[0, 2:])
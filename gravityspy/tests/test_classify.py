@@ -2,11 +2,18 @@ from gwpy.timeseries import TimeSeries
 from gwpy.table import EventTable
 
 from gravityspy.classify import classify
+from gravityspy.utils import (utils, qtransform)
+from gwpy.segments import Segment
+from skimage import io
+import numpy
 import os
 import pandas
 
 MODEL_NAME_CNN = os.path.join(os.path.split(__file__)[0], '..', '..', 'models',
                               'O3-multiview-classifer.h5')
+MODEL_NAME_FEATURE_MULTIVIEW = os.path.join(os.path.split(__file__)[0], '..',
+                                            '..', 'models',
+                                            'similarity-model-O3.h5')
 
 SCRATCHY_TIMESERIES_PATH = os.path.join(os.path.split(__file__)[0], 'data',
                                         'timeseries',
@@ -35,3 +42,133 @@ class TestUtils(object):
                                           RESULTS_TABLE.to_pandas(),
                                           check_dtype=False,
                                           check_less_precise=True)
+
+    def test_interpolate(self):
+
+        config = utils.GravitySpyConfigFile()
+        center_time, data_segment = utils.event_segment(EVENT_TIME,
+                                                        config=config)
+        data = utils.whiten_data(SCRATCHY_TIMESERIES.crop(*data_segment))
+        search = Segment(center_time - 0.25, center_time + 0.25)
+        qgram, _ = qtransform.q_scan(data, qrange=config.search_q_range,
+                                     frange=config.search_frequency_range,
+                                     search=search)
+
+        # evaluating the frequencies in blocks gives the same spectrogram
+        for output_grid in ['linear', 'log']:
+            config = utils.GravitySpyConfigFile(output_grid=output_grid)
+            grid = utils.output_grid(4.0, config=config)
+            outseg = Segment(center_time - 2, center_time + 2)
+            expected = qgram.interpolate(outseg=outseg, **grid)
+            spec = qtransform.interpolate(qgram, outseg=outseg, **grid)
+            assert spec.dtype == expected.dtype
+            assert spec.q == expected.q
+            numpy.testing.assert_array_equal(spec.value, expected.value)
+            numpy.testing.assert_array_equal(spec.yindex.value,
+                                             expected.yindex.value)
+
+    def test_classify_without_images(self, tmpdir):
+
+        results = classify(event_time=EVENT_TIME,
+                           channel_name='L1:GDS-CALIB_STRAIN',
+                           path_to_cnn=MODEL_NAME_CNN,
+                           timeseries=SCRATCHY_TIMESERIES,
+                           plot_directory=str(tmpdir),
+                           save_images=False)
+
+        assert not os.listdir(str(tmpdir))
+        results.convert_unicode_to_bytestring()
+        assert list(results['ml_label']) == list(RESULTS_TABLE['ml_label'])
+        numpy.testing.assert_allclose(results['ml_confidence'],
+                                      RESULTS_TABLE['ml_confidence'],
+                                      atol=1e-3)
+
+    def test_classify_with_features(self, tmpdir):
+
+        results = classify(event_time=EVENT_TIME,
+                           channel_name='L1:GDS-CALIB_STRAIN',
+                           path_to_cnn=MODEL_NAME_CNN,
+                           timeseries=SCRATCHY_TIMESERIES,
+                           plot_directory=str(tmpdir),
+                           path_to_semantic_model=MODEL_NAME_FEATURE_MULTIVIEW)
+
+        # the features are columns of the one table returned
+        results.convert_unicode_to_bytestring()
+        assert list(results['ml_label']) == list(RESULTS_TABLE['ml_label'])
+        assert len([name for name in results.colnames if name.isdigit()]) > 0
+
+    def test_super_image(self, tmpdir):
+
+        config = utils.GravitySpyConfigFile()
+        specsgrams, _ = utils.make_q_scans(EVENT_TIME, config=config,
+                                           timeseries=SCRATCHY_TIMESERIES)
+        for super_image, directory in [('stitch', 'stitch'), (None, 'lazy'),
+                                       ('plot', 'plot')]:
+            utils.save_q_scans(str(tmpdir.join(directory)), specsgrams,
+                               config.plot_normalized_energy_range,
+                               config.plot_time_ranges, 'L1', EVENT_TIME,
+                               id_string='event', super_image=super_image)
+        assert not os.path.isfile(str(tmpdir.join('lazy', 'event.png')))
+
+        # the stitched image is the size of the plotted one
+        assert (io.imread(str(tmpdir.join('stitch', 'event.png'))).shape ==
+                io.imread(str(tmpdir.join('plot', 'event.png'))).shape)
+
+        # made on request from the saved panels, the same as stitched
+        filename = utils.make_super_image(str(tmpdir.join('lazy')),
+                                          config.plot_time_ranges,
+                                          'L1', 'event')
+        numpy.testing.assert_array_equal(
+            io.imread(filename),
+            io.imread(str(tmpdir.join('stitch', 'event.png'))))
+
+    def test_log_output_grid(self):
+
+        config = utils.GravitySpyConfigFile(output_grid='log')
+        specsgrams, _ = utils.make_q_scans(event_time=EVENT_TIME,
+                                           timeseries=SCRATCHY_TIMESERIES,
+                                           config=config)
+
+        for spec in specsgrams:
+            assert spec.shape == (640, 480)
+            numpy.testing.assert_allclose(
+                numpy.diff(numpy.log(spec.yindex.value)),
+                numpy.log(spec.yindex.value[1] / spec.yindex.value[0]))
+
+    def test_plan_blocks(self):
+
+        blocks = utils.plan_blocks([100.1, 1000.0, 101.3, 160.0, 230.5])
+
+        assert [list(block) for block, _ in blocks] == [[68, 192],
+                                                        [198, 262],
+                                                        [968, 1032]]
+        assert [indices for _, indices in blocks] == [[0, 2, 3], [4], [1]]
+
+        blocks = utils.plan_blocks([100.1, 101.3, 160.0], max_block_time=100)
+
+        assert [indices for _, indices in blocks] == [[0, 1], [2]]
+
+    def test_native_qtransform(self):
+
+        specsgrams, q_value = utils.make_q_scans(
+            event_time=EVENT_TIME, timeseries=SCRATCHY_TIMESERIES)
+
+        config = utils.GravitySpyConfigFile(qtransform_engine='native')
+        native_specsgrams, native_q_value = utils.make_q_scans(
+            event_time=EVENT_TIME, timeseries=SCRATCHY_TIMESERIES,
+            config=config)
+
+        assert native_q_value == q_value
+        for spec, native_spec in zip(specsgrams, native_specsgrams):
+            numpy.testing.assert_allclose(native_spec.value, spec.value,
+                                          rtol=1e-5, atol=1e-5)
+
+        # threads do not change the result
+        threaded_specsgrams, threaded_q_value = utils.make_q_scans(
+            event_time=EVENT_TIME, timeseries=SCRATCHY_TIMESERIES,
+            config=config, nthreads=4)
+
+        assert threaded_q_value == native_q_value
+        for spec, threaded_spec in zip(native_specsgrams,
+                                       threaded_specsgrams):
+            numpy.testing.assert_array_equal(threaded_spec.value, spec.value)
@@ -6,11 +6,20 @@ __author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
 import os
 
 import gravityspy.ml.read_image as read_image
+from gravityspy.ml.registry import MODEL_REGISTRY
 import gravityspy.ml.labelling_test_glitches as label_glitches
+from gravityspy.ml.GS_utils import assemble_views
+from gravityspy.ml.numpy_model import export_model
+from gravityspy.utils import utils
+from gravityspy.utils.inference import (InferenceServer, InferenceClient,
+                                        InferenceUnavailable, parse_endpoint)
 import gravityspy.ml.train_classifier as train_classifier
 
 import pandas as pd
 import numpy
+import pytest
+import socket
+import threading
 
 TEST_IMAGES_PATH = os.path.join(os.path.split(__file__)[0], 'data',
 'images')
@@ -72,6 +81,11 @@ class TestGravitySpyML(object):
         confidence = float(scores[0][MLlabel])
         assert confidence == SCORE
 
+        scores, MLlabel, deeplayer, _, _, _, _, _ = \
+            label_glitches.get_deeplayer(image_dataDF, MODEL_NAME_CNN)
+        numpy.testing.assert_allclose(scores[0][MLlabel], SCORE, rtol=1e-5)
+        assert deeplayer.shape[0] == 1
+
 
     def test_multiview_rgb(self):
 
@@ -98,3 +112,199 @@ class TestGravitySpyML(object):
 
         numpy.testing.assert_array_almost_equal(features, MULTIVIEW_FEATURES,
                                                 decimal=3)
+
+    def test_read_batch(self):
+
+        list_of_images = [os.path.join(TEST_IMAGES_PATH,
+                                       'L1_123abc1234_spectrogram_'
+                                       '{0}.png'.format(dur))
+                          for dur in ['0.5', '1.0', '2.0', '4.0']]
+
+        image_data, ids = read_image.read_batch([list_of_images],
+                                                resolution=0.3, nthreads=2)
+        assert image_data.shape == (1, 4, 140, 170)
+        assert image_data.dtype == numpy.float32
+        assert ids == ['123abc1234']
+        for idx, image in enumerate(list_of_images):
+            numpy.testing.assert_allclose(
+                image_data[0, idx].ravel(),
+                read_image.read_grayscale(image, resolution=0.3),
+                rtol=0, atol=1e-6)
+
+        image_data, _ = read_image.read_batch([list_of_images], color='rgb')
+        assert image_data.shape == (1, 4, 140, 170, 3)
+
+        # one decode gives both
+        (image_data_gray, image_data_rgb), _ = read_image.read_batch(
+            [list_of_images], color='both')
+        numpy.testing.assert_array_equal(image_data_rgb, image_data)
+        numpy.testing.assert_array_equal(
+            image_data_gray, read_image.read_batch([list_of_images])[0])
+        for idx, image in enumerate(list_of_images):
+            image_data_r, image_data_g, image_data_b = read_image.read_rgb(
+                image, resolution=0.3)
+            numpy.testing.assert_allclose(
+                image_data[0, idx, :, :, 0].ravel(), image_data_r,
+                rtol=0, atol=255e-6)
+            numpy.testing.assert_allclose(
+                image_data[0, idx, :, :, 2].ravel(), image_data_b,
+                rtol=0, atol=255e-6)
+
+    def test_resample(self):
+
+        image_data = numpy.random.RandomState(0).rand(466, 566)
+        numpy.testing.assert_allclose(
+            read_image.resample(image_data, resolution=0.3),
+            read_image.rescale(image_data, 0.3, mode='constant',
+                               preserve_range=True, multichannel=False),
+            rtol=0, atol=1e-6)
+
+    def test_read_q_scans(self):
+
+        (image_data, image_data_rgb), names = utils.read_q_scans(
+            TEST_IMAGES_PATH, color='both')
+        assert names == [['L1_123abc1234_spectrogram_{0}.png'.format(dur)
+                          for dur in ['0.5', '1.0', '2.0', '4.0']]]
+        assert image_data.shape == (1, 4, 140, 170)
+        assert image_data_rgb.shape == (1, 4, 140, 170, 3)
+        numpy.testing.assert_allclose(
+            image_data[0, 0].ravel(),
+            read_image.read_grayscale(os.path.join(TEST_IMAGES_PATH,
+                                                   names[0][0])),
+            rtol=0, atol=1e-6)
+
+    def test_model_registry(self):
+
+        model = MODEL_REGISTRY.get_model(MODEL_NAME_CNN)
+        assert MODEL_REGISTRY.get_model(MODEL_NAME_CNN) is model
+        predict = MODEL_REGISTRY.get_predictor(MODEL_NAME_CNN)
+        assert MODEL_REGISTRY.get_predictor(MODEL_NAME_CNN) is predict
+        classes = MODEL_REGISTRY.get_classes(MODEL_NAME_CNN)
+        assert len(classes) == model.output_shape[-1]
+
+    def test_predict_batch(self):
+
+        list_of_images = [os.path.join(TEST_IMAGES_PATH,
+                                       'L1_123abc1234_spectrogram_'
+                                       '{0}.png'.format(dur))
+                          for dur in ['0.5', '1.0', '2.0', '4.0']]
+        image_data, _ = read_image.read_batch([list_of_images] * 3)
+
+        scores = label_glitches.predict_batch(image_data, MODEL_NAME_CNN,
+                                              batch_size=2)
+        assert scores.shape[0] == 3
+        numpy.testing.assert_allclose(scores.max(1), SCORE, rtol=1e-5)
+
+    def test_assemble_views(self):
+
+        views = numpy.random.RandomState(0).rand(2, 4, 3, 5, 3)
+        out = numpy.zeros((2, 6, 10, 3), dtype=numpy.float32)
+        assert assemble_views(views, out=out) is out
+        left = numpy.concatenate([views[:, 0], views[:, 1]], axis=1)
+        right = numpy.concatenate([views[:, 2], views[:, 3]], axis=1)
+        numpy.testing.assert_allclose(
+            out, numpy.concatenate([left, right], axis=2), rtol=1e-6)
+
+        first = assemble_views(numpy.moveaxis(views, -1, 2),
+                               order_of_channels='channels_first')
+        numpy.testing.assert_array_equal(numpy.moveaxis(first, 1, -1), out)
+
+    def test_inference_server(self, tmpdir):
+
+        list_of_images = [os.path.join(TEST_IMAGES_PATH,
+                                       'L1_123abc1234_spectrogram_'
+                                       '{0}.png'.format(dur))
+                          for dur in ['0.5', '1.0', '2.0', '4.0']]
+        image_data, _ = read_image.read_batch([list_of_images] * 2)
+        endpoint = str(tmpdir.join('inference.sock'))
+
+        # no server, the model is loaded by this process
+        scores = utils.predict_batch(image_data, MODEL_NAME_CNN,
+                                     inference_endpoint=endpoint)
+
+        server = InferenceServer(endpoint, [MODEL_NAME_CNN])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            assert InferenceClient(endpoint).models() == [
+                os.path.abspath(MODEL_NAME_CNN)]
+            numpy.testing.assert_allclose(
+                utils.predict_batch(image_data, MODEL_NAME_CNN,
+                                    inference_endpoint=endpoint),
+                scores, rtol=1e-5)
+            outputs, deeplayer = utils.predict_batch(
+                image_data, MODEL_NAME_CNN, penultimate=True,
+                inference_endpoint=endpoint)
+            numpy.testing.assert_allclose(outputs, scores, rtol=1e-5)
+            assert deeplayer.shape[0] == 2
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_inference_server_limits(self, tmpdir):
+
+        # any client of a TCP endpoint can use the models
+        assert parse_endpoint('8000') == (socket.AF_INET, ('localhost', 8000))
+        assert parse_endpoint('127.0.0.1:8000') == (socket.AF_INET,
+                                                    ('127.0.0.1', 8000))
+        assert parse_endpoint('[::1]:8000') == (socket.AF_INET6,
+                                                ('::1', 8000))
+        for endpoint in ['0.0.0.0:8000', 'example.org:8000']:
+            with pytest.raises(ValueError):
+                parse_endpoint(endpoint)
+
+        list_of_images = [os.path.join(TEST_IMAGES_PATH,
+                                       'L1_123abc1234_spectrogram_'
+                                       '{0}.png'.format(dur))
+                          for dur in ['0.5', '1.0', '2.0', '4.0']]
+        image_data, _ = read_image.read_batch([list_of_images])
+        endpoint = str(tmpdir.join('inference.sock'))
+
+        server = InferenceServer(endpoint, [MODEL_NAME_CNN],
+                                 max_request_bytes=1024)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with pytest.raises(InferenceUnavailable) as excinfo:
+                InferenceClient(endpoint).predict(image_data, MODEL_NAME_CNN)
+            assert '413' in str(excinfo.value)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_label_and_embed_q_scans(self):
+
+        events = utils.label_and_embed_q_scans(
+            TEST_IMAGES_PATH, MODEL_NAME_CNN,
+            path_to_semantic_model=MODEL_NAME_FEATURE_MULTIVIEW)
+        numpy.testing.assert_allclose(events['ml_confidence'], SCORE,
+                                      rtol=1e-5)
+        assert events['deeplayer'].shape[0] == 1
+        features = numpy.array([events[str(idx)] for idx in
+                                range(MULTIVIEW_FEATURES.shape[1])]).T
+        numpy.testing.assert_array_almost_equal(features, MULTIVIEW_FEATURES,
+                                                decimal=3)
+
+    def test_numpy_model(self, tmpdir):
+
+        list_of_images = [os.path.join(TEST_IMAGES_PATH,
+                                       'L1_123abc1234_spectrogram_'
+                                       '{0}.png'.format(dur))
+                          for dur in ['0.5', '1.0', '2.0', '4.0']]
+        image_data, _ = read_image.read_batch([list_of_images] * 2)
+        model_name = str(tmpdir.join('classifier.npz'))
+        export_model(MODEL_NAME_CNN, model_name)
+
+        numpy.testing.assert_array_equal(
+            MODEL_REGISTRY.get_classes(model_name),
+            MODEL_REGISTRY.get_classes(MODEL_NAME_CNN))
+        scores, deeplayer = label_glitches.predict_batch(
+            image_data, model_name, penultimate=True)
+        keras_scores, keras_deeplayer = label_glitches.predict_batch(
+            image_data, MODEL_NAME_CNN, penultimate=True)
+        numpy.testing.assert_allclose(scores, keras_scores, rtol=1e-4,
+                                      atol=1e-6)
+        numpy.testing.assert_allclose(deeplayer, keras_deeplayer, rtol=1e-4,
+                                      atol=1e-4)
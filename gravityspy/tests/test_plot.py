@@ -4,11 +4,19 @@
 __author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
 
 import os
+import io as pyio
+import numpy
 import matplotlib
 matplotlib.use('agg')
-from gravityspy.plot.plot import plot_qtransform
+from gravityspy.plot.plot import (plot_qtransform, QTransformRenderer)
+from gravityspy.plot.raster import rasterize_qtransform
+from gravityspy.plot.stitch import stitch_qtransform
+from gravityspy.plot.writer import (PNGWriter, render_figure, save_image,
+                                    make_thumbnail)
+from skimage import io
 from gwpy.timeseries import TimeSeries
 from gwpy.segments import Segment
+from concurrent.futures import ThreadPoolExecutor
 
 TIMESERIES_PATH = os.path.join(os.path.split(__file__)[0], 'data',
 'timeseries', 'scratchy_timeseries_test.h5')
@@ -61,3 +69,133 @@ class TestGravitySpyPlot(object):
                                                  plot_time_ranges,
                                                  detector_name,
                                                  start_time)
+
+    def test_rasterize(self, tmpdir):
+        # the pixels must match those cropped from the saved plots
+        ind_fig_all, _ = plot_qtransform(specsgrams,
+                                         plot_normalized_energy_range,
+                                         plot_time_ranges,
+                                         detector_name,
+                                         start_time)
+        filename = str(tmpdir.join('spectrogram.png'))
+        for spec, ind_fig in zip(specsgrams, ind_fig_all):
+            ind_fig.savefig(filename, dpi=100)
+            png = io.imread(filename)[66:532, 105:671, :3].astype(int)
+            pixels = rasterize_qtransform(spec, plot_normalized_energy_range)
+            assert pixels.shape == png.shape
+            assert (abs(png - pixels.astype(int)) > 1).mean() < 0.01
+
+    def test_renderer(self, tmpdir):
+        # a second event drawn on the figures of the first one must give
+        # the same images as plotting it from scratch
+        other_specsgrams = [spec * 0.5 for spec in specsgrams]
+        renderer = QTransformRenderer()
+        renderer.plot(specsgrams, plot_normalized_energy_range,
+                      plot_time_ranges, detector_name, start_time)
+        figs = renderer.plot(other_specsgrams, plot_normalized_energy_range,
+                             plot_time_ranges, detector_name, start_time)
+        new_figs = plot_qtransform(other_specsgrams,
+                                   plot_normalized_energy_range,
+                                   plot_time_ranges, detector_name,
+                                   start_time)
+
+        for fig, new_fig in zip(figs[0] + [figs[1]],
+                                new_figs[0] + [new_figs[1]]):
+            fig.savefig(str(tmpdir.join('renderer.png')), dpi=100)
+            new_fig.savefig(str(tmpdir.join('new.png')), dpi=100)
+            numpy.testing.assert_array_equal(
+                io.imread(str(tmpdir.join('renderer.png'))),
+                io.imread(str(tmpdir.join('new.png'))))
+
+    def test_threaded_renderer(self):
+        # events plotted at once by a pool of threads give the same images
+        # as plotted one after the other
+        renderer = QTransformRenderer()
+        events = [[spec * scale for spec in specsgrams]
+                  for scale in (0.5, 2.0)]
+
+        def render(event):
+            ind_fig_all, super_fig = renderer.plot(
+                event, plot_normalized_energy_range, plot_time_ranges,
+                detector_name, start_time)
+            images = []
+            for fig in ind_fig_all + [super_fig]:
+                buf = pyio.BytesIO()
+                fig.savefig(buf, format='png', dpi=100)
+                images.append(buf.getvalue())
+            return images
+
+        with ThreadPoolExecutor(2) as executor:
+            threaded = list(executor.map(render, events))
+        assert threaded == [render(event) for event in events]
+
+    def test_png_writer(self, tmpdir):
+        # the images written in the background are those savefig writes
+        ind_fig_all, super_fig = plot_qtransform(specsgrams,
+                                                 plot_normalized_energy_range,
+                                                 plot_time_ranges,
+                                                 detector_name,
+                                                 start_time)
+        sizes = []
+        for compress_level in (1, 9):
+            with PNGWriter(compress_level=compress_level) as writer:
+                for idx, fig in enumerate(ind_fig_all + [super_fig]):
+                    writer.write(fig, str(tmpdir.join(
+                        'writer_{0}_{1}.png'.format(compress_level, idx))))
+            sizes.append(os.path.getsize(
+                str(tmpdir.join('writer_{0}_0.png'.format(compress_level)))))
+        assert sizes[1] < sizes[0]
+
+        for idx, fig in enumerate(ind_fig_all + [super_fig]):
+            filename = str(tmpdir.join('savefig_{0}.png'.format(idx)))
+            fig.savefig(filename, dpi=100)
+            numpy.testing.assert_array_equal(
+                io.imread(str(tmpdir.join('writer_9_{0}.png'.format(idx)))),
+                io.imread(filename))
+
+        # no temporary files are left behind
+        assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')]
+
+    def test_stitch(self):
+        # the spectrograms of the panels are laid out untouched
+        ind_fig_all, super_fig = plot_qtransform(specsgrams,
+                                                 plot_normalized_energy_range,
+                                                 plot_time_ranges,
+                                                 detector_name,
+                                                 start_time,
+                                                 plot_super_fig=False)
+        assert super_fig is None
+        panels = [render_figure(fig) for fig in ind_fig_all]
+        image_data = stitch_qtransform(panels)
+        # as wide as the combined plot, with 4 columns between panels
+        assert image_data.shape == (600, 2700, 4)
+        for idx, panel in enumerate(panels):
+            left = 100 + idx * (624 + 4)
+            numpy.testing.assert_array_equal(
+                image_data[60:540, left:left + 574], panel[60:540, 100:674])
+
+    def test_image_formats(self, tmpdir):
+        ind_fig_all, _ = plot_qtransform(specsgrams,
+                                         plot_normalized_energy_range,
+                                         plot_time_ranges,
+                                         detector_name,
+                                         start_time,
+                                         plot_super_fig=False)
+        pixels = render_figure(ind_fig_all[0])[:, :, :3]
+
+        sizes = {}
+        for image_format in ['png', 'png-palette', 'webp']:
+            filename = str(tmpdir.join('{0}.image'.format(image_format)))
+            save_image(pixels, filename, image_format=image_format)
+            sizes[image_format] = os.path.getsize(filename)
+            image_data = io.imread(filename)[:, :, :3]
+            if image_format == 'png-palette':
+                # the spectrogram keeps its colours
+                assert abs(image_data[66:532, 105:671].astype(int) -
+                           pixels[66:532, 105:671]).mean() < 0.1
+            else:
+                numpy.testing.assert_array_equal(image_data, pixels)
+        assert sizes['webp'] < sizes['png']
+        assert sizes['png-palette'] < sizes['png']
+
+        assert make_thumbnail(pixels, 0.25).shape == (150, 200, 3)
@@ -0,0 +1,35 @@
+"""Unit test for GravitySpy
+"""
+
+__author__ = 'Scott Coughlin <scott.coughlin@ligo.org>'
+
+from gravityspy.utils.sharedmemory import SharedTimeSeries
+from gwpy.timeseries import TimeSeries
+
+import numpy
+import os
+import pickle
+
+numpy.random.seed(1986)
+TIMESERIES = TimeSeries(numpy.random.normal(size=4096 * 16),
+                        sample_rate=4096, t0=1127700000,
+                        name='L1:GDS-CALIB_STRAIN')
+
+
+class TestGravitySpySharedMemory(object):
+    """`TestCase` for sharing data with worker processes
+    """
+    def test_shared_timeseries(self, tmpdir):
+        with SharedTimeSeries(TIMESERIES, directory=str(tmpdir)) as shared:
+            # only the metadata are pickled
+            assert len(pickle.dumps(shared)) < 1024
+
+            attached = pickle.loads(pickle.dumps(shared)).attach()
+            cropped = attached.crop(1127700004, 1127700012)
+            assert numpy.shares_memory(cropped.value, attached.value)
+            numpy.testing.assert_array_equal(
+                cropped.value, TIMESERIES.crop(1127700004, 1127700012).value)
+            assert cropped.t0 == TIMESERIES.crop(1127700004, 1127700012).t0
+            assert attached.name == TIMESERIES.name
+
+        assert not os.path.exists(shared.filename)
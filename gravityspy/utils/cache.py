@@ -0,0 +1,714 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Scott Coughlin (2017-)
+#
+# This file is part of gravityspy.
+#
+# gravityspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gravityspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Caches for intermediate data products of gravityspy
+"""
+
+from ..ml import read_image
+
+from gwpy.frequencyseries import FrequencySeries
+from gwpy.timeseries import TimeSeries
+
+from collections import OrderedDict
+import hashlib
+import json
+import math
+import numpy
+import os
+import re
+import tempfile
+import threading
+import uuid
+
+
+class ASDCache(object):
+    """A cache of amplitude spectral densities used for whitening
+
+    The ASDs are kept in an in-memory least recently used tier
+    and, if a `directory` is given, in an on-disk tier that can be shared
+    by many processes (and many runs) on the same machine.
+
+    Each ASD is estimated from the chunk of `chunk_time` seconds, aligned
+    to multiples of `chunk_time` in GPS time, nearest the middle of the
+    data, so that the data of neighbouring events share their ASD. Data
+    whitened with a cached ASD therefore differ from data whitened with
+    the ASD of all of the data. ASDs are keyed on the channel and the
+    origin (frametype or source) of the data.
+
+    Parameters:
+
+        maxsize (int, optional):
+            The number of ASDs kept in memory, default: 128
+
+        directory (str, optional):
+            Where to store the on-disk tier, default: no on-disk tier
+
+        chunk_time (int, optional):
+            Duration (seconds) of the data each ASD is estimated from,
+            default: 32. `None` estimates it from all of the data, which
+            then only shares it with the exact same span
+    """
+    def __init__(self, maxsize=128, directory=None, chunk_time=32):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.chunk_time = chunk_time
+        self._asds = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __getstate__(self):
+        # only the configuration travels to other processes
+        return {'maxsize': self.maxsize, 'directory': self.directory,
+                'chunk_time': self.chunk_time}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._asds)
+
+    @staticmethod
+    def key(channel_name, start_time, stop_time, sample_rate,
+            fftlength, overlap, window, origin=None):
+        """The key an ASD is stored under
+
+        Parameters:
+
+            channel_name (str):
+                The channel the data were read from
+
+            start_time (float):
+                GPS start time of the data the ASD was estimated from
+
+            stop_time (float):
+                GPS end time of the data the ASD was estimated from
+
+            sample_rate (float):
+                The sample rate of the data
+
+            fftlength (float):
+                FFT length (seconds) of the ASD estimate
+
+            overlap (float):
+                Overlap (seconds) of the ASD estimate
+
+            window (str):
+                Window of the ASD estimate
+
+            origin (optional):
+                Where the data were read from, e.g. the frametype or the
+                source files, default: `None`
+
+        Returns:
+
+            key (tuple)
+        """
+        return (str(channel_name), float(start_time), float(stop_time),
+                float(sample_rate), float(fftlength), float(overlap),
+                str(window), repr(origin))
+
+    def get(self, key):
+        """Retrieve an ASD from the cache
+
+        Parameters:
+
+            key (tuple):
+                see `ASDCache.key`
+
+        Returns:
+
+            asd (`gwpy.frequencyseries.FrequencySeries`):
+                or `None` if this ASD is not cached
+        """
+        with self._lock:
+            if key in self._asds:
+                self._asds.move_to_end(key)
+                return self._asds[key]
+
+        if self.directory is None:
+            return None
+
+        filename = self._filename(key)
+        if not os.path.isfile(filename):
+            return None
+
+        with numpy.load(filename) as cached:
+            asd = FrequencySeries(cached['value'], f0=float(cached['f0']),
+                                  df=float(cached['df']),
+                                  unit=str(cached['unit']),
+                                  name=str(cached['name']))
+        self._remember(key, asd)
+        return asd
+
+    def put(self, key, asd):
+        """Add an ASD to the cache
+
+        Parameters:
+
+            key (tuple):
+                see `ASDCache.key`
+
+            asd (`gwpy.frequencyseries.FrequencySeries`)
+        """
+        self._remember(key, asd)
+
+        if self.directory is None:
+            return
+
+        # write to a temporary file first so that other processes never
+        # read a partially written ASD
+        filename = self._filename(key)
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.npz')
+        with os.fdopen(fd, 'wb') as tmpfile:
+            numpy.savez(tmpfile, value=asd.value, f0=asd.f0.value,
+                        df=asd.df.value, unit=str(asd.unit),
+                        name=str(asd.name))
+        os.replace(tmpname, filename)
+
+    def asd(self, data, fftlength, overlap, window='hann',
+            channel_name=None, origin=None):
+        """Estimate the ASD of data, reusing a cached estimate if possible
+
+        Parameters:
+
+            data (`gwpy.timeseries.TimeSeries`)
+
+            fftlength (float):
+                FFT length (seconds) of the ASD estimate
+
+            overlap (float):
+                Overlap (seconds) of the ASD estimate
+
+            window (str, optional):
+                default: 'hann'
+
+            channel_name (str, optional):
+                The channel the data were read from, default: the name of
+                `data`. If neither is known the ASD is not cached.
+
+            origin (optional):
+                Where the data were read from, e.g. the frametype or the
+                source files, ASDs of other origins are not used,
+                default: `None`
+
+        Returns:
+
+            asd (`gwpy.frequencyseries.FrequencySeries`)
+        """
+        channel_name = channel_name or data.name
+        if not channel_name:
+            return data.asd(fftlength, overlap, window=window)
+
+        start_time, stop_time = self.chunk(*data.span)
+        key = self.key(channel_name, start_time, stop_time,
+                       data.sample_rate.decompose().value,
+                       fftlength, overlap, window, origin=origin)
+
+        asd = self.get(key)
+        if asd is None:
+            if (start_time, stop_time) != tuple(data.span):
+                data = data.crop(start_time, stop_time)
+            asd = data.asd(fftlength, overlap, window=window)
+            self.put(key, asd)
+        return asd
+
+    def chunk(self, start_time, stop_time):
+        """The span of data an ASD is estimated from
+
+        Parameters:
+
+            start_time (float):
+                GPS start time of the data
+
+            stop_time (float):
+                GPS end time of the data
+
+        Returns:
+
+            start_time, stop_time (tuple):
+                the aligned chunk nearest the middle of the data, or the
+                span of the data if no chunk fits in it
+        """
+        start_time, stop_time = float(start_time), float(stop_time)
+        if self.chunk_time is None:
+            return start_time, stop_time
+
+        first = numpy.ceil(start_time / self.chunk_time)
+        last = numpy.floor(stop_time / self.chunk_time) - 1
+        if first > last:
+            return start_time, stop_time
+        middle = numpy.round((start_time + stop_time) / 2. / self.chunk_time
+                             - 0.5)
+        chunk = min(max(middle, first), last)
+        return (float(chunk * self.chunk_time),
+                float((chunk + 1) * self.chunk_time))
+
+    def clear(self):
+        """Empty the in-memory tier of this cache
+        """
+        with self._lock:
+            self._asds.clear()
+
+    def _remember(self, key, asd):
+        with self._lock:
+            self._asds[key] = asd
+            self._asds.move_to_end(key)
+            while len(self._asds) > self.maxsize:
+                self._asds.popitem(last=False)
+
+    def _filename(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'asd-{0}.npz'.format(digest))
+
+
+def _origin_tag(origin):
+    """The part of a file name telling where the cached data came from
+
+    Frametypes are kept as they are, anything else (e.g. a list of
+    source files) is hashed.
+    """
+    if origin is None:
+        return 'default'
+    if isinstance(origin, str) and re.match(r'^[A-Za-z0-9_]+$', origin):
+        return origin
+    return hashlib.sha1(repr(origin).encode('utf-8')).hexdigest()[:16]
+
+
+class StrainCache(object):
+    """A read-through on-disk cache of conditioned strain data
+
+    Data are stored in memory-mapped `.npy` files holding one chunk of
+    `chunk_time` seconds, aligned to multiples of `chunk_time` in GPS time,
+    for every channel, origin (frametype or source) and sample rate.
+    Once the cache holds more than
+    `maxbytes` the least recently used chunks are deleted.
+
+    Parameters:
+
+        directory (str):
+            Where to store the chunks
+
+        chunk_time (int, optional):
+            Duration (seconds) of each chunk, default: 256
+
+        maxbytes (int, optional):
+            The size of the cache on disk, default: 16 GiB
+
+        pad (float, optional):
+            Extra data (seconds) fetched on either side of a chunk
+            and discarded, so that resampling does not leave artefacts
+            at the chunk boundaries, default: 8
+    """
+    def __init__(self, directory, chunk_time=256, maxbytes=2 ** 34, pad=8):
+        self.directory = directory
+        self.chunk_time = chunk_time
+        self.maxbytes = maxbytes
+        self.pad = pad
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, channel_name, start_time, stop_time, sample_rate, fetch,
+            origin=None):
+        """Obtain conditioned data, fetching any chunks not yet cached
+
+        Parameters:
+
+            channel_name (str):
+                The channel to obtain
+
+            start_time (float):
+                GPS start time of the data
+
+            stop_time (float):
+                GPS end time of the data
+
+            sample_rate (float):
+                The sample rate of the conditioned data
+
+            fetch (callable):
+                `fetch(start_time, stop_time)` returns the conditioned
+                `gwpy.timeseries.TimeSeries` for a span of time.
+                If a whole chunk cannot be fetched (e.g. at the end of
+                a science segment), the requested span is fetched
+                directly and not cached.
+
+            origin (optional):
+                Where `fetch` reads the data from, e.g. the frametype or
+                the source files, chunks of other origins are not used,
+                default: `None`
+
+        Returns:
+
+            data (`gwpy.timeseries.TimeSeries`)
+        """
+        first = int(math.floor(start_time / self.chunk_time))
+        last = int(math.ceil(stop_time / self.chunk_time))
+
+        chunks = []
+        for ichunk in range(first, last):
+            chunk = self._chunk(channel_name, ichunk, sample_rate, fetch,
+                                origin)
+            if chunk is None:
+                return fetch(start_time, stop_time)
+            chunks.append(chunk)
+
+        data = TimeSeries(numpy.concatenate(chunks),
+                          t0=first * self.chunk_time,
+                          sample_rate=sample_rate, name=channel_name,
+                          channel=channel_name)
+        return data.crop(start_time, stop_time, copy=True)
+
+    def size(self):
+        """The size (bytes) of this cache on disk
+        """
+        return sum(os.path.getsize(filename)
+                   for filename in self._filenames())
+
+    def evict(self):
+        """Delete least recently used chunks until within `maxbytes`
+        """
+        filenames = sorted(self._filenames(), key=os.path.getmtime)
+        total = sum(os.path.getsize(filename) for filename in filenames)
+        for filename in filenames:
+            if total <= self.maxbytes:
+                break
+            total -= os.path.getsize(filename)
+            try:
+                os.remove(filename)
+            except OSError:
+                # already removed by another process
+                pass
+
+    def _chunk(self, channel_name, ichunk, sample_rate, fetch, origin):
+        filename = self._filename(channel_name, ichunk, sample_rate, origin)
+        try:
+            chunk = numpy.load(filename, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            chunk = None
+        else:
+            # mark as recently used
+            os.utime(filename, None)
+            return chunk
+
+        start_time = ichunk * self.chunk_time
+        stop_time = start_time + self.chunk_time
+        try:
+            data = fetch(start_time - self.pad, stop_time + self.pad)
+        except (RuntimeError, ValueError, IOError):
+            return None
+        data = data.crop(start_time, stop_time)
+        if data.size != int(round(self.chunk_time * sample_rate)):
+            return None
+
+        # write to a temporary file first so that other processes never
+        # read a partially written chunk
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.npy')
+        with os.fdopen(fd, 'wb') as tmpfile:
+            numpy.save(tmpfile, data.value)
+        os.replace(tmpname, filename)
+        self.evict()
+        return data.value
+
+    def _filenames(self):
+        return [os.path.join(self.directory, filename)
+                for filename in os.listdir(self.directory)
+                if filename.startswith('strain-')]
+
+    def _filename(self, channel_name, ichunk, sample_rate, origin):
+        return os.path.join(
+            self.directory, 'strain-{0}-{1}-{2}-{3}-{4}.npy'.format(
+                str(channel_name).replace(':', '_'), _origin_tag(origin),
+                float(sample_rate), ichunk * self.chunk_time,
+                self.chunk_time))
+
+
+class PixelCache(object):
+    """An on-disk cache of the pixels of q scan images
+
+    The pixels `gravityspy.ml.read_image.read_batch` gives each image
+    are keyed by the path, modification time and size of the file and by
+    the crop, resolution and color they were read with, so an image that
+    is rewritten is read again. Every batch of newly read images is
+    stored as one shard: a memory-mapped `.npy` file with an index of
+    the keys of its rows. Shards are never modified, so any number of
+    processes can share the cache. Once the cache holds more than
+    `maxbytes` the least recently used shards are deleted.
+
+    Parameters:
+
+        directory (str):
+            Where to store the shards
+
+        maxbytes (int, optional):
+            The size of the cache on disk, default: 4 GiB
+    """
+    def __init__(self, directory, maxbytes=2 ** 32):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self._index = {}
+        self._shards = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.refresh()
+
+    def __getstate__(self):
+        # only the configuration travels to other processes
+        return {'directory': self.directory, 'maxbytes': self.maxbytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._index)
+
+    @staticmethod
+    def key(filename, x, y, resolution, color):
+        """The key the pixels of an image are stored under
+
+        Parameters:
+
+            filename (str):
+                The image
+
+            x (list):
+                xrange of pixels kept, see `read_image.read_and_crop_image`
+
+            y (list):
+                yrange of pixels kept
+
+            resolution (float):
+                The downsampling of the image
+
+            color (str):
+                'grayscale' or 'rgb'
+
+        Returns:
+
+            key (str):
+                or `None` if there is no such file
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size,
+               [int(i) for i in x], [int(i) for i in y], float(resolution),
+               str(color))
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Retrieve the pixels of an image from the cache
+
+        Parameters:
+
+            key (str):
+                see `PixelCache.key`
+
+        Returns:
+
+            pixels (`numpy.ndarray`):
+                read-only, or `None` if this image is not cached
+        """
+        with self._lock:
+            location = self._index.get(key)
+        if location is None:
+            return None
+        shard, row = location
+        pixels = self._shard(shard)
+        if pixels is None:
+            return None
+        return pixels[row]
+
+    def put(self, keys, pixels):
+        """Add the pixels of a batch of images to the cache as one shard
+
+        Parameters:
+
+            keys (list):
+                see `PixelCache.key`
+
+            pixels (`numpy.ndarray`):
+                The pixels of each image, stacked along the first axis
+        """
+        if not len(keys):
+            return
+        shard = 'pixels-{0}'.format(uuid.uuid4().hex)
+
+        # write the shard before its index, and both to temporary files
+        # first, so that other processes never read a partial shard
+        self._write(shard + '.npy',
+                    lambda tmpfile: numpy.save(tmpfile, pixels))
+        self._write(shard + '.json',
+                    lambda tmpfile: tmpfile.write(
+                        json.dumps(list(keys)).encode('utf-8')))
+
+        with self._lock:
+            self._shards[shard] = None
+            for row, key in enumerate(keys):
+                self._index[key] = (shard, row)
+        self.evict()
+
+    def size(self):
+        """The size (bytes) of the shards of this cache on disk
+        """
+        return sum(os.path.getsize(filename)
+                   for filename in self._filenames())
+
+    def evict(self):
+        """Delete least recently used shards until within `maxbytes`
+        """
+        filenames = sorted(self._filenames(), key=os.path.getmtime)
+        total = sum(os.path.getsize(filename) for filename in filenames)
+        for filename in filenames:
+            if total <= self.maxbytes:
+                break
+            total -= os.path.getsize(filename)
+            shard = os.path.basename(filename)[:-len('.npy')]
+            # the index first, so that no process finds a deleted shard
+            for name in [shard + '.json', shard + '.npy']:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    # already removed by another process
+                    pass
+            self._forget(shard)
+
+    def refresh(self):
+        """Pick up the shards written by other processes
+        """
+        for filename in sorted(os.listdir(self.directory)):
+            if not (filename.startswith('pixels-') and
+                    filename.endswith('.json')):
+                continue
+            shard = filename[:-len('.json')]
+            with self._lock:
+                if shard in self._shards:
+                    continue
+            with open(os.path.join(self.directory, filename)) as index:
+                keys = json.load(index)
+            with self._lock:
+                self._shards.setdefault(shard, None)
+                for row, key in enumerate(keys):
+                    self._index.setdefault(key, (shard, row))
+
+    def read_batch(self, filenames, resolution=0.3, x=[66, 532],
+                   y=[105, 671], color='grayscale', nthreads=4):
+        """Read the views of many samples, decoding only uncached images
+
+        The arguments and output are those of
+        `gravityspy.ml.read_image.read_batch`.
+        """
+        filenames = [list(sample) for sample in filenames]
+        if not filenames or not filenames[0]:
+            return read_image.read_batch(filenames, resolution=resolution,
+                                         x=x, y=y, color=color)
+        colors = ['grayscale', 'rgb'] if color == 'both' else [color]
+
+        keys = {}
+        cached = {}
+        missing = OrderedDict()
+        for icolor in colors:
+            keys[icolor] = {}
+            cached[icolor] = {}
+            for filename in set(filename for sample in filenames
+                                for filename in sample):
+                key = self.key(filename, x, y, resolution, icolor)
+                pixels = None if key is None else self.get(key)
+                keys[icolor][filename] = key
+                if pixels is None:
+                    missing[filename] = None
+                else:
+                    cached[icolor][filename] = pixels
+
+        if missing:
+            # decode every missing image once, as a batch of one view
+            missing = list(missing)
+            image_data, _ = read_image.read_batch(
+                [[filename] for filename in missing], resolution=resolution,
+                x=x, y=y, color=color, nthreads=nthreads)
+            if color != 'both':
+                image_data = (image_data,)
+            for icolor, pixels in zip(colors, image_data):
+                new = [(keys[icolor][filename], row)
+                       for row, filename in enumerate(missing)
+                       if filename not in cached[icolor] and
+                       keys[icolor][filename] is not None]
+                self.put([key for key, _ in new],
+                         pixels[[row for _, row in new], 0])
+                for filename, row in zip(missing, pixels[:, 0]):
+                    cached[icolor].setdefault(filename, row)
+
+        image_data = []
+        for icolor in colors:
+            shape = next(iter(cached[icolor].values())).shape
+            pixels = numpy.empty((len(filenames), len(filenames[0])) + shape,
+                                 dtype='float32')
+            for isample, sample in enumerate(filenames):
+                for iview, filename in enumerate(sample):
+                    pixels[isample, iview] = cached[icolor][filename]
+            image_data.append(pixels)
+
+        ids = [os.path.basename(sample[0]).split('_')[1]
+               for sample in filenames]
+
+        if color == 'both':
+            return tuple(image_data), ids
+        return image_data[0], ids
+
+    def _shard(self, shard):
+        filename = os.path.join(self.directory, shard + '.npy')
+        with self._lock:
+            pixels = self._shards.get(shard)
+        try:
+            if pixels is None:
+                pixels = numpy.load(filename, mmap_mode='r')
+                with self._lock:
+                    self._shards[shard] = pixels
+            # mark as recently used
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            # evicted by another process
+            self._forget(shard)
+            return None
+        return pixels
+
+    def _forget(self, shard):
+        with self._lock:
+            self._shards.pop(shard, None)
+            for key in [key for key, (name, _) in self._index.items()
+                        if name == shard]:
+                del self._index[key]
+
+    def _filenames(self):
+        return [os.path.join(self.directory, filename)
+                for filename in os.listdir(self.directory)
+                if filename.startswith('pixels-') and
+                filename.endswith('.npy')]
+
+    def _write(self, filename, write):
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmpfile:
+            write(tmpfile)
+        os.replace(tmpname, os.path.join(self.directory, filename))
+
+
+#: A cache for the processes that whiten data of only one source, pass it
+#: as the `asd_cache` of `gravityspy.utils.utils.make_q_scans`
+ASD_CACHE = ASDCache()
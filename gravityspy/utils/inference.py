@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Scott Coughlin (2017-)
+#
+# This file is part of gravityspy.
+#
+# gravityspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gravityspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Score images with models held by a long-running local process
+
+Loading the models costs far more than scoring one event. An
+`InferenceServer` loads them once and scores the pixels sent by any
+number of jobs on the same node, over a Unix socket or a localhost TCP
+port. Requests that arrive close together are scored as one batch.
+
+The requests are HTTP, so an endpoint can be checked with e.g.
+``curl --unix-socket <path> http://localhost/models``:
+
+    GET /models
+        the JSON list of the models held
+
+    POST /predict?model=<path>&order_of_channels=<order>&rgb=<0 or 1>
+                 &penultimate=<0 or 1>
+        the body is the `.npy` of the (samples, 4, rows, columns[, 3])
+        pixels and the response the `.npy` of the outputs of the model,
+        or with `penultimate` the `.npz` of the 'outputs' and the
+        'activations' fed to the last layer
+"""
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlencode, urlparse, parse_qs
+import http.client
+import io
+import ipaddress
+import json
+import numpy
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+
+class InferenceUnavailable(Exception):
+    """The endpoint cannot score the images
+    """
+    pass
+
+
+def parse_endpoint(endpoint):
+    """Where an endpoint listens
+
+    Parameters:
+
+        endpoint (str):
+            'host:port' or 'port' for TCP, otherwise the path of a Unix
+            socket, optionally prefixed with 'unix:'. As any client can
+            use the models, TCP hosts must be loopback, e.g. 'localhost',
+            '127.0.0.1' or '[::1]'
+
+    Returns:
+
+        family, address (tuple):
+            the socket family and the address to connect to
+
+    Raises:
+
+        ValueError:
+            if the host of a TCP endpoint is not loopback
+    """
+    if endpoint.startswith('unix:'):
+        return socket.AF_UNIX, endpoint[len('unix:'):]
+    host, _, port = endpoint.rpartition(':')
+    if port.isdigit() and '/' not in endpoint:
+        host = host.strip('[]') or 'localhost'
+        if host == 'localhost':
+            return socket.AF_INET, (host, int(port))
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            address = None
+        if address is None or not address.is_loopback:
+            raise ValueError('Endpoint {0} is not on a loopback host, '
+                             'please use localhost or a Unix '
+                             'socket'.format(endpoint))
+        if address.version == 6:
+            return socket.AF_INET6, (host, int(port))
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, endpoint
+
+
+class _Connection(http.client.HTTPConnection):
+    # an HTTP connection to a Unix socket or a TCP port
+    def __init__(self, endpoint, timeout):
+        self.family, self.address = parse_endpoint(endpoint)
+        http.client.HTTPConnection.__init__(self, 'localhost',
+                                            timeout=timeout)
+
+    def connect(self):
+        if self.family == socket.AF_UNIX:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.address)
+        else:
+            self.sock = socket.create_connection(self.address, self.timeout)
+
+
+class InferenceClient(object):
+    """Send images to an `InferenceServer`
+
+    Parameters:
+
+        endpoint (str):
+            Where the server listens, see `parse_endpoint`
+
+        timeout (float, optional):
+            Seconds to wait for the server, default: 60
+    """
+    def __init__(self, endpoint, timeout=60):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def models(self):
+        """The models held by the server
+
+        Returns:
+
+            models (list):
+                the path of every model
+        """
+        return json.loads(self._request('GET', '/models').decode())
+
+    def predict(self, image_data, model_name, order_of_channels='channels_last',
+                rgb=False, penultimate=False):
+        """The outputs of a model held by the server
+
+        Parameters:
+
+            image_data (`numpy.ndarray`):
+                The pixels of the 4 views of every sample, as for
+                `labelling_test_glitches.predict_batch`
+
+            model_name (str):
+                The file of the model
+
+            order_of_channels (str, optional):
+                default: 'channels_last'
+
+            rgb (bool, optional):
+                Are the pixels RGB, default: `False`
+
+            penultimate (bool, optional):
+                Also return the activations fed to the last layer of the
+                model, default: `False`
+
+        Returns:
+
+            outputs (`numpy.ndarray`):
+                or the outputs and the activations if `penultimate`
+
+        Raises:
+
+            InferenceUnavailable:
+                if the server is not running, does not hold the model
+                or fails to score the images
+        """
+        query = urlencode({'model': os.path.abspath(model_name),
+                           'order_of_channels': order_of_channels,
+                           'rgb': int(bool(rgb)),
+                           'penultimate': int(bool(penultimate))})
+        body = io.BytesIO()
+        numpy.save(body, numpy.asarray(image_data, dtype=numpy.float32))
+        response = self._request('POST', '/predict?' + query,
+                                 body.getvalue())
+        response = numpy.load(io.BytesIO(response), allow_pickle=False)
+        if penultimate:
+            with response:
+                return response['outputs'], response['activations']
+        return response
+
+    def _request(self, method, url, body=None):
+        connection = _Connection(self.endpoint, self.timeout)
+        try:
+            connection.request(method, url, body)
+            response = connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException) as exc:
+            raise InferenceUnavailable('Cannot reach {0}: {1}'.format(
+                                       self.endpoint, exc))
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise InferenceUnavailable('{0} answered {1}: {2}'.format(
+                                       self.endpoint, response.status,
+                                       content.decode(errors='replace')))
+        return content
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # the requests of one connection to an InferenceServer
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/models':
+            return self._reply(404, b'Unknown path')
+        self._reply(200, json.dumps(sorted(self.server.models)).encode())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            return self._reply(404, b'Unknown path')
+        query = parse_qs(url.query)
+        try:
+            model_name = query['model'][0]
+            order_of_channels = query.get('order_of_channels',
+                                          ['channels_last'])[0]
+            rgb = bool(int(query.get('rgb', ['0'])[0]))
+            penultimate = bool(int(query.get('penultimate', ['0'])[0]))
+            length = int(self.headers['Content-Length'])
+        except Exception as exc:
+            return self._reply(400, str(exc).encode())
+        if not 0 <= length <= self.server.max_request_bytes:
+            # discard the body a little at a time, so that the client
+            # reads the reply rather than a broken pipe
+            while length > 0:
+                chunk = self.rfile.read(min(length, 2 ** 16))
+                if not chunk:
+                    break
+                length -= len(chunk)
+            return self._reply(413, 'Requests are limited to {0} '
+                                    'bytes'.format(
+                                    self.server.max_request_bytes).encode())
+        try:
+            image_data = numpy.load(io.BytesIO(self.rfile.read(length)),
+                                    allow_pickle=False)
+        except Exception as exc:
+            return self._reply(400, str(exc).encode())
+        if model_name not in self.server.models:
+            return self._reply(404, 'Not holding {0}'.format(
+                                    model_name).encode())
+
+        try:
+            outputs = self.server.batcher.submit(
+                image_data, model_name, order_of_channels, rgb,
+                penultimate).result()
+        except Exception as exc:
+            return self._reply(500, str(exc).encode())
+        body = io.BytesIO()
+        if penultimate:
+            numpy.savez(body, outputs=outputs[0], activations=outputs[1])
+        else:
+            numpy.save(body, outputs)
+        self._reply(200, body.getvalue())
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Unix sockets have no client address to log
+        pass
+
+
+class _Batcher(object):
+    # scores the requests on one thread, which keras needs, merging
+    # those that arrive within max_delay seconds of the first
+    def __init__(self, models, batch_size, max_delay, predict):
+        self.models = models
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.predict = predict
+        self.requests = queue.Queue()
+        self.ready = Future()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, image_data, model_name, order_of_channels, rgb,
+               penultimate=False):
+        future = Future()
+        self.requests.put(((model_name, order_of_channels, rgb, penultimate),
+                           image_data, future))
+        return future
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        try:
+            from ..ml.registry import MODEL_REGISTRY
+            for model_name in self.models:
+                MODEL_REGISTRY.get_predictor(model_name)
+        except Exception as exc:
+            self.ready.set_exception(exc)
+            return
+        self.ready.set_result(True)
+
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            pending = [request]
+            nsamples = len(request[1])
+            deadline = time.time() + self.max_delay
+            while nsamples < self.batch_size:
+                try:
+                    request = self.requests.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                pending.append(request)
+                nsamples += len(request[1])
+
+            keys = []
+            for request in pending:
+                if request[0] not in keys:
+                    keys.append(request[0])
+            for key in keys:
+                self.score([request for request in pending
+                            if request[0] == key])
+
+    def score(self, requests):
+        (model_name, order_of_channels, rgb, penultimate) = requests[0][0]
+        try:
+            outputs = self.predict(
+                numpy.concatenate([request[1] for request in requests]),
+                model_name, order_of_channels=order_of_channels,
+                batch_size=self.batch_size, rgb=rgb, penultimate=penultimate)
+        except Exception as exc:
+            for request in requests:
+                request[2].set_exception(exc)
+            return
+        first = 0
+        for request in requests:
+            batch = slice(first, first + len(request[1]))
+            if penultimate:
+                request[2].set_result((outputs[0][batch], outputs[1][batch]))
+            else:
+                request[2].set_result(outputs[batch])
+            first += len(request[1])
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Hold models in memory and score the images sent to them
+
+    Parameters:
+
+        endpoint (str):
+            Where to listen, see `parse_endpoint`. TCP endpoints must
+            be on a loopback host, as any client can use the models
+
+        models (list):
+            The files of the models to hold
+
+        batch_size (int, optional):
+            The most samples scored at once, default: 64
+
+        max_delay (float, optional):
+            Seconds to wait for more requests to score together,
+            default: 0.01
+
+        max_request_bytes (int, optional):
+            The largest body of a request, larger requests are refused
+            with status 413, default: 1 GiB
+    """
+    daemon_threads = True
+
+    def __init__(self, endpoint, models, batch_size=64, max_delay=0.01,
+                 max_request_bytes=2 ** 30):
+        from ..ml.labelling_test_glitches import predict_batch
+
+        self.address_family, address = parse_endpoint(endpoint)
+        if self.address_family == socket.AF_UNIX and os.path.exists(address):
+            # a socket left by a server that was killed refuses connections
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(address)
+            except OSError:
+                os.remove(address)
+            else:
+                raise ValueError('A server already listens on {0}'.format(
+                                 endpoint))
+            finally:
+                probe.close()
+        self.allow_reuse_address = self.address_family != socket.AF_UNIX
+        socketserver.TCPServer.__init__(self, address, _Handler)
+
+        self.max_request_bytes = max_request_bytes
+        self.models = [os.path.abspath(model) for model in models]
+        self.batcher = _Batcher(self.models, batch_size, max_delay,
+                                predict_batch)
+        try:
+            self.batcher.ready.result()
+        except Exception:
+            self.server_close()
+            raise
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        self.batcher.stop()
+        if self.address_family == socket.AF_UNIX:
+            try:
+                os.remove(self.server_address)
+            except OSError:
+                pass
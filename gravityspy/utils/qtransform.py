@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Scott Coughlin (2017-)
+#
+# This file is part of gravityspy.
+#
+# gravityspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gravityspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A vectorized implementation of the tiled Q-transform
+
+The tiling is identical to `gwpy.signal.qtransform`, but all rows of a
+Q plane with the same number of tiles are transformed by one batched FFT,
+and the windows and layout of every plane are computed only once for
+each (duration, sample rate, Q range, frequency range).
+"""
+
+from gwpy.segments import Segment
+from gwpy.signal.qtransform import (QTiling, QGram, DEFAULT_MISMATCH)
+from gwpy.spectrogram import Spectrogram
+from gwpy.timeseries import TimeSeries
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from math import floor
+import numpy
+import threading
+
+#: The largest number of complex samples transformed in one batch
+MAX_BATCH_SIZE = 2 ** 22
+
+#: The largest number of double precision samples interpolated in one block
+MAX_INTERPOLATION_SIZE = 2 ** 18
+
+
+def get_fft_backend(name='numpy'):
+    """Find the module used to compute FFTs
+
+    Parameters:
+
+        name (str, optional):
+            One of 'numpy', 'scipy' or 'pyfftw', default: 'numpy'
+
+    Returns:
+
+        backend (module):
+            A module providing numpy-like `rfft` and `ifft` functions
+    """
+    if name == 'numpy':
+        return numpy.fft
+    elif name == 'scipy':
+        import scipy.fft
+        return scipy.fft
+    elif name == 'pyfftw':
+        try:
+            import pyfftw.interfaces.numpy_fft
+            import pyfftw.interfaces.cache
+        except ImportError:
+            raise ImportError("The pyfftw FFT backend requires pyfftw, "
+                              "try pip install pyfftw")
+        # keep the FFTW plans of repeated transforms
+        pyfftw.interfaces.cache.enable()
+        return pyfftw.interfaces.numpy_fft
+    else:
+        raise ValueError('Unknown FFT backend {0}, please choose from '
+                         'numpy, scipy or pyfftw'.format(name))
+
+
+class QPlaneLayout(object):
+    """The precomputed windows and layout of the rows of one Q plane
+
+    Rows with the same number of tiles are grouped so that they can be
+    transformed together.
+
+    Parameters:
+
+        plane (`gwpy.signal.qtransform.QPlane`)
+    """
+    def __init__(self, plane):
+        self.plane = plane
+        self.q = plane.q
+        self.frequencies = plane.frequencies
+
+        rows = list(plane)
+        # the number of independent tiles, used to estimate the FAR
+        self.nind = sum([1 + row.ntiles * row.deltam for row in rows])
+
+        groups = {}
+        for idx, row in enumerate(rows):
+            groups.setdefault(row.ntiles, []).append(idx)
+
+        self.groups = []
+        for ntiles in sorted(groups):
+            indices = groups[ntiles]
+            starts = []
+            lefts = []
+            windows = []
+            for idx in indices:
+                row = rows[idx]
+                window = row.get_window()
+                starts.append(row.get_data_indices()[0])
+                lefts.append(row.padding[0])
+                windows.append(window)
+            self.groups.append((ntiles, numpy.array(indices), starts,
+                                lefts, windows))
+
+
+@lru_cache(maxsize=16)
+def get_tiling(duration, sampling, qrange, frange,
+               mismatch=DEFAULT_MISMATCH):
+    """Find the (cached) layouts of every Q plane of a tiling
+
+    Parameters:
+
+        duration (float):
+            Duration (seconds) of the data to be transformed
+
+        sampling (float):
+            Sample rate (Hertz) of the data to be transformed
+
+        qrange (tuple):
+            `(low, high)` range of Qs
+
+        frange (tuple):
+            `(low, high)` range of frequencies
+
+        mismatch (float, optional):
+            Maximum fractional mismatch between neighbouring tiles
+
+    Returns:
+
+        layouts (tuple):
+            A `QPlaneLayout` for every plane of the tiling
+    """
+    tiling = QTiling(duration, sampling, qrange=qrange, frange=frange,
+                     mismatch=mismatch)
+    return tuple(QPlaneLayout(plane) for plane in tiling)
+
+
+def transform_plane(layout, fdata, epoch, duration, search=None,
+                    backend=numpy.fft):
+    """Compute the normalized tile energies of one Q plane
+
+    Parameters:
+
+        layout (`QPlaneLayout`):
+            The plane to compute
+
+        fdata (array):
+            The one-sided FFT of the data, normalized as in
+            `gwpy.timeseries.TimeSeries.fft`
+
+        epoch (float):
+            GPS start time of the data
+
+        duration (float):
+            Duration (seconds) of the data
+
+        search (`gwpy.segments.Segment`, optional):
+            Window in which to look for the loudest tile
+
+        backend (module, optional):
+            see `get_fft_backend`
+
+    Returns:
+
+        energies (list):
+            A list of `numpy.ndarray` of normalized energies,
+            one for each frequency row of the plane
+
+        peak (float):
+            The energy of the loudest tile in the search window
+    """
+    energies = [None] * len(layout.frequencies)
+    peak = 0.
+    for ntiles, indices, starts, lefts, windows in layout.groups:
+        # bound the memory of very long rows
+        nbatch = max(1, MAX_BATCH_SIZE // ntiles)
+        for first in range(0, len(indices), nbatch):
+            batch = slice(first, first + nbatch)
+            padded = numpy.zeros((len(indices[batch]), ntiles),
+                                 dtype=fdata.dtype)
+            for irow, (start, left, window) in enumerate(zip(
+                    starts[batch], lefts[batch], windows[batch])):
+                padded[irow, left:left + window.size] = (
+                    fdata[start:start + window.size] * window)
+            # move negative frequencies to the end and IFFT every row
+            tdenergy = backend.ifft(numpy.fft.ifftshift(padded, axes=1),
+                                    axis=1)
+            energy = tdenergy.real ** 2. + tdenergy.imag ** 2.
+            energy = (energy / numpy.median(energy, axis=1)[:, None]
+                      ).astype('float32', casting='same_kind', copy=False)
+
+            if search is None:
+                idx0, idx1 = None, None
+            else:
+                idx0, idx1 = _crop_indices(epoch, duration / ntiles,
+                                           epoch + duration, search)
+            peak = max(peak, energy[:, idx0:idx1].max())
+
+            for irow, idx in enumerate(indices[batch]):
+                energies[idx] = energy[irow]
+
+    return energies, peak
+
+
+def q_scan(data, qrange, frange, mismatch=DEFAULT_MISMATCH, search=None,
+           backend='numpy', nthreads=1):
+    """Transform data by scanning over a Q tiling
+
+    This is a drop-in replacement of `gwpy.signal.qtransform.q_scan`
+    for `gwpy.timeseries.TimeSeries` input.
+
+    Parameters:
+
+        data (`gwpy.timeseries.TimeSeries`):
+            The (whitened) data to transform
+
+        qrange (tuple):
+            `(low, high)` range of Qs to scan
+
+        frange (tuple):
+            `(low, high)` range of frequencies to scan
+
+        mismatch (float, optional):
+            Maximum fractional mismatch between neighbouring tiles
+
+        search (`gwpy.segments.Segment`, optional):
+            Window in which to look for the loudest Q plane
+
+        backend (str, optional):
+            The FFT backend, see `get_fft_backend`, default: 'numpy'
+
+        nthreads (int, optional):
+            The number of Q planes to compute at once, default: 1
+
+    Returns:
+
+        qgram (`gwpy.signal.qtransform.QGram`):
+            The energies of the loudest Q plane
+
+        far (float):
+            Expected false alarm rate (Hertz) of white Gaussian noise
+            with the same peak energy
+    """
+    fft_backend = get_fft_backend(backend)
+    duration = float(abs(data.span))
+    sampling = float(data.sample_rate.to('Hz').value)
+    epoch = data.x0.value
+
+    # one-sided FFT normalized as in TimeSeries.fft
+    nfft = data.size
+    fdata = fft_backend.rfft(data.value) / nfft
+    fdata[1:] *= 2.0
+    if not numpy.isfinite(fdata).all():
+        raise ValueError('Input signal contains non-numerical values')
+
+    layouts = get_tiling(duration, sampling, tuple(qrange), tuple(frange),
+                         mismatch)
+
+    # keep only the loudest plane so far; as in gwpy the first of
+    # equally loud planes wins
+    best = {'key': (0., 0), 'layout': None, 'energies': None}
+    lock = threading.Lock()
+
+    def _scan(ilayout):
+        layout = layouts[ilayout]
+        energies, peak = transform_plane(layout, fdata, epoch, duration,
+                                         search=search, backend=fft_backend)
+        with lock:
+            if (peak, -ilayout) > best['key']:
+                best.update(key=(peak, -ilayout), layout=layout,
+                            energies=energies)
+
+    if nthreads > 1:
+        with ThreadPoolExecutor(nthreads) as executor:
+            list(executor.map(_scan, range(len(layouts))))
+    else:
+        for ilayout in range(len(layouts)):
+            _scan(ilayout)
+    best, best_energies = best['layout'], best['energies']
+
+    rows = [TimeSeries(energy, x0=epoch, dx=duration / energy.size,
+                       copy=False) for energy in best_energies]
+    qgram = QGram(best.plane, rows, search)
+
+    weight = 1 + numpy.log10(qrange[1] / qrange[0]) / numpy.sqrt(2)
+    ntiles = sum(layout.nind for layout in layouts) * weight / len(layouts)
+    far = 1.5 * ntiles * numpy.exp(-qgram.peak['energy']) / duration
+    return qgram, far
+
+
+def _crop_indices(x0, dx, x1, segment):
+    """The slice indices `gwpy.types.Series.crop` would use
+    """
+    start, end = segment
+    if start <= x0:
+        idx0 = None
+    else:
+        idx0 = floor((start - x0) / dx)
+    if end >= x1:
+        idx1 = None
+    else:
+        idx1 = floor((end - x0) / dx)
+    return idx0, idx1
+
+
+def interpolate(qgram, tres=None, fres=None, logf=False, outseg=None):
+    """Interpolate a `QGram` over a regularly-gridded spectrogram
+
+    This gives the same spectrogram as
+    `gwpy.signal.qtransform.QGram.interpolate`, but the frequency
+    interpolation is evaluated a block of time bins at a time and written
+    straight into an output of the dtype of the energies, so no double
+    precision copy of the whole spectrogram is ever made.
+
+    Parameters:
+
+        qgram (`gwpy.signal.qtransform.QGram`):
+            The Q plane to interpolate
+
+        tres (float, optional):
+            Time resolution (seconds) of the output,
+            default: `abs(outseg) / 1000.`
+
+        fres (float, int, optional):
+            Frequency resolution (Hertz) of the output or, if `logf`,
+            the number of log-spaced frequencies,
+            default: 0.5 Hz or 500 frequencies
+
+        logf (bool, optional):
+            Whether to log-sample the frequencies, default: False
+
+        outseg (`gwpy.segments.Segment`, optional):
+            GPS `[start, stop)` of the output, default: the span of `qgram`
+
+    Returns:
+
+        specgram (`gwpy.spectrogram.Spectrogram`):
+            The normalized Q energies
+    """
+    from scipy.interpolate import (InterpolatedUnivariateSpline,
+                                   RectBivariateSpline)
+
+    if outseg is None:
+        outseg = qgram.energies[0].span
+    if tres is None:
+        tres = abs(Segment(outseg)) / 1000.
+    dtype = qgram.energies[0].dtype
+    frequencies = qgram.plane.frequencies
+
+    # interpolate every frequency row onto the same times
+    xout = numpy.arange(outseg[0], outseg[1], step=tres)
+    rows = numpy.empty((xout.size, frequencies.size), dtype=dtype)
+    for irow, row in enumerate(qgram.energies):
+        xrow = numpy.arange(row.x0.value, (row.x0 + row.duration).value,
+                            row.dx.value)
+        spline = InterpolatedUnivariateSpline(xrow, row.value)
+        rows[:, irow] = spline(xout)
+
+    # then across the band onto the output frequencies
+    spline = RectBivariateSpline(xout, frequencies, rows)
+    del rows
+    if logf:
+        outfreq = numpy.geomspace(qgram.plane.frange[0],
+                                  qgram.plane.frange[1],
+                                  num=int(fres or 500))
+    else:
+        outfreq = numpy.arange(qgram.plane.frange[0], qgram.plane.frange[1],
+                               fres or .5, dtype=dtype)
+    out = numpy.empty((xout.size, outfreq.size), dtype=dtype)
+    nbatch = max(1, MAX_INTERPOLATION_SIZE // outfreq.size)
+    for first in range(0, xout.size, nbatch):
+        block = slice(first, first + nbatch)
+        out[block] = spline(xout[block], outfreq)
+
+    specgram = Spectrogram(out, t0=outseg[0], dt=tres, frequencies=outfreq,
+                           copy=False)
+    specgram.q = qgram.plane.q
+    return specgram
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) Scott Coughlin (2017-)
+#
+# This file is part of gravityspy.
+#
+# gravityspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# gravityspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Share data with worker processes without pickling it
+"""
+
+from gwpy.timeseries import TimeSeries
+
+import numpy
+import os
+import tempfile
+
+#: Where shared arrays are stored, a RAM-backed filesystem if possible
+SHARED_MEMORY_DIRECTORY = '/dev/shm'
+
+
+class SharedTimeSeries(object):
+    """A `gwpy.timeseries.TimeSeries` in memory shared between processes
+
+    The data are copied once into a memory-mapped file on a RAM-backed
+    filesystem. Only the name of that file and the metadata of the
+    `TimeSeries` are pickled when this object is sent to other processes,
+    which then map the same memory with `SharedTimeSeries.attach`.
+
+    Parameters:
+
+        timeseries (`gwpy.timeseries.TimeSeries`):
+            The data to share
+
+        directory (str, optional):
+            Where to store the data, default: `/dev/shm` if it exists,
+            otherwise the temporary directory
+    """
+    def __init__(self, timeseries, directory=None):
+        if directory is None:
+            if os.path.isdir(SHARED_MEMORY_DIRECTORY):
+                directory = SHARED_MEMORY_DIRECTORY
+            else:
+                directory = tempfile.gettempdir()
+
+        fd, self.filename = tempfile.mkstemp(prefix='gravityspy-',
+                                             suffix='.dat', dir=directory)
+        os.close(fd)
+        self.dtype = timeseries.dtype.str
+        self.shape = timeseries.shape
+        array = numpy.memmap(self.filename, dtype=self.dtype, mode='w+',
+                             shape=self.shape)
+        array[:] = timeseries.value
+        array.flush()
+        del array
+
+        self.t0 = timeseries.t0.value
+        self.sample_rate = timeseries.sample_rate.decompose().value
+        self.unit = str(timeseries.unit)
+        self.name = timeseries.name
+        self.channel = timeseries.channel
+        self._owner = os.getpid()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def attach(self):
+        """Map the shared data into this process
+
+        Returns:
+
+            timeseries (`gwpy.timeseries.TimeSeries`):
+                A read-only `TimeSeries` backed by the shared memory,
+                `crop` returns views of it without copying
+        """
+        array = numpy.memmap(self.filename, dtype=self.dtype, mode='r',
+                             shape=self.shape)
+        return TimeSeries(array, t0=self.t0, sample_rate=self.sample_rate,
+                          unit=self.unit, name=self.name,
+                          channel=self.channel, copy=False)
+
+    def close(self):
+        """Free the shared memory, only the process that created it can
+        """
+        if os.getpid() == self._owner and os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -17,25 +17,39 @@
 # along with gravityspy.  If not, see <http://www.gnu.org/licenses/>.
 
 from . import log
+from . import qtransform
+from .inference import InferenceClient, InferenceUnavailable
 from ..plot.plot import plot_qtransform
+from ..plot.raster import rasterize_qtransform
+from ..plot.stitch import stitch_qtransform
+from ..plot.writer import (render_figure, save_image, make_thumbnail,
+                           image_extension)
 from ..ml import read_image
 from ..ml import labelling_test_glitches as label_glitches
+from ..ml.registry import MODEL_REGISTRY
 
 from gwpy.timeseries import TimeSeries
 from gwpy.segments import Segment
+from gwpy.signal import qtransform as gwpy_qtransform
 from gwpy.table import GravitySpyTable
+from skimage import io
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy
-import h5py
 import os
-import pandas
-import matplotlib.pyplot as plt
+import re
 
 class GravitySpyConfigFile(object):
     def __init__(self, sample_frequency=16384, block_time=64,
                  search_frequency_range=(10, 2048),
                  search_q_range=(4, 64), plot_time_ranges=[0.5, 1.0, 2.0, 4.0],
-                 plot_normalized_energy_range=(0, 25.5)):
+                 plot_normalized_energy_range=(0, 25.5),
+                 qtransform_engine='gwpy', fft_backend='numpy',
+                 output_grid='linear',
+                 output_time_bins=640, output_frequency_bins=480,
+                 png_compress_level=6, super_image='plot',
+                 image_format='png', thumbnail_scale=None):
 
         self.sample_frequency = sample_frequency
         self.block_time = block_time
@@ -43,15 +57,47 @@ class GravitySpyConfigFile(object):
         self.search_q_range = search_q_range
         self.plot_time_ranges = plot_time_ranges
         self.plot_normalized_energy_range = plot_normalized_energy_range
+        self.qtransform_engine = qtransform_engine
+        self.fft_backend = fft_backend
+        self.output_grid = output_grid
+        self.output_time_bins = output_time_bins
+        self.output_frequency_bins = output_frequency_bins
+        self.png_compress_level = png_compress_level
+        self.super_image = super_image
+        self.image_format = image_format
+        self.thumbnail_scale = thumbnail_scale
 
 def make_q_scans(event_time, **kwargs):
-    """Classify triggers in this table
+    """Q scan the data around an event
 
     Parameters:
-    -----------
 
-    Returns
-    -------
+        event_time (float):
+            The GPS time of the event
+
+        **kwargs:
+            config, timeseries, source, channel_name, frametype,
+            strain_cache, verbose : see `fetch_data`
+
+            whiten : whiten the data before the q transform, default:
+                `True`
+
+            asd_cache : `cache.ASDCache` to reuse the ASDs for whitening
+                in. With a cache the ASD is estimated from one aligned
+                chunk of the data (see `cache.ASDCache`) instead of all
+                of it, so the q scans differ slightly from those made
+                without one, default: `None`
+
+            nthreads : the number of spectrograms interpolated at once,
+                default: 1
+
+    Returns:
+
+        specsgrams (list):
+            A `gwpy.spectrogram.Spectrogram` per duration of the config
+
+        q_value (float):
+            The Q of the loudest plane
     """
     # Parse Keyword Arguments
     config = kwargs.pop('config', GravitySpyConfigFile())
@@ -59,6 +105,10 @@ def make_q_scans(event_time, **kwargs):
     source = kwargs.pop('source', None)
     channel_name = kwargs.pop('channel_name', None)
     frametype = kwargs.pop('frametype', None)
+    whiten = kwargs.pop('whiten', True)
+    asd_cache = kwargs.pop('asd_cache', None)
+    strain_cache = kwargs.pop('strain_cache', None)
+    nthreads = kwargs.pop('nthreads', 1)
     verbose = kwargs.pop('verbose', False)
 
     if verbose:
@@ -92,74 +142,301 @@ def make_q_scans(event_time, **kwargs):
                                search_frequency_range, search_q_range,
                                plot_time_ranges, plot_normalized_energy_range))
 
-    # find closest sample time to event time
-    center_time = (
-                   numpy.floor(event_time) +
-                   numpy.round((event_time - numpy.floor(event_time)) *
-                   sample_frequency) / sample_frequency
-                  )
-
-    # determine segment start and stop times
-    start_time = round(center_time - block_time / 2)
-    stop_time = start_time + block_time
+    # find closest sample time to event time and the data segment around it
+    center_time, data_segment = event_segment(event_time, config=config)
+    start_time, stop_time = data_segment
 
     # Read in the data
-    if timeseries:
-        data = timeseries.crop(start_time, stop_time,)
-    elif source:
-        if verbose:
-            logger.info('Reading Data From Source ...')
-        data = TimeSeries.read(source=source, channel=channel_name,
-                               start=start_time, end=stop_time, verbose=verbose)
-    else:
-        if verbose:
-            logger.info('Fetching Data...')
-        data = TimeSeries.get(channel_name, start_time, stop_time,
-                              frametype=frametype, verbose=verbose).astype('float64')
+    data = fetch_data(start_time, stop_time, config=config,
+                      timeseries=timeseries, source=source,
+                      channel_name=channel_name, frametype=frametype,
+                      strain_cache=strain_cache, verbose=verbose)
 
-    # resample data
-    if verbose:
-        logger.info('Resampling Data...')
-    if data.sample_rate.decompose().value != sample_frequency:
-        data = data.resample(sample_frequency)
+    # whiten the data once for all of the q scans of this event
+    if whiten:
+        if verbose:
+            logger.info('Whitening Data...')
+        data = whiten_data(data, asd_cache=asd_cache,
+                           channel_name=channel_name,
+                           origin=source or frametype)
 
     # Cropping the results before interpolation to save on time and memory
     # perform the q-transform
     if verbose:
         logger.info('Processing Q Scans...')
 
-    specsgrams = []
-    for time_window in plot_time_ranges:
+    # The loudest Q plane within half a second of the event is the same
+    # for every duration, so tile the data only once and derive each
+    # duration by interpolating that plane over its own window
+    search = Segment(center_time - 0.25, center_time + 0.25) & data.span
+    if config.qtransform_engine == 'gwpy':
+        qgram, _ = gwpy_qtransform.q_scan(
+            data, qrange=tuple(search_q_range),
+            frange=tuple(search_frequency_range), search=search)
+    elif config.qtransform_engine == 'native':
+        qgram, _ = qtransform.q_scan(
+            data, qrange=tuple(search_q_range),
+            frange=tuple(search_frequency_range), search=search,
+            backend=config.fft_backend, nthreads=nthreads)
+    else:
+        raise ValueError('Unknown qtransform_engine {0}, please choose '
+                         'from gwpy or native'.format(
+                             config.qtransform_engine))
+    q_value = qgram.plane.q
+
+    def _interpolate(time_window):
         duration_for_plot = time_window/2
+        grid = output_grid(time_window, config=config)
         try:
             outseg = Segment(center_time - duration_for_plot,
                              center_time + duration_for_plot)
-            q_scan = data.q_transform(qrange=tuple(search_q_range),
-                                      frange=tuple(search_frequency_range),
-                                      gps=center_time,
-                                      search=0.5, tres=0.002,
-                                      fres=0.5, outseg=outseg, whiten=True)
-            q_value = q_scan.q
-            q_scan = q_scan.crop(center_time-time_window/2,
-                                 center_time+time_window/2)
+            q_scan = qtransform.interpolate(qgram, outseg=outseg, **grid)
         except:
             outseg = Segment(center_time - 2*duration_for_plot,
                              center_time + 2*duration_for_plot)
-            q_scan = data.q_transform(qrange=tuple(search_q_range),
-                                      frange=tuple(search_frequency_range),
-                                      gps=center_time, search=0.5,
-                                      tres=0.002,
-                                      fres=0.5, outseg=outseg, whiten=True)
-            q_value = q_scan.q
-            q_scan = q_scan.crop(center_time-time_window/2,
-                                 center_time+time_window/2)
-        specsgrams.append(q_scan)
+            q_scan = qtransform.interpolate(qgram, outseg=outseg, **grid)
+        return q_scan.crop(center_time-time_window/2,
+                           center_time+time_window/2)
+
+    if nthreads > 1:
+        with ThreadPoolExecutor(nthreads) as executor:
+            specsgrams = list(executor.map(_interpolate, plot_time_ranges))
+    else:
+        specsgrams = [_interpolate(time_window)
+                      for time_window in plot_time_ranges]
 
     if verbose:
         logger.info('The most significant q value is {0}'.format(q_value))
 
     return specsgrams, q_value
 
+def output_grid(time_window, config=GravitySpyConfigFile()):
+    """The time and frequency grid the q scans are interpolated onto
+
+    With `config.output_grid` 'linear' every spectrogram is sampled every
+    2 ms and 0.5 Hz. With 'log' the frequencies are log-spaced and each
+    duration has the same number of time bins, so that the spectrograms are
+    only as large as the plots (and the CNN) can resolve.
+
+    Parameters:
+
+        time_window (float):
+            The duration of the spectrogram
+
+        config (`GravitySpyConfigFile`, optional)
+
+    Returns:
+
+        grid (dict):
+            keyword arguments for `gwpy.signal.qtransform.QGram.interpolate`
+    """
+    if config.output_grid == 'linear':
+        return {'tres': 0.002, 'fres': 0.5}
+    elif config.output_grid == 'log':
+        return {'tres': float(time_window) / config.output_time_bins,
+                'fres': config.output_frequency_bins, 'logf': True}
+    else:
+        raise ValueError('Unknown output_grid {0}, please choose '
+                         'from linear or log'.format(config.output_grid))
+
+def event_segment(event_time, config=GravitySpyConfigFile()):
+    """Determine the span of data needed to q scan an event
+
+    Parameters:
+
+        event_time (float):
+            The GPS time of the event
+
+        config (`GravitySpyConfigFile`, optional):
+            The `sample_frequency` and `block_time` of this
+            config determine the segment
+
+    Returns:
+
+        center_time (float):
+            The sample time closest to `event_time`
+
+        data_segment (`gwpy.segments.Segment`):
+            The `block_time` long span of data centered on `center_time`
+    """
+    sample_frequency = config.sample_frequency
+    block_time = config.block_time
+
+    # find closest sample time to event time
+    center_time = (
+                   numpy.floor(event_time) +
+                   numpy.round((event_time - numpy.floor(event_time)) *
+                   sample_frequency) / sample_frequency
+                  )
+
+    # determine segment start and stop times
+    start_time = round(center_time - block_time / 2)
+    stop_time = start_time + block_time
+
+    return center_time, Segment(start_time, stop_time)
+
+def plan_blocks(event_times, config=GravitySpyConfigFile(),
+                max_block_time=None):
+    """Group events whose data overlap into coalesced blocks of data
+
+    Parameters:
+
+        event_times (array):
+            The GPS times of the events to be q scanned
+
+        config (`GravitySpyConfigFile`, optional):
+            Determines the span of data needed for each event,
+            see `event_segment`
+
+        max_block_time (float, optional):
+            The longest block of data to plan, once a block reaches
+            this length the next overlapping event starts a new block.
+            default: no limit
+
+    Returns:
+
+        blocks (list):
+            A list of `(gwpy.segments.Segment, indices)` tuples, one
+            for each block of data, where `indices` are the positions
+            in `event_times` of the events whose data lies in the block
+    """
+    segments = [event_segment(event_time, config=config)[1]
+                for event_time in event_times]
+    order = sorted(range(len(segments)), key=lambda idx: segments[idx][0])
+
+    blocks = []
+    for idx in order:
+        start_time, stop_time = segments[idx]
+        if blocks:
+            block, indices = blocks[-1]
+            coalesced = Segment(block[0], max(block[1], stop_time))
+            if ((start_time <= block[1]) and
+                    ((max_block_time is None) or
+                     (abs(coalesced) <= max_block_time))):
+                blocks[-1] = (coalesced, indices + [idx])
+                continue
+        blocks.append((Segment(start_time, stop_time), [idx]))
+
+    return blocks
+
+def fetch_data(start_time, stop_time, **kwargs):
+    """Obtain resampled data for a span of time
+
+    Parameters:
+
+        start_time (float):
+            GPS start time of the data
+
+        stop_time (float):
+            GPS end time of the data
+
+        **kwargs:
+            config, timeseries, source, channel_name, frametype, verbose
+
+            strain_cache : `cache.StrainCache` to read the resampled data
+                through when it is read from `source` or fetched, the
+                data are keyed by `channel_name` and by `source` or
+                `frametype`, and not cached without `channel_name`,
+                default: `None` (no caching)
+
+    Returns:
+
+        data (`gwpy.timeseries.TimeSeries`):
+            The data sampled at the `sample_frequency` of the config
+    """
+    config = kwargs.pop('config', GravitySpyConfigFile())
+    timeseries = kwargs.pop('timeseries', None)
+    source = kwargs.pop('source', None)
+    channel_name = kwargs.pop('channel_name', None)
+    frametype = kwargs.pop('frametype', None)
+    strain_cache = kwargs.pop('strain_cache', None)
+    verbose = kwargs.pop('verbose', False)
+
+    if verbose:
+        logger = log.Logger('Gravity Spy: Fetching Data')
+
+    sample_frequency = config.sample_frequency
+
+    def _resample(data):
+        if verbose:
+            logger.info('Resampling Data...')
+        if data.sample_rate.decompose().value != sample_frequency:
+            data = data.resample(sample_frequency)
+        return data
+
+    def _fetch(start_time, stop_time):
+        if source:
+            if verbose:
+                logger.info('Reading Data From Source ...')
+            data = TimeSeries.read(source=source, channel=channel_name,
+                                   start=start_time, end=stop_time,
+                                   verbose=verbose)
+        else:
+            if verbose:
+                logger.info('Fetching Data...')
+            data = TimeSeries.get(channel_name, start_time, stop_time,
+                                  frametype=frametype,
+                                  verbose=verbose).astype('float64')
+        return _resample(data)
+
+    # Read in the data
+    if timeseries is not None:
+        data = _resample(timeseries.crop(start_time, stop_time,))
+    elif (strain_cache is not None) and (channel_name is not None):
+        data = strain_cache.get(channel_name, start_time, stop_time,
+                                sample_frequency, _fetch,
+                                origin=source or frametype)
+    else:
+        data = _fetch(start_time, stop_time)
+
+    return data
+
+def whiten_data(data, fduration=2, **kwargs):
+    """Whiten data exactly as `TimeSeries.q_transform` would
+
+    The ASD is averaged over 50% overlapping Hann windowed
+    periodograms of the default `gwpy` length for this sample rate.
+
+    Parameters:
+
+        data (`gwpy.timeseries.TimeSeries`):
+            The data to whiten
+
+        fduration (float, optional):
+            Duration (seconds) of the time-domain whitening filter,
+            default: 2
+
+        **kwargs:
+            asd_cache : `cache.ASDCache` to look up and store the ASD in,
+                which then estimates it from an aligned chunk of the data
+                rather than all of it, default: `None` (no caching)
+
+            channel_name : the channel the data were read from,
+                used to key the ASD cache, default: the name of `data`
+
+            origin : the frametype or the source the data were read
+                from, used to key the ASD cache, default: `None`
+
+    Returns:
+
+        whitened (`gwpy.timeseries.TimeSeries`):
+            The whitened data, suitable for `q_transform` with
+            `whiten=False`
+    """
+    asd_cache = kwargs.pop('asd_cache', None)
+    channel_name = kwargs.pop('channel_name', None)
+    origin = kwargs.pop('origin', None)
+
+    fftlength = int(max(2, numpy.ceil(2048 * data.dt.decompose().value)))
+    overlap = fftlength / 2.
+    if asd_cache is None:
+        asd = data.asd(fftlength, overlap, window='hann')
+    else:
+        asd = asd_cache.asd(data, fftlength, overlap, window='hann',
+                            channel_name=channel_name, origin=origin)
+    with numpy.errstate(all='raise'):
+        return data.whiten(asd=asd, fduration=fduration)
+
 def save_q_scans(plot_directory, specsgrams,
                  plot_normalized_energy_range, plot_time_ranges,
                  detector_name, event_time, **kwargs):
@@ -168,11 +445,33 @@ def save_q_scans(plot_directory, specsgrams,
     Parameters:
     -----------
 
+        super_image (str, optional):
+            How to make the image of all q scans, `id_string.png`: 'plot'
+            plots it, 'stitch' lays out the individual plots side by side
+            (see `gravityspy.plot.stitch_qtransform`), `None` skips it,
+            see `make_super_image`, default: 'plot'
+
+        image_format (str, optional):
+            The encoding of the images, see `gravityspy.plot.save_image`,
+            a `writer` uses its own, default: 'png'
+
+        thumbnail_scale (float, optional):
+            If given, also save the images downscaled by this factor to
+            the thumbnails subdirectory, default: None
+
     Returns
     -------
     """
     id_string = kwargs.pop('id_string', '{0:.9f}'.format(event_time))
     verbose = kwargs.pop('verbose', False)
+    renderer = kwargs.pop('renderer', None)
+    writer = kwargs.pop('writer', None)
+    image_format = kwargs.pop('image_format', 'png')
+    thumbnail_scale = kwargs.pop('thumbnail_scale', None)
+    super_image = kwargs.pop('super_image', 'plot')
+    if super_image not in ['plot', 'stitch', None]:
+        raise ValueError('Unknown super_image {0}, please choose from '
+                         'plot, stitch or None'.format(super_image))
     ###########################################################################
     #                           create output directory                       #
     ###########################################################################
@@ -184,33 +483,372 @@ def save_q_scans(plot_directory, specsgrams,
             logger.info('creating event directory')
         os.makedirs(plot_directory)
 
+    thumbnail_directory = os.path.join(plot_directory, 'thumbnails')
+    if thumbnail_scale is not None and not os.path.isdir(thumbnail_directory):
+        os.makedirs(thumbnail_directory)
+
     if verbose:
         logger.info('plot_directory:  {0}'.format(plot_directory))
 
     # Plot q_scans
     if verbose:
         logger.info('Plotting q scans...')
-    ind_fig_all, super_fig = plot_qtransform(specsgrams,
-                                             plot_normalized_energy_range,
-                                             plot_time_ranges,
-                                             detector_name,
-                                             event_time, **kwargs)
+    # a renderer reuses the figures of the previous event
+    if renderer is None:
+        plot = plot_qtransform
+    else:
+        plot = renderer.plot
+    ind_fig_all, super_fig = plot(specsgrams,
+                                  plot_normalized_energy_range,
+                                  plot_time_ranges,
+                                  detector_name,
+                                  event_time,
+                                  plot_super_fig=(super_image == 'plot'),
+                                  **kwargs)
+
+    # a writer encodes and writes the images in the background
+    if writer is None:
+        write_image = partial(save_image, image_format=image_format)
+    else:
+        image_format = writer.image_format
+        write_image = writer.write_image
+    extension = image_extension(image_format)
+
+    def _save(image, name):
+        write_image(image, os.path.join(plot_directory, name))
+        if thumbnail_scale is not None:
+            write_image(make_thumbnail(image, thumbnail_scale),
+                        os.path.join(thumbnail_directory, name))
 
+    panels = []
     for idx, ind_fig in enumerate(ind_fig_all):
         dur = float(plot_time_ranges[idx])
-        ind_fig.save(os.path.join(
-                                  plot_directory,
-                                  detector_name + '_' + id_string
-                                  + '_spectrogram_' + str(dur) +'.png'
-                                 ), dpi=100,
-                    )
-
-    super_fig.save(os.path.join(plot_directory, id_string + '.png'),)
+        panel = render_figure(ind_fig, dpi=100)
+        _save(panel, detector_name + '_' + id_string
+              + '_spectrogram_' + str(dur) + extension)
+        panels.append(panel)
 
-    plt.close('all')
+    if super_image == 'plot':
+        _save(render_figure(super_fig, dpi=super_fig.dpi),
+              id_string + extension)
+    elif super_image == 'stitch':
+        _save(stitch_qtransform(panels), id_string + extension)
 
     return
 
+def make_super_image(plot_directory, plot_time_ranges, detector_name,
+                     id_string, **kwargs):
+    """Make the image of all q scans of an event from its saved plots
+
+    The individual plots are laid out side by side, as
+    `save_q_scans` does with `super_image='stitch'`, so the combined
+    image only needs to be made when it is asked for.
+
+    Parameters:
+
+        plot_directory (str):
+            Where the individual plots were saved
+
+        plot_time_ranges (array):
+            The duration assosciated with each plot
+
+        detector_name (str):
+            What detetor where these plots from
+
+        id_string (str):
+            The id of the event
+
+        overwrite (bool, optional):
+            Make the image again if it exists, default: False
+
+        image_format (str, optional):
+            The encoding of the individual plots, and of the combined
+            image, see `gravityspy.plot.save_image`, default: 'png'
+
+    Returns:
+
+        filename (str):
+            The combined image, `id_string.png` in `plot_directory`
+    """
+    overwrite = kwargs.pop('overwrite', False)
+    image_format = kwargs.pop('image_format', 'png')
+    extension = image_extension(image_format)
+
+    filename = os.path.join(plot_directory, id_string + extension)
+    if os.path.isfile(filename) and not overwrite:
+        return filename
+
+    panels = []
+    for dur in plot_time_ranges:
+        panels.append(io.imread(os.path.join(
+            plot_directory,
+            detector_name + '_' + id_string
+            + '_spectrogram_' + str(float(dur)) + extension)))
+
+    save_image(stitch_qtransform(panels), filename,
+               image_format=image_format)
+    return filename
+
+def rasterize_q_scans(specsgrams, plot_normalized_energy_range,
+                      plot_time_ranges, detector_name, event_time, **kwargs):
+    """Convert q scans to the pixels the CNN reads, without plotting them
+
+    The pixels are the same as those `read_image` obtains from the plots
+    saved by `save_q_scans`.
+
+    Parameters:
+
+        specsgrams (list):
+            A list of `gwpy.spectrogram.Spectrogram` objects
+
+        plot_normalized_energy_range (array):
+            The min and max of the colorbar for the plots
+
+        plot_time_ranges (array):
+            The duration assosciated with each spectrogram
+
+        detector_name (str):
+            What detetor where these spectrograms from
+
+        event_time (float):
+            The time of the event
+
+        **kwargs:
+            id_string, frange, resolution, image_format
+
+            color : either 'grayscale' (default), 'rgb' or 'both'
+
+    Returns:
+
+        image_data (`numpy.ndarray`):
+            The (1, spectrograms, rows, columns) pixels, as from
+            `read_image.read_batch`, or a tuple of the grayscale and rgb
+            pixels for 'both'
+
+        names (list):
+            The one list of the images `save_q_scans` would have saved
+    """
+    id_string = kwargs.pop('id_string', '{0:.9f}'.format(event_time))
+    frange = kwargs.pop('frange', [10, 2048])
+    resolution = kwargs.pop('resolution', 0.3)
+    color = kwargs.pop('color', 'grayscale')
+    extension = image_extension(kwargs.pop('image_format', 'png'))
+
+    if color not in ['grayscale', 'rgb', 'both']:
+        raise ValueError('Unknown color {0}, please choose '
+                         'from grayscale, rgb or both'.format(color))
+
+    names = [detector_name + '_' + id_string + '_spectrogram_'
+             + str(float(dur)) + extension for dur in plot_time_ranges]
+    views = [rasterize_qtransform(spec, plot_normalized_energy_range,
+                                  frange=frange) for spec in specsgrams]
+    image_data = read_image.resample_views(views, resolution=resolution,
+                                           color=color)
+
+    if color == 'both':
+        return ((image_data[0][numpy.newaxis].astype('float32'),
+                 image_data[1][numpy.newaxis].astype('float32')), [names])
+    return image_data[numpy.newaxis].astype('float32'), [names]
+
+def read_q_scans(plot_directory, **kwargs):
+    """Read the pixels the CNNs read from the q scans of a directory
+
+    Parameters:
+
+        plot_directory (str):
+            Where `save_q_scans` saved the images
+
+        **kwargs:
+            image_format : the format the images were saved in,
+                default: 'png'
+
+            image_order : the patterns of the names of the images of
+                each view, default: the 0.5, 1.0, 2.0 and 4.0 second
+                views
+
+            color : either 'grayscale' (default), 'rgb' or 'both', in
+                which case every image is decoded only once for the two
+                arrays
+
+            nthreads : the number of images decoded at once, default: 4
+
+    Returns:
+
+        image_data (`numpy.ndarray`):
+            The (samples, 4, rows, columns) pixels, as from
+            `read_image.read_batch`, or a tuple of the grayscale and rgb
+            pixels for 'both'
+
+        names (list):
+            The names of the images of the views of each sample
+    """
+    extension = image_extension(kwargs.pop('image_format', 'png'))
+    image_order = kwargs.pop('image_order', [dur + extension for dur in
+                                             ['0.5', '1.0', '2.0', '4.0']])
+    color = kwargs.pop('color', 'grayscale')
+    nthreads = kwargs.pop('nthreads', 4)
+
+    list_of_images = [ifile for ifile in os.listdir(plot_directory)
+                      if 'spectrogram' in ifile and ifile.endswith(extension)]
+    names = [list(sample) for sample in zip(*[
+        sorted(image for image in list_of_images if re.search(order, image))
+        for order in image_order])]
+
+    image_data, _ = read_image.read_batch(
+        [[os.path.join(plot_directory, image) for image in sample]
+         for sample in names],
+        resolution=0.3, color=color, nthreads=nthreads)
+
+    return image_data, names
+
+def read_select_images(filename1, filename2, filename3, filename4,
+                       **kwargs):
+    """Read the pixels the CNNs read from the q scans of many events
+
+    Parameters:
+
+        filename1, filename2, filename3, filename4 (list):
+            The images of each duration, one of each per event
+
+        **kwargs:
+            color : either 'grayscale' (default), 'rgb' or 'both', in
+                which case every image is decoded only once for the two
+                arrays
+
+            nthreads : the number of images decoded at once, default: 4
+
+            pixel_cache : `cache.PixelCache` to read the pixels through,
+                default: `None`
+
+    Returns:
+
+        image_data (`numpy.ndarray`):
+            The pixels of the views of every event, see
+            `read_image.read_batch`, or a tuple of the grayscale and rgb
+            pixels for 'both'
+    """
+    color = kwargs.pop('color', 'grayscale')
+    nthreads = kwargs.pop('nthreads', 4)
+    pixel_cache = kwargs.pop('pixel_cache', None)
+
+    list_of_images_all = list(zip(filename1, filename2, filename3,
+                                  filename4))
+    if pixel_cache is None:
+        read_batch = read_image.read_batch
+    else:
+        read_batch = pixel_cache.read_batch
+    image_data, _ = read_batch(list_of_images_all, resolution=0.3,
+                               color=color, nthreads=nthreads)
+
+    return image_data
+
+def predict_batch(image_data, model_name, **kwargs):
+    """The outputs of a model for many samples
+
+    Parameters:
+
+        image_data (`numpy.ndarray`):
+            The pixels of the 4 views of every sample, as for
+            `labelling_test_glitches.predict_batch`
+
+        model_name (str):
+            The file of the model
+
+        **kwargs:
+            order_of_channels : default: 'channels_last'
+
+            batch_size : default: 64
+
+            rgb : default: `False`
+
+            penultimate : also return the activations fed to the last
+                layer of the model, default: `False`
+
+            inference_endpoint : where an `inference.InferenceServer`
+                holding the model listens, the model is loaded by this
+                process if the server cannot score the samples,
+                default: `None`
+
+    Returns:
+
+        outputs (`numpy.ndarray`):
+            or the outputs and the activations if `penultimate`
+    """
+    order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
+    batch_size = kwargs.pop('batch_size', 64)
+    rgb = kwargs.pop('rgb', False)
+    penultimate = kwargs.pop('penultimate', False)
+    inference_endpoint = kwargs.pop('inference_endpoint', None)
+
+    if inference_endpoint is not None:
+        try:
+            return InferenceClient(inference_endpoint).predict(
+                image_data, model_name, order_of_channels=order_of_channels,
+                rgb=rgb, penultimate=penultimate)
+        except InferenceUnavailable as exc:
+            logger = log.Logger('Gravity Spy: Inference')
+            logger.warning('{0}, loading {1} instead'.format(exc,
+                                                              model_name))
+
+    return label_glitches.predict_batch(image_data, model_name,
+                                        order_of_channels=order_of_channels,
+                                        batch_size=batch_size, rgb=rgb,
+                                        penultimate=penultimate)
+
+def score_batch(image_data, ids, path_to_cnn, **kwargs):
+    """Classify many samples from the pixels of their views
+
+    Parameters:
+
+        image_data (`numpy.ndarray`):
+            The (samples, 4, 140, 170) grayscale pixels of the 0.5, 1.0,
+            2.0 and 4.0 second views of each sample, as from
+            `read_image.read_batch`
+
+        ids (list):
+            The gravityspy id of each sample
+
+        path_to_cnn (str):
+            The classifier
+
+        **kwargs:
+            order_of_channels : default: 'channels_last'
+
+            batch_size : the number of samples passed through the
+                classifier at once, which bounds the memory used,
+                default: 64
+
+            classes : the name of each class, default: those stored
+                with the classifier
+
+            inference_endpoint : see `predict_batch`, default: `None`
+
+    Returns:
+
+        scores_table (`gwpy.table.GravitySpyTable`):
+            The score of every class, the ml_label and ml_confidence
+            of every sample
+    """
+    order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
+    batch_size = kwargs.pop('batch_size', 64)
+    classes = kwargs.pop('classes', None)
+    inference_endpoint = kwargs.pop('inference_endpoint', None)
+    if classes is None:
+        classes = MODEL_REGISTRY.get_classes(path_to_cnn)
+
+    scores = predict_batch(image_data, path_to_cnn,
+                           order_of_channels=order_of_channels,
+                           batch_size=batch_size,
+                           inference_endpoint=inference_endpoint)
+
+    scores_table = GravitySpyTable(scores, names=classes)
+
+    scores_table['gravityspy_id'] = ids
+    scores_table['ml_label'] = numpy.array(classes)[scores.argmax(1)]
+    scores_table['ml_confidence'] = scores.max(1)
+
+    return scores_table
+
 def label_q_scans(plot_directory, path_to_cnn, **kwargs):
     """Classify triggers in this table
 
@@ -222,56 +860,40 @@ def label_q_scans(plot_directory, path_to_cnn, **kwargs):
     """
     verbose = kwargs.pop('verbose', False)
     order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
-    image_order = kwargs.pop('image_order', ['0.5.png', '1.0.png', '2.0.png', '4.0.png'])
-
-    f = h5py.File(path_to_cnn, 'r')
-    # load the api gravityspy project cached class
-    classes = kwargs.pop('classes',
-                         numpy.array(f['/labels/labels']).astype(str).T[0])
+    image_format = kwargs.pop('image_format', 'png')
+    extension = image_extension(image_format)
+    image_order = kwargs.pop('image_order', [dur + extension for dur in
+                                             ['0.5', '1.0', '2.0', '4.0']])
+    image_data_for_cnn = kwargs.pop('image_data', None)
+    nthreads = kwargs.pop('nthreads', 4)
 
     if verbose:
         logger = log.Logger('Gravity Spy: Labelling Images')
-    # Since we created the images in a
-    # special temporary directory we can run os.listdir to get there full
-    # names so we can convert the images into ML readable format.
-    list_of_images = [ifile for ifile in os.listdir(plot_directory)
-                      if 'spectrogram' in ifile]
 
-    if verbose:
-        logger.info('Converting image to ML readable...')
-
-    image_data_for_cnn = pandas.DataFrame()
-    for image in list_of_images:
+    # pixels from rasterize_q_scans need no images on disk
+    if image_data_for_cnn is None:
         if verbose:
-            logger.info('Converting {0}'.format(image))
+            logger.info('Converting image to ML readable...')
 
-        image_data = read_image.read_grayscale(os.path.join(plot_directory, image),
-                                               resolution=0.3)
-        image_data_for_cnn[image] = [image_data]
+        image_data_for_cnn = read_q_scans(plot_directory,
+                                          image_format=image_format,
+                                          image_order=image_order,
+                                          nthreads=nthreads)
 
     # Now label the image
     if verbose:
         logger.info('Labelling image...')
 
-    scores, ml_label, ids, filename1, filename2, filename3, filename4 = \
-         label_glitches.label_glitches(image_data=image_data_for_cnn,
-                                       model_name='{0}'.format(path_to_cnn),
-                                       image_size=[140, 170],
-                                       order_of_channels=order_of_channels,
-                                       image_order=image_order,
-                                       verbose=verbose)
-
-    labels = numpy.array(classes)[ml_label]
-
-    scores_table = GravitySpyTable(scores, names=classes)
+    image_data, names = image_data_for_cnn
+    scores_table = score_batch(image_data,
+                               [sample[0].split('_')[1] for sample in names],
+                               path_to_cnn,
+                               order_of_channels=order_of_channels, **kwargs)
 
-    scores_table['Filename1'] = filename1
-    scores_table['Filename2'] = filename2
-    scores_table['Filename3'] = filename3
-    scores_table['Filename4'] = filename4
-    scores_table['gravityspy_id'] = ids
-    scores_table['ml_label'] = labels
-    scores_table['ml_confidence'] = scores.max(1)
+    scores_table['Filename1'] = [sample[0] for sample in names]
+    scores_table['Filename2'] = [sample[1] for sample in names]
+    scores_table['Filename3'] = [sample[2] for sample in names]
+    scores_table['Filename4'] = [sample[3] for sample in names]
 
     return scores_table
 
@@ -287,60 +909,30 @@ def label_select_images(filename1, filename2, filename3, filename4,
     """
     verbose = kwargs.pop('verbose', False)
     order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
-    image_order = kwargs.pop('image_order', ['0.5.png', '1.0.png', '2.0.png', '4.0.png'])
-
-    # determine class names
-    f = h5py.File(path_to_cnn, 'r')
-    classes = kwargs.pop('classes',
-                         numpy.array(f['/labels/labels']).astype(str).T[0])
+    nthreads = kwargs.pop('nthreads', 4)
+    pixel_cache = kwargs.pop('pixel_cache', None)
+    image_data_for_cnn = kwargs.pop('image_data', None)
 
     if verbose:
         logger = log.Logger('Gravity Spy: Labelling Select Images')
 
-    list_of_images_all = [filename1,
-                          filename2,
-                          filename3,
-                          filename4]
-
-    list_of_images_all = zip(list_of_images_all[0], list_of_images_all[1],
-                             list_of_images_all[2], list_of_images_all[3])
-
-    if verbose:
-        logger.info('Converting image to ML readable...')
-
-    image_data_for_cnn = pandas.DataFrame()
-
-    for list_of_images in list_of_images_all:
-        for image in list_of_images:
-            image_name = image.split('/')[-1]
-            if verbose:
-                logger.info('Converting {0}'.format(image_name))
+    # pixels from read_select_images need not be read again
+    if image_data_for_cnn is None:
+        if verbose:
+            logger.info('Converting image to ML readable...')
 
-            image_data = read_image.read_grayscale(image,
-                                                   resolution=0.3)
-            image_data_for_cnn[image_name] = [image_data]
+        image_data_for_cnn = read_select_images(filename1, filename2,
+                                                filename3, filename4,
+                                                nthreads=nthreads,
+                                                pixel_cache=pixel_cache)
 
     # Now label the image
     if verbose:
         logger.info('Labelling images...')
 
-    scores, ml_label, ids, _, _, _, _ = \
-         label_glitches.label_glitches(image_data=image_data_for_cnn,
-                                       model_name='{0}'.format(path_to_cnn),
-                                       image_size=[140, 170],
-                                       order_of_channels=order_of_channels,
-                                       image_order=image_order,
-                                       verbose=verbose)
-
-    labels = numpy.array(classes)[ml_label]
-
-    scores_table = GravitySpyTable(scores, names=classes)
-
-    scores_table['gravityspy_id'] = ids
-    scores_table['ml_label'] = labels
-    scores_table['ml_confidence'] = scores.max(1)
-
-    return scores_table
+    ids = [os.path.basename(str(image)).split('_')[1] for image in filename1]
+    return score_batch(image_data_for_cnn, ids, path_to_cnn,
+                       order_of_channels=order_of_channels, **kwargs)
 
 def get_features_select_images(filename1, filename2, filename3, filename4,
                                path_to_semantic_model, **kwargs):
@@ -354,40 +946,35 @@ def get_features_select_images(filename1, filename2, filename3, filename4,
     """
     verbose = kwargs.pop('verbose', False)
     order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
+    nthreads = kwargs.pop('nthreads', 4)
+    pixel_cache = kwargs.pop('pixel_cache', None)
+    image_data_for_cnn = kwargs.pop('image_data', None)
 
     # determine class names
     if verbose:
         logger = log.Logger('Gravity Spy: Extracting features select images')
 
-    list_of_images_all = [filename1,
-                          filename2,
-                          filename3,
-                          filename4]
-
-    list_of_images_all = zip(list_of_images_all[0], list_of_images_all[1],
-                             list_of_images_all[2], list_of_images_all[3])
-
-    image_data_for_cnn = pandas.DataFrame()
-
-    for list_of_images in list_of_images_all:
-        for image in list_of_images:
-            image_name = image.split('/')[-1]
-            if verbose:
-                logger.info('Converting {0}'.format(image_name))
+    # pixels from read_select_images need not be read again
+    if image_data_for_cnn is None:
+        if verbose:
+            logger.info('Converting image to ML readable...')
 
-            image_data_r, image_data_g, image_data_b = read_image.read_rgb(image,
-                                                                           resolution=0.3)
-            image_data_for_cnn[image] = [[image_data_r, image_data_g, image_data_b]]
+        image_data_for_cnn = read_select_images(filename1, filename2,
+                                                filename3, filename4,
+                                                color='rgb',
+                                                nthreads=nthreads,
+                                                pixel_cache=pixel_cache)
 
-    features, ids = label_glitches.get_multiview_feature_space(image_data=image_data_for_cnn,
-                                       semantic_model_name='{0}'.format(path_to_semantic_model),
-                                       image_size=[140, 170],
-                                       verbose=verbose,
-                                       order_of_channels=order_of_channels)
+    features = predict_batch(
+        image_data_for_cnn, path_to_semantic_model,
+        order_of_channels=order_of_channels,
+        batch_size=kwargs.pop('batch_size', 64), rgb=True,
+        inference_endpoint=kwargs.pop('inference_endpoint', None))
 
     scores_table = GravitySpyTable(features, names=numpy.arange(0, features.shape[1]).astype(str))
 
-    scores_table['gravityspy_id'] = ids
+    scores_table['gravityspy_id'] = [
+        os.path.basename(str(image)).split('_')[1] for image in filename1]
 
     return scores_table
 
@@ -402,99 +989,171 @@ def get_features(plot_directory, path_to_semantic_model, **kwargs):
     """
     verbose = kwargs.pop('verbose', False)
     order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
+    image_format = kwargs.pop('image_format', 'png')
+    extension = image_extension(image_format)
+    image_order = kwargs.pop('image_order', [dur + extension for dur in
+                                             ['0.5', '1.0', '2.0', '4.0']])
+    nthreads = kwargs.pop('nthreads', 4)
+    image_data_for_si = kwargs.pop('image_data', None)
 
     if verbose:
         logger = log.Logger('Gravity Spy: Extracting Feature Space')
-    # Since we created the images in a
-    # special temporary directory we can run os.listdir to get there full
-    # names so we can convert the images into ML readable format.
-    list_of_images = [ifile for ifile in os.listdir(plot_directory)
-                      if 'spectrogram' in ifile]
-
-    if verbose:
-        logger.info('Converting image to RGB readable...')
 
-    image_data_for_si = pandas.DataFrame()
-    for image in list_of_images:
+    # pixels from read_q_scans or rasterize_q_scans need not be read again
+    if image_data_for_si is None:
         if verbose:
-            logger.info('Converting {0}'.format(image))
+            logger.info('Converting image to RGB readable...')
 
-        image_data_r, image_data_g, image_data_b = read_image.read_rgb(os.path.join(plot_directory, image),
-                                                                       resolution=0.3)
-        image_data_for_si[image] = [[image_data_r, image_data_g, image_data_b]]
+        image_data_for_si = read_q_scans(plot_directory, color='rgb',
+                                         image_format=image_format,
+                                         image_order=image_order,
+                                         nthreads=nthreads)
 
     # Now label the image
     if verbose:
         logger.info('Extracting Features of Image...')
 
-    features, ids = label_glitches.get_multiview_feature_space(image_data=image_data_for_si,
-                                       semantic_model_name='{0}'.format(path_to_semantic_model),
-                                       image_size=[140, 170],
-                                       verbose=verbose,
-                                       order_of_channels=order_of_channels)
+    image_data, names = image_data_for_si
+    features = predict_batch(
+        image_data, path_to_semantic_model,
+        order_of_channels=order_of_channels,
+        batch_size=kwargs.pop('batch_size', 64), rgb=True,
+        inference_endpoint=kwargs.pop('inference_endpoint', None))
 
     scores_table = GravitySpyTable(features, names=numpy.arange(0, features.shape[1]).astype(str))
 
-    scores_table['gravityspy_id'] = ids
+    scores_table['gravityspy_id'] = [sample[0].split('_')[1]
+                                     for sample in names]
 
     return scores_table
 
-def get_deeplayer(plot_directory, path_to_cnn, **kwargs):
-    """Classify triggers in this table
+def label_and_embed_q_scans(plot_directory, path_to_cnn, **kwargs):
+    """Classify the q scans of an event and describe them for similarity
+
+    The images are read once and each model runs once over them, so
+    this gives at the same time what `label_q_scans`, `get_deeplayer`
+    and `get_features` give.
 
     Parameters:
-    -----------
 
-    Returns
-    -------
+        plot_directory (str):
+            Where `save_q_scans` saved the images
+
+        path_to_cnn (str):
+            The classifier
+
+        **kwargs:
+            path_to_semantic_model : the similarity model, default:
+                `None`, no features
+
+            image_data : the pixels and the names of the images as from
+                `read_q_scans` or `rasterize_q_scans`, with
+                `color='both'` if `path_to_semantic_model` is given,
+                default: read from `plot_directory`
+
+            classes : the name of each class, default: those stored
+                with the classifier
+
+            order_of_channels : default: 'channels_last'
+
+            batch_size : the number of samples passed through each
+                model at once, default: 64
+
+            image_format : default: 'png'
+
+            nthreads : the number of images decoded at once, default: 4
+
+            inference_endpoint : see `predict_batch`, default: `None`
+
+    Returns:
+
+        events (`gravityspy.table.Events`):
+            The score of every class, the ml_label and ml_confidence,
+            the activations of the deep layer of the classifier in
+            `deeplayer` and, with `path_to_semantic_model`, the
+            features in the columns '0', '1', ... as `get_features`
     """
-    verbose = kwargs.pop('verbose', False)
-    f = h5py.File(path_to_cnn, 'r')
-    # load the api gravityspy project cached class
-    classes = kwargs.pop('classes',
-                         numpy.array(f['/labels/labels']).astype(str).T[0])
+    # the tables are built on the utilities of this module
+    from ..table import Events
 
-    if verbose:
-        logger = log.Logger('Gravity Spy: Labelling Images')
-    # Since we created the images in a
-    # special temporary directory we can run os.listdir to get there full
-    # names so we can convert the images into ML readable format.
-    list_of_images = [ifile for ifile in os.listdir(plot_directory)
-                      if 'spectrogram' in ifile]
+    path_to_semantic_model = kwargs.pop('path_to_semantic_model', None)
+    order_of_channels = kwargs.pop('order_of_channels', 'channels_last')
+    batch_size = kwargs.pop('batch_size', 64)
+    classes = kwargs.pop('classes', None)
+    image_format = kwargs.pop('image_format', 'png')
+    extension = image_extension(image_format)
+    image_order = kwargs.pop('image_order', [dur + extension for dur in
+                                             ['0.5', '1.0', '2.0', '4.0']])
+    image_data = kwargs.pop('image_data', None)
+    nthreads = kwargs.pop('nthreads', 4)
+    inference_endpoint = kwargs.pop('inference_endpoint', None)
+    if kwargs:
+        raise TypeError('Unknown keyword arguments {0}'.format(
+                        ', '.join(sorted(kwargs))))
+    if classes is None:
+        classes = MODEL_REGISTRY.get_classes(path_to_cnn)
+
+    if image_data is None:
+        image_data = read_q_scans(plot_directory, image_format=image_format,
+                                  image_order=image_order, nthreads=nthreads,
+                                  color=('grayscale'
+                                         if path_to_semantic_model is None
+                                         else 'both'))
+    image_data, names = image_data
+    if path_to_semantic_model is not None:
+        image_data, image_data_rgb = image_data
+
+    scores, deeplayer = predict_batch(
+        image_data, path_to_cnn, order_of_channels=order_of_channels,
+        batch_size=batch_size, penultimate=True,
+        inference_endpoint=inference_endpoint)
+
+    events = Events(scores, names=classes)
+    events['Filename1'] = [sample[0] for sample in names]
+    events['Filename2'] = [sample[1] for sample in names]
+    events['Filename3'] = [sample[2] for sample in names]
+    events['Filename4'] = [sample[3] for sample in names]
+    events['gravityspy_id'] = [sample[0].split('_')[1] for sample in names]
+    events['ml_label'] = numpy.array(classes)[scores.argmax(1)]
+    events['ml_confidence'] = scores.max(1)
+    events['deeplayer'] = deeplayer
+
+    if path_to_semantic_model is not None:
+        features = predict_batch(
+            image_data_rgb, path_to_semantic_model,
+            order_of_channels=order_of_channels, batch_size=batch_size,
+            rgb=True, inference_endpoint=inference_endpoint)
+        for idx in range(features.shape[1]):
+            events[str(idx)] = features[:, idx]
+
+    return events
 
-    if verbose:
-        logger.info('Converting image to ML readable...')
+def get_deeplayer(plot_directory, path_to_cnn, **kwargs):
+    """Classify the q scans of an event and keep the deep layer
 
-    image_data_for_cnn = pandas.DataFrame()
-    for image in list_of_images:
-        if verbose:
-            logger.info('Converting {0}'.format(image))
+    Parameters:
 
-        image_data = read_image.read_grayscale(os.path.join(plot_directory, image),
-                                               resolution=0.3)
-        image_data_for_cnn[image] = [image_data]
+        plot_directory (str):
+            Where `save_q_scans` saved the images
 
-    # Now label the image
-    if verbose:
-        logger.info('Labelling image...')
+        path_to_cnn (str):
+            The classifier
 
-    scores, ml_label, deeplayer, ids, filename1, filename2, filename3, filename4 = \
-         label_glitches.get_deeplayer(image_data=image_data_for_cnn,
-                                       model_name='{0}'.format(path_to_cnn),
-                                       image_size=[140, 170],
-                                       verbose=verbose)
+        **kwargs:
+            see `label_and_embed_q_scans`
 
-    labels = numpy.array(classes)[ml_label]
+    Returns:
 
-    scores_table = GravitySpyTable(scores, names=classes)
+        scores_table (`gwpy.table.GravitySpyTable`):
+            The score of every class, the ml_label, ml_confidence and
+            the activations of the deep layer of every sample
+    """
+    verbose = kwargs.pop('verbose', False)
 
-    scores_table['Filename1'] = filename1
-    scores_table['Filename2'] = filename2
-    scores_table['Filename3'] = filename3
-    scores_table['Filename4'] = filename4
-    scores_table['gravityspy_id'] = ids
-    scores_table['ml_label'] = labels
-    scores_table['ml_confidence'] = scores.max(1)
-    scores_table['deeplayer'] = deeplayer
+    if verbose:
+        logger = log.Logger('Gravity Spy: Labelling Images')
+        logger.info('Labelling image...')
 
-    return scores_table
+    events = label_and_embed_q_scans(plot_directory, path_to_cnn, **kwargs)
+
+    return GravitySpyTable(events)